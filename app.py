@@ -2,20 +2,53 @@
 Main application module for the Kids Audio Player
 """
 import os
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, url_for
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 from routes.rfid_routes import rfid_bp
+from routes.api_routes import api_bp, emit_event
+from routes.debug_routes import debug_bp
+from routes.asset_routes import assets_bp
+from routes.sync_routes import sync_bp
 from models import db
+from db import DATABASE_URL
 import logging
 import threading
 import time
 from utils.rfid_shared import get_rfid_handler
-from utils.player import MP3Player, start_playback, stop_playback
-from config import MUSIC_DIR
+from utils.player import MP3Player, start_playback, stop_playback, set_gain_provider
+from utils.loudness import LoudnessAnalyzer
+from utils.jobs import JobScheduler, PRIORITY_HIGH, PRIORITY_LOW, claim_scheduler
+from utils.watchdog import create_watchdog
+from utils.metrics import metrics
+from utils import sched_policy
+from utils.audio_telemetry import telemetry as audio_telemetry
+from utils.library import Library
+from utils.search_index import LibrarySearch
+from utils.pagination import paginate
+from utils.http_cache import page_headers
+from utils.response_cache import cached_json_response
+from utils.file_handler import SOURCE_EXTENSIONS
+from utils.transcode import get_transcode_cache
+from utils.card_payload import CardResolver
+from controllers.card_programmer import card_programmer
+from utils.reader_pool import create_reader_pool
+from utils import change_notify
+from utils.log_pipeline import setup_logging
+from utils.mapping_store import export_mappings
+from utils.assets import AssetPipeline
+from utils.fleet_sync import SyncIndex
+from utils.multiroom import create_multiroom
+from utils.event_emitter import EventEmitter, ROOM_ALL, reader_room
+from utils.event_bus import create_bus, bridge_generations
+from utils.generation import EPOCH, LIBRARY, TAGS, get_generation, add_listener
+from config import (MUSIC_DIR, LOUDNESS_ANALYSIS, RFID_CARD_PAYLOAD, RFID_READERS, RFID_REMOVAL_MISSES,
+                    CHANGE_NOTIFY, MAPPING_EXPORT, MAPPING_FILE, ASSET_PIPELINE,
+                    SW_AUDIO_QUOTA_MB, SOCKET_EMIT_WINDOW_MS, SOCKET_ACK_TIMEOUT, APP_ROLE,
+                    SYNC_ENABLED, SYNC_INDEX_FILE, JOBS_ENABLED, PLAYBACK_ENGINE, AUDIO_DEVICE)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (queued, written by a background thread)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Create Flask app
@@ -23,26 +56,90 @@ app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Configure database
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///kids_audio_player.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Configure MP3 directory
-MUSIC_DIR = os.environ.get('MUSIC_DIR', os.path.join(os.getcwd(), 'mp3s'))
-if not os.path.exists(MUSIC_DIR):
-    os.makedirs(MUSIC_DIR)
-    logger.info(f"Created MP3 directory at {MUSIC_DIR}")
+# The MP3 directory is MUSIC_DIR from config.py (created there)
+# Cached view of the music directory and its search index
+# (non-MP3 sources are only listed if they can be transcoded)
+library = Library(MUSIC_DIR, extensions=SOURCE_EXTENSIONS if get_transcode_cache() else ('.mp3',))
+app.extensions['library'] = library
+app.extensions['library_search'] = LibrarySearch(library)
+card_resolver = CardResolver(library)
 
 # Initialize database
 db.init_app(app)
 
 # Register blueprints
 app.register_blueprint(rfid_bp)
+app.register_blueprint(api_bp)
+app.register_blueprint(debug_bp)
+app.register_blueprint(assets_bp)
+sync_index = None
+if SYNC_ENABLED:
+    # Other boxes pull the music library from here
+    sync_index = SyncIndex(MUSIC_DIR, SYNC_INDEX_FILE)
+    app.extensions['sync_index'] = sync_index
+    app.register_blueprint(sync_bp)
+
+# Fingerprint and precompress the static assets once
+asset_pipeline = None
+if ASSET_PIPELINE:
+    try:
+        asset_pipeline = AssetPipeline(app.static_folder)
+        asset_pipeline.build()
+    except Exception as e:
+        logger.error(f"Asset-Pipeline fehlgeschlagen, verwende /static: {e}")
+        asset_pipeline = None
+app.extensions['assets'] = asset_pipeline
+
+@app.template_global()
+def asset_url(name):
+    """URL of a static asset, fingerprinted if the pipeline is active"""
+    if asset_pipeline:
+        return asset_pipeline.url(name)
+    return url_for('static', filename=name)
 
 # Create database tables
 with app.app_context():
     db.create_all()
     logger.info("Database tables created")
 
+def export_tag_mappings():
+    """Export the tag mappings for the headless appliance"""
+    try:
+        with app.app_context():
+            from models import RFIDTag
+            return export_mappings(MAPPING_FILE, RFIDTag.query.all(), get_generation(TAGS))
+    except Exception as e:
+        logger.error(f"Fehler beim Exportieren der Tag-Zuordnungen: {e}")
+
+@app.cli.command('export-mappings')
+def export_mappings_command():
+    """Export the tag mappings to MAPPING_FILE"""
+    count = export_tag_mappings()
+    print(f"{count} Tag-Zuordnungen nach {MAPPING_FILE} exportiert")
+
+# Keep the exported mappings in sync with the database
+if MAPPING_EXPORT:
+    add_listener(lambda name, generation, keys, remote: name == TAGS and not remote and export_tag_mappings())
+    export_tag_mappings()
+
+# Tell other processes (e.g. the RFID service) about changed tag mappings
+if CHANGE_NOTIFY:
+    change_notify.install()
+
+# Only one process owns the reader and the audio output, web workers
+# (APP_ROLE=web) get its events over the bus
+OWNS_READER = APP_ROLE in ('all', 'owner')
+
+# Analyze the loudness of new tracks in the background and apply it on playback
+# (as jobs of the scheduler below if it is enabled)
+loudness_analyzer = LoudnessAnalyzer(app, library)
+set_gain_provider(loudness_analyzer.get_gain)
+if LOUDNESS_ANALYSIS and OWNS_READER and not JOBS_ENABLED:
+    loudness_analyzer.start()
+
 # Global variables for RFID scanning
 scanning = False
 current_tag = None
@@ -50,27 +147,267 @@ current_tag = None
 # Initialize MP3 player
 player = MP3Player()
 
+# In a multiroom group the synchronized player takes over: taps on the
+# leader play on all boxes (see utils/multiroom.py)
+multiroom = create_multiroom() if OWNS_READER else None
+if multiroom:
+    player = multiroom
+app.extensions['multiroom'] = multiroom
+
 # Initialize RFID handler
-rfid_handler = get_rfid_handler()
+rfid_handler = get_rfid_handler() if OWNS_READER else None
+
+# Socket.IO events are sent by a background thread, never by the reader loops
+event_emitter = EventEmitter(socketio, window=SOCKET_EMIT_WINDOW_MS / 1000, ack_timeout=SOCKET_ACK_TIMEOUT)
+event_emitter.start()
+app.extensions['event_emitter'] = event_emitter
+
+# Events and state are shared with the other processes over the bus
+event_bus = create_bus(APP_ROLE)
+app.extensions['event_bus'] = event_bus
+bridge_generations(event_bus, (TAGS,))
+
+def relay_event(topic, message):
+    """Pass an event from the bus on to this process's clients"""
+    event_emitter.emit(message['event'], message['data'], message['room'])
+    emit_event(message['event'], message['data'])
+
+event_bus.subscribe('socket.event', relay_event)
+last_event = event_bus.retained('socket.event')
+if last_event:
+    emit_event(last_event['event'], last_event['data'])
+
+# Events that describe the current reader and playback state; only these
+# are retained for workers that start later
+STATE_EVENTS = ('tag_detected', 'tag_removed', 'song_playing')
+
+def emit(event, data=None, room=None):
+    """Send an event to the Socket.IO clients of all processes and to the polling endpoint"""
+    event_bus.publish('socket.event', {'event': event, 'data': data, 'room': room},
+                      retain=event in STATE_EVENTS)
+
+def tag_present(tag_id):
+    """Check whether a tag is still on one of the readers"""
+    if tag_id in (current_tag, rfid_handler.current_tag):
+        return True
+    return bool(reader_pool) and any(r.current_tag == tag_id for r in reader_pool.readers.values())
+
+def verify_card(tag_id, filename, play, room=None):
+    """
+    Check a track started from a card payload against the database.
+
+    Runs in a background thread, so playback does not wait for the
+    database. If the database maps the tag to a different track, that
+    track is played instead.
+    """
+    def _verify():
+        try:
+            with app.app_context():
+                from models import RFIDTag
+                tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
+                db_filename = tag.mp3_filename if tag else None
+                name = tag.name if tag else None
+        except Exception as e:
+            logger.warning(f"Datenbank nicht erreichbar, Tag {tag_id} nur über die Karte aufgelöst: {e}")
+            return
+
+        if not db_filename:
+            logger.info(f"Tag {tag_id} nicht registriert, spiele Track von der Karte")
+        elif db_filename != filename and tag_present(tag_id):
+            logger.warning(f"Karte {tag_id} verweist auf {filename}, Datenbank auf {db_filename}")
+            if play(db_filename):
+                emit('song_playing', {'title': name, 'filename': db_filename}, room)
+
+    threading.Thread(target=_verify, daemon=True).start()
+
+def play_tag(tag_id, text, play, room=None):
+    """
+    Start the track of a tag.
+
+    A self-describing card is played straight from its payload, other
+    cards are looked up in the database.
+
+    Args:
+        tag_id (str): ID of the tag
+        text (str): Text stored on the tag (may be None)
+        play (callable): Starts playback of a filename, returns success
+        room (str): Socket.IO room of the reader (None for all clients)
+    """
+    filename = card_resolver.resolve(text) if text else None
+    if filename:
+        if play(filename):
+            emit('song_playing', {
+                'title': os.path.splitext(os.path.basename(filename))[0],
+                'filename': filename
+            }, room)
+        verify_card(tag_id, filename, play, room)
+        return
+
+    try:
+        with app.app_context():
+            from models import RFIDTag
+            tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
+            filename = tag.mp3_filename if tag else None
+            name = tag.name if tag else None
+    except Exception as e:
+        logger.error(f"Datenbankfehler beim Auflösen von Tag {tag_id}: {e}")
+        return
+
+    if filename:
+        # Start playback
+        if play(filename):
+            emit('song_playing', {'title': name, 'filename': filename}, room)
+        else:
+            logger.error(f"Konnte MP3 nicht abspielen: {filename}")
+    else:
+        logger.info(f"Tag {tag_id} nicht registriert oder keine MP3-Datei verknüpft")
+
+def program_card(tag_id, write=None):
+    """Write the next queued track to a card while bulk programming is active"""
+    with app.app_context():
+        item = card_programmer.program(tag_id, write or rfid_handler.write_once)
+    if item:
+        emit('card_programmed', item)
+
+# Report every track whose payload is ready (or failed) while programming starts
+card_programmer.on_prepared = lambda item: emit('card_prepared', item)
 
 def tag_callback(tag_id, status):
     """Callback function for RFID tag events"""
     if status == 'present':
-        # Get tag from database
-        from models import db, RFIDTag
-        with app.app_context():
-            tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
-            if tag:
-                # Play the associated MP3
-                player.play(tag.mp3_filename)
-                socketio.emit('song_playing', {'title': tag.name})
+        if card_programmer.active:
+            program_card(tag_id)
+            return
+        # The callback runs after the loop moved on, the text belongs to the tag on the reader
+        text = rfid_handler.current_text if rfid_handler.current_tag == tag_id else None
+        play_tag(tag_id, text, player.play)
     elif status == 'absent':
         # Stop playback when tag is removed
         player.stop()
-        socketio.emit('tag_removed')
+        emit('tag_removed')
 
 # Register callback with RFID handler
-rfid_handler.register_callback(tag_callback)
+if rfid_handler:
+    rfid_handler.register_callback(tag_callback)
+
+# Several readers share the SPI bus in a pool, each with its own player
+reader_pool = None
+reader_players = {}
+
+def pool_callback(tag_id, status, reader_id):
+    """Callback function for tag events of the reader pool"""
+    player_ = reader_players[reader_id]
+    if status == 'present':
+        if card_programmer.active:
+            program_card(tag_id, lambda text: reader_pool.write_once(reader_id, text))
+            return
+        # The callback runs after the pool moved on, the text belongs to the tag on the reader
+        reader = reader_pool.readers[reader_id]
+        text = reader.current_text if reader.current_tag == tag_id else None
+        play_tag(tag_id, text, player_.play, reader_room(reader_id))
+    elif status == 'absent':
+        player_.stop()
+        emit('tag_removed', {'tag_id': tag_id, 'reader': reader_id}, reader_room(reader_id))
+
+if RFID_READERS and OWNS_READER:
+    try:
+        reader_pool = create_reader_pool(
+            RFID_READERS, pool_callback,
+            removal_misses=RFID_REMOVAL_MISSES,
+            read_text=RFID_CARD_PAYLOAD
+        )
+        reader_players = {reader_id: MP3Player(reader.output) for reader_id, reader in reader_pool.readers.items()}
+        # The mixer of a device is shared by all its players
+        outputs = [reader.output or AUDIO_DEVICE for reader in reader_pool.readers.values()]
+        if PLAYBACK_ENGINE == 'mixer' and len(set(outputs)) < len(outputs):
+            logger.error("Mehrere Leser teilen sich ein Audiogerät, mit PLAYBACK_ENGINE=mixer "
+                         "beenden sie gegenseitig ihre Titel - jedem Leser ein eigenes Gerät zuweisen (RFID_READERS)")
+    except Exception as e:
+        logger.error(f"Leser-Pool konnte nicht initialisiert werden: {e}")
+        reader_pool = None
+app.extensions['reader_pool'] = reader_pool
+
+def read_tag_request(data=None):
+    """Read the tag on the reader once (bus request 'rfid.scan')"""
+    if not rfid_handler:
+        raise RuntimeError("RFID handler not initialized")
+    tag_id, text = rfid_handler.read_once(with_text=True)
+    return {'tag_id': str(tag_id) if tag_id else None, 'text': text}
+
+def program_request(data):
+    """Control the bulk card programming (bus request 'rfid.program')"""
+    action = (data or {}).get('action')
+    if action == 'start':
+        try:
+            # Returns at once, the payloads are computed in the background
+            card_programmer.start(library.directory, data['items'])
+        except ValueError as e:
+            return {'error': str(e), 'status': 400}
+        except FileNotFoundError as e:
+            return {'error': str(e), 'status': 404}
+    if action == 'cancel':
+        card_programmer.cancel()
+    return card_programmer.status()
+
+# Requests the web workers send to the reader process
+if OWNS_READER:
+    event_bus.handle('rfid.scan', read_tag_request)
+    event_bus.handle('rfid.program', program_request)
+    event_bus.handle('rfid.readers', lambda data: reader_pool.stats() if reader_pool else [])
+    event_bus.handle('multiroom.status', lambda data: multiroom.status() if multiroom else {'role': 'off'})
+    event_bus.handle('jobs.status', lambda data: job_scheduler.status() if job_scheduler else {'enabled': False})
+    event_bus.handle('watchdog.status', lambda data: watchdog.status() if watchdog else {})
+    event_bus.handle('metrics', lambda data: metrics.render())
+    event_bus.handle('sched.status', lambda data: sched_policy.status())
+    event_bus.handle('audio.telemetry', lambda data: audio_telemetry.status())
+
+# Restart a wedged reader loop or a hanging decoder (see utils/watchdog.py)
+watchdog = create_watchdog(reader_pool or rfid_handler) if OWNS_READER else None
+if watchdog:
+    watchdog.start()
+app.extensions['watchdog'] = watchdog
+
+def library_scan_job(ctx):
+    """Job: rescan the music directory"""
+    library.scan(ctx.checkpoint)
+
+def sync_index_job(ctx):
+    """Job: chunk new and changed files for /sync/manifest"""
+    sync_index.manifest(refresh=True, checkpoint=ctx.checkpoint)
+
+def maintenance_job(ctx):
+    """Job: prune old jobs and loudness results of deleted tracks"""
+    from models import TrackLoudness
+    pruned = job_scheduler.prune()
+    known = {song['filename'] for song in library.get_songs()}
+    with app.app_context():
+        # An empty library is more likely an unmounted card than deleted tracks
+        stale = [row for row in TrackLoudness.query.all() if known and row.filename not in known]
+        for row in stale:
+            ctx.checkpoint()
+            db.session.delete(row)
+        db.session.commit()
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(db.text('PRAGMA optimize'))
+    logger.info(f"Wartung: {pruned} alte Jobs und {len(stale)} Lautheitswerte gelöscht")
+
+# Library scans, loudness analysis and maintenance run as niced background
+# jobs that wait while audio plays (see utils/jobs.py), in one process only
+job_scheduler = None
+if JOBS_ENABLED and OWNS_READER and claim_scheduler():
+    job_scheduler = JobScheduler(app, is_playing=lambda: player.is_playing() or
+                                 any(p.is_playing() for p in reader_players.values()))
+    job_scheduler.register('library.scan', library_scan_job, priority=PRIORITY_HIGH, pause_while_playing=False)
+    library.set_scan_hook(lambda: job_scheduler.submit('library.scan', key='library.scan'))
+    job_scheduler.register('db.maintenance', maintenance_job, priority=PRIORITY_LOW)
+    job_scheduler.every(24 * 3600, 'db.maintenance')
+    if sync_index:
+        job_scheduler.register('sync.index', sync_index_job, priority=PRIORITY_LOW)
+        sync_index.set_refresh_hook(lambda: job_scheduler.submit('sync.index', key='sync.index'))
+    if LOUDNESS_ANALYSIS:
+        loudness_analyzer.schedule(job_scheduler)
+    job_scheduler.start()
+app.extensions['jobs'] = job_scheduler
 
 def start_rfid_scan():
     """Start continuous RFID scanning"""
@@ -101,32 +438,25 @@ def start_rfid_scan():
                     logger.debug(f"Neuer Tag erkannt: {tag_id}")
                     current_tag = tag_id
                     
+                    # Read the track reference of a self-describing card once
+                    if RFID_CARD_PAYLOAD:
+                        text = rfid_handler.read_text(tag_id)
+                    
                     # Emit tag detected event
-                    socketio.emit('tag_detected', {
+                    emit('tag_detected', {
                         'tag_id': tag_id,
                         'text': text
                     })
                     
-                    # Check if tag is registered and play song
-                    with app.app_context():
-                        from models import RFIDTag
-                        tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
-                        if tag and tag.mp3_filename:
-                            # Start playback
-                            if start_playback(tag.mp3_filename):
-                                socketio.emit('song_playing', {
-                                    'title': tag.name,
-                                    'filename': tag.mp3_filename
-                                })
-                            else:
-                                logger.error(f"Konnte MP3 nicht abspielen: {tag.mp3_filename}")
-                        else:
-                            logger.info(f"Tag {tag_id} nicht registriert oder keine MP3-Datei verknüpft")
+                    if card_programmer.active:
+                        program_card(tag_id)
+                    else:
+                        play_tag(tag_id, text, start_playback)
             else:
                 if current_tag:
                     # Tag removed
                     logger.debug(f"Tag entfernt: {current_tag}")
-                    socketio.emit('tag_removed', {'tag_id': current_tag})
+                    emit('tag_removed', {'tag_id': current_tag})
                     current_tag = None
                     stop_playback()
                     
@@ -144,29 +474,74 @@ def index():
     """Render the main page"""
     return render_template('index.html')
 
+@app.route('/sw.js')
+def service_worker():
+    """Service worker of the tablet client (served from the root for its scope)"""
+    script = render_template('sw.js', audio_quota_bytes=SW_AUDIO_QUOTA_MB * 1024 * 1024)
+    response = Response(script, mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/songs')
 def get_songs():
-    """Get list of MP3 files"""
+    """Get list of MP3 files (supports q, prefix, sort, limit and cursor)"""
     try:
-        songs = []
-        for filename in os.listdir(MUSIC_DIR):
-            if filename.lower().endswith('.mp3'):
-                # Use filename without extension as title
-                title = os.path.splitext(filename)[0]
-                songs.append({
-                    'filename': filename,
-                    'title': title
-                })
-        return jsonify(songs)
+        generation = library.refresh()
+
+        def build():
+            songs, next_cursor, total = paginate(
+                library.get_songs(),
+                request.args,
+                sort_keys=('title', 'filename'),
+                search_fields=('title', 'filename'),
+                id_key='filename',
+                default_sort='title'
+            )
+            return songs, page_headers(next_cursor, total, generation)
+
+        return cached_json_response('songs', LIBRARY, generation, request.args, build)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting songs: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/songs/changes')
+def get_song_changes():
+    """
+    Get the songs that changed since a library generation.
+
+    Query parameters: since (X-Generation of the client's copy) and epoch
+    (its X-Epoch). If the changes are no longer known, "reset" tells the
+    client to load the full list again.
+    """
+    try:
+        since = int(request.args.get('since', ''))
+        epoch = int(request.args.get('epoch', EPOCH))
+    except ValueError:
+        return jsonify({"error": "since and epoch must be numbers"}), 400
+
+    generation = library.refresh()
+
+    def build():
+        changes = library.changes_since(since) if epoch == EPOCH else None
+        if changes is None:
+            payload = {"reset": True}
+        else:
+            upserts, removed = changes
+            payload = {"reset": False, "upserts": upserts, "removed": removed}
+        payload.update({"generation": generation, "epoch": EPOCH})
+        return payload, None
+
+    return cached_json_response('song-changes', LIBRARY, generation, request.args, build)
+
 @socketio.on('connect')
 def handle_connect():
     """Handle WebSocket connection"""
     logger.info("Client connected")
-    if not scanning:
+    join_room(ROOM_ALL)
+    event_emitter.add_client(request.sid)
+    if OWNS_READER and not scanning and not reader_pool:
         # Start RFID scanning in a separate thread
         threading.Thread(target=start_rfid_scan, daemon=True).start()
 
@@ -174,10 +549,27 @@ def handle_connect():
 def handle_disconnect():
     """Handle WebSocket disconnection"""
     logger.info("Client disconnected")
+    event_emitter.remove_client(request.sid)
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Only receive the events of some readers ({"readers": [...]}, empty for all)"""
+    readers = (data or {}).get('readers') or []
+    wanted = [reader_room(reader_id) for reader_id in readers] or [ROOM_ALL]
+    for room in rooms():
+        if room != request.sid and room not in wanted:
+            leave_room(room)
+    for room in wanted:
+        join_room(room)
+    event_emitter.set_rooms(request.sid, wanted)
+    return {'rooms': wanted}
 
 if __name__ == '__main__':
-    # Start RFID handler
-    rfid_handler.start()
+    # Start the reader pool or the single RFID handler
+    if reader_pool:
+        reader_pool.start()
+    elif rfid_handler:
+        rfid_handler.start()
     
     # Run Flask app with SocketIO
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,121 @@
+"""
+Headless appliance mode
+
+Runs only the tag-to-playback loop: the RFID reader, the tag mappings
+exported by the web app (see utils/mapping_store.py) and the player.
+Flask, Flask-SocketIO and SQLAlchemy are never imported, which keeps
+memory use and startup time low on small boards without a UI.
+
+    python appliance.py   # run the appliance
+
+tests/test_appliance.py checks the memory and startup budgets.
+"""
+import time
+STARTED = time.perf_counter()
+
+import sys
+import json
+import signal
+import argparse
+import logging
+from config import MAPPING_FILE, MUSIC_DIR, RFID_CARD_PAYLOAD
+from utils.mapping_store import MappingStore
+from utils.rfid_handler import RFIDHandler
+from utils.player import start_playback, stop_playback
+from utils.log_pipeline import setup_logging
+from utils.watchdog import create_watchdog
+
+logger = logging.getLogger(__name__)
+
+# Modules the appliance must not load
+HEAVY_MODULES = ('flask', 'flask_socketio', 'flask_sqlalchemy', 'sqlalchemy')
+
+def rss_mb():
+    """Resident memory of this process in MB (None if unknown)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+class Appliance:
+    """
+    Plays the track of a tag while it is on the reader
+    """
+    def __init__(self, handler, store, resolver=None):
+        self.handler = handler
+        self.store = store
+        self.resolver = resolver
+        handler.register_callback(self.on_tag)
+
+    def on_tag(self, tag_id, status):
+        """Callback for tag events of the RFID handler"""
+        if status == 'absent':
+            stop_playback()
+            return
+        if status != 'present':
+            return
+
+        # Self-describing cards carry their track, others are looked up
+        filename = None
+        if self.resolver and self.handler.current_text:
+            filename = self.resolver.resolve(self.handler.current_text)
+        if not filename:
+            mapping = self.store.get(tag_id)
+            filename = mapping[1] if mapping else None
+
+        if filename:
+            logger.info(f"Tag {tag_id}: spiele {filename}")
+            start_playback(filename)
+        else:
+            logger.info(f"Tag {tag_id} nicht registriert")
+
+    def run(self):
+        """Run until SIGINT/SIGTERM"""
+        self.handler.start()
+        watchdog = create_watchdog(self.handler)
+        if watchdog:
+            watchdog.start()
+        while self.handler.running:
+            time.sleep(1)
+
+def build():
+    """Create the appliance from the configuration"""
+    resolver = None
+    if RFID_CARD_PAYLOAD:
+        from utils.card_payload import CardResolver
+        from utils.library import Library
+        resolver = CardResolver(Library(MUSIC_DIR))
+    return Appliance(RFIDHandler(), MappingStore(MAPPING_FILE), resolver)
+
+def report():
+    """Startup figures of this process"""
+    return {
+        'startup_s': round(time.perf_counter() - STARTED, 3),
+        'rss_mb': rss_mb(),
+        'heavy_modules': [m for m in HEAVY_MODULES if m in sys.modules]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Kids Audio Player without web interface")
+    parser.add_argument('--report', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    setup_logging(logging.WARNING if args.report else None)
+    appliance = build()
+
+    if args.report:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        print(json.dumps(report()))
+        return
+
+    figures = report()
+    logger.info(f"Appliance bereit nach {figures['startup_s']} s, RSS {figures['rss_mb']} MB, "
+                f"{len(appliance.store)} Tags")
+    appliance.run()
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,169 @@
 Configuration settings for the Kids Audio Player
 """
 import os
+import tempfile
 
 # Base directory for the application
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Directory for storing MP3 files
-MUSIC_DIR = os.path.join(BASE_DIR, 'static', 'music')
+# Directory for storing MP3 files (the web app, the players and fleet sync
+# all use this one)
+MUSIC_DIR = os.environ.get('MUSIC_DIR', os.path.join(BASE_DIR, 'mp3s'))
 
 # Ensure the music directory exists
-os.makedirs(MUSIC_DIR, exist_ok=True) 
\ No newline at end of file
+os.makedirs(MUSIC_DIR, exist_ok=True)
+
+# Loudness normalization: tracks are analyzed in the background and played
+# back with a gain that brings them to the target loudness
+LOUDNESS_ANALYSIS = os.environ.get('LOUDNESS_ANALYSIS', '1') == '1'
+LOUDNESS_TARGET_LUFS = float(os.environ.get('LOUDNESS_TARGET_LUFS', '-18'))
+LOUDNESS_MAX_GAIN_DB = float(os.environ.get('LOUDNESS_MAX_GAIN_DB', '12'))
+LOUDNESS_NICE = int(os.environ.get('LOUDNESS_NICE', '19'))
+
+# Background jobs (library scans, loudness analysis, database maintenance)
+# run niced in JOBS_THREADS worker threads and up to JOBS_PROCESSES child
+# processes, limited to JOBS_CPU_SHARE of the CPU. Heavy jobs wait while
+# audio plays. Unfinished jobs are resumed after a restart. Only the
+# process holding JOBS_LOCK_FILE runs the scheduler.
+JOBS_ENABLED = os.environ.get('JOBS_ENABLED', '1') == '1'
+JOBS_THREADS = int(os.environ.get('JOBS_THREADS', '1'))
+JOBS_PROCESSES = int(os.environ.get('JOBS_PROCESSES', '1'))
+JOBS_CPU_SHARE = float(os.environ.get('JOBS_CPU_SHARE', '0.5'))
+JOBS_NICE = int(os.environ.get('JOBS_NICE', '19'))
+JOBS_PAUSE_WHILE_PLAYING = os.environ.get('JOBS_PAUSE_WHILE_PLAYING', '1') == '1'
+JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', '3'))
+JOBS_LOCK_FILE = os.environ.get('JOBS_LOCK_FILE', os.path.join(BASE_DIR, 'cache', 'jobs.lock'))
+
+# Scheduling of the decoder (mpg123, aplay, mixer thread), the RFID loop
+# and background work (jobs, transcoding, log writer), see
+# utils/sched_policy.py. Priority: 'rr:N' or 'fifo:N' (real-time, 1-99),
+# 'nice:N' or 'off'. IO: 'realtime:N' or 'best-effort:N' (0 is highest,
+# 7 lowest), 'idle' or 'off'. CPUs: e.g. '3' or '0-2', empty for all.
+# What the process is not allowed to set is skipped (real-time falls back
+# to nice -10 first).
+SCHED_POLICY_ENABLED = os.environ.get('SCHED_POLICY_ENABLED', '1') == '1'
+SCHED_DECODER_PRIORITY = os.environ.get('SCHED_DECODER_PRIORITY', 'rr:20')
+SCHED_DECODER_IO = os.environ.get('SCHED_DECODER_IO', 'best-effort:0')
+SCHED_DECODER_CPUS = os.environ.get('SCHED_DECODER_CPUS', '')
+SCHED_READER_PRIORITY = os.environ.get('SCHED_READER_PRIORITY', 'rr:10')
+SCHED_READER_IO = os.environ.get('SCHED_READER_IO', 'best-effort:0')
+SCHED_READER_CPUS = os.environ.get('SCHED_READER_CPUS', '')
+SCHED_BACKGROUND_PRIORITY = os.environ.get('SCHED_BACKGROUND_PRIORITY', 'off')
+SCHED_BACKGROUND_IO = os.environ.get('SCHED_BACKGROUND_IO', 'idle')
+SCHED_BACKGROUND_CPUS = os.environ.get('SCHED_BACKGROUND_CPUS', '')
+
+# Optional transcoding of heavy or non-MP3 sources into a cache of small MP3s
+TRANSCODE_ENABLED = os.environ.get('TRANSCODE_ENABLED', '0') == '1'
+TRANSCODE_CACHE_DIR = os.environ.get('TRANSCODE_CACHE_DIR', os.path.join(BASE_DIR, 'cache', 'transcode'))
+TRANSCODE_CACHE_MAX_MB = int(os.environ.get('TRANSCODE_CACHE_MAX_MB', '1024'))
+TRANSCODE_BITRATE_KBPS = int(os.environ.get('TRANSCODE_BITRATE_KBPS', '128'))
+TRANSCODE_SAMPLE_RATE = int(os.environ.get('TRANSCODE_SAMPLE_RATE', '44100'))
+TRANSCODE_NICE = int(os.environ.get('TRANSCODE_NICE', '19'))
+
+# Playback engine: 'mpg123' starts one mpg123 process per track, 'mixer'
+# decodes in-process with fades and crossfades (requires NumPy)
+PLAYBACK_ENGINE = os.environ.get('PLAYBACK_ENGINE', 'mpg123')
+AUDIO_DEVICE = os.environ.get('AUDIO_DEVICE', 'hw:0,0')
+FADE_IN_MS = int(os.environ.get('FADE_IN_MS', '300'))
+FADE_OUT_MS = int(os.environ.get('FADE_OUT_MS', '300'))
+CROSSFADE_MS = int(os.environ.get('CROSSFADE_MS', '1000'))
+
+# Synchronized playback on several boxes (utils/multiroom.py): 'off',
+# 'leader' or 'follower'. Followers probe the leader (MULTIROOM_LEADER,
+# host[:port]) over UDP; a tap on the leader starts the track on all boxes
+# MULTIROOM_LEAD_MS later. MULTIROOM_OUTPUT_LATENCY_MS is the audio
+# buffered between the player and the speaker, calibrate it per device.
+MULTIROOM_ROLE = os.environ.get('MULTIROOM_ROLE', 'off')
+MULTIROOM_LEADER = os.environ.get('MULTIROOM_LEADER', '')
+MULTIROOM_PORT = int(os.environ.get('MULTIROOM_PORT', '5005'))
+MULTIROOM_LEAD_MS = int(os.environ.get('MULTIROOM_LEAD_MS', '300'))
+MULTIROOM_OUTPUT_LATENCY_MS = int(os.environ.get('MULTIROOM_OUTPUT_LATENCY_MS', '100'))
+
+# RFID reader backend: 'fast' polls only the UID (needs spidev), 'simple'
+# uses SimpleMFRC522 which reads the data blocks on every poll
+RFID_READER_BACKEND = os.environ.get('RFID_READER_BACKEND', 'fast')
+RFID_SPI_BUS = int(os.environ.get('RFID_SPI_BUS', '0'))
+RFID_SPI_DEVICE = int(os.environ.get('RFID_SPI_DEVICE', '0'))
+
+# Number of consecutive empty polls before a tag counts as removed
+RFID_REMOVAL_MISSES = int(os.environ.get('RFID_REMOVAL_MISSES', '3'))
+
+# Self-describing cards: read the track reference stored on a new card and
+# start playback from it before the database mapping is checked
+RFID_CARD_PAYLOAD = os.environ.get('RFID_CARD_PAYLOAD', '1') == '1'
+
+# Several readers on one Pi, separated by ';' as name=bus:device with an
+# optional audio device per reader, e.g. "corner=0:0@hw:0,0;desk=0:1@hw:1,0".
+# Empty means a single reader handled by RFIDHandler.
+RFID_READERS = os.environ.get('RFID_READERS', '')
+
+# Watchdog (utils/watchdog.py): restarts the reader loop when it gave no
+# sign of life for WATCHDOG_READER_TIMEOUT_MS and a decoder that made no
+# progress for WATCHDOG_DECODER_TIMEOUT_MS. Repeated restarts back off
+# exponentially up to WATCHDOG_BACKOFF_MAX_S.
+WATCHDOG_ENABLED = os.environ.get('WATCHDOG_ENABLED', '1') == '1'
+WATCHDOG_INTERVAL_MS = int(os.environ.get('WATCHDOG_INTERVAL_MS', '100'))
+WATCHDOG_READER_TIMEOUT_MS = int(os.environ.get('WATCHDOG_READER_TIMEOUT_MS', '500'))
+WATCHDOG_DECODER_TIMEOUT_MS = int(os.environ.get('WATCHDOG_DECODER_TIMEOUT_MS', '500'))
+WATCHDOG_BACKOFF_MAX_S = float(os.environ.get('WATCHDOG_BACKOFF_MAX_S', '30'))
+
+# Audio telemetry (utils/audio_telemetry.py): playback whose position falls
+# more than AUDIO_UNDERRUN_MS behind the wall clock counts as an underrun.
+# Tracks and output devices with an underrun or xrun in at least
+# AUDIO_FLAG_PLAYS of their last AUDIO_FLAG_WINDOW plays are flagged.
+AUDIO_UNDERRUN_MS = int(os.environ.get('AUDIO_UNDERRUN_MS', '100'))
+AUDIO_FLAG_PLAYS = int(os.environ.get('AUDIO_FLAG_PLAYS', '3'))
+AUDIO_FLAG_WINDOW = int(os.environ.get('AUDIO_FLAG_WINDOW', '10'))
+
+# Directory for the sockets that notify other processes (e.g. the RFID
+# service) about changed tag mappings
+CHANGE_NOTIFY = os.environ.get('CHANGE_NOTIFY', '1') == '1'
+CHANGE_NOTIFY_DIR = os.environ.get('CHANGE_NOTIFY_DIR', os.path.join(tempfile.gettempdir(), 'kids-audio-player-notify'))
+
+# Tag mappings exported for the headless appliance (appliance.py), which
+# reads this file instead of the database
+MAPPING_EXPORT = os.environ.get('MAPPING_EXPORT', '1') == '1'
+MAPPING_FILE = os.environ.get('MAPPING_FILE', os.path.join(BASE_DIR, 'mappings.json'))
+
+# Budgets checked by tests/test_appliance.py
+APPLIANCE_MAX_RSS_MB = float(os.environ.get('APPLIANCE_MAX_RSS_MB', '40'))
+APPLIANCE_MAX_STARTUP_S = float(os.environ.get('APPLIANCE_MAX_STARTUP_S', '1.5'))
+
+# Logging: records are queued and written by a background thread, the last
+# LOG_RING_SIZE records are kept in memory for /debug/logs
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.environ.get('LOG_FILE') or None
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_RING_SIZE = int(os.environ.get('LOG_RING_SIZE', '1000'))
+
+# Token for the /debug endpoints (disabled if empty)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Fingerprinted, precompressed static assets served under /assets
+ASSET_PIPELINE = os.environ.get('ASSET_PIPELINE', '1') == '1'
+
+# Space the tablets' service worker may use for pinned offline tracks
+SW_AUDIO_QUOTA_MB = int(os.environ.get('SW_AUDIO_QUOTA_MB', '512'))
+
+# Socket.IO events are collected for this long and sent by a background
+# thread; clients that do not acknowledge a state event within the timeout
+# get the next one anyway
+SOCKET_EMIT_WINDOW_MS = int(os.environ.get('SOCKET_EMIT_WINDOW_MS', '50'))
+SOCKET_ACK_TIMEOUT = float(os.environ.get('SOCKET_ACK_TIMEOUT', '1.0'))
+
+# Several processes: one owns the reader and the audio (APP_ROLE=owner),
+# the others only serve HTTP/WebSocket clients (APP_ROLE=web). They talk
+# over a bus of local sockets (EVENT_BUS=socket). With APP_ROLE=all one
+# process does everything and the bus stays in-process.
+APP_ROLE = os.environ.get('APP_ROLE', 'all')
+EVENT_BUS = os.environ.get('EVENT_BUS', 'socket' if APP_ROLE != 'all' else 'inprocess')
+BUS_DIR = os.environ.get('BUS_DIR', os.path.join(tempfile.gettempdir(), 'kids-audio-player-bus'))
+
+# Fleet sync: boxes pull changed files of MUSIC_DIR from a peer or hub
+# over /sync and only transfer the content-defined chunks they lack. The
+# chunk lists are kept in SYNC_INDEX_FILE; SYNC_TOKEN, if set, is required
+# from peers (X-Sync-Token header) and sent when pulling. Serving /sync is
+# off unless SYNC_ENABLED=1.
+SYNC_ENABLED = os.environ.get('SYNC_ENABLED', '0') == '1'
+SYNC_TOKEN = os.environ.get('SYNC_TOKEN', '')
+SYNC_INDEX_FILE = os.environ.get('SYNC_INDEX_FILE', os.path.join(BASE_DIR, 'cache', 'sync-index.json'))
@@ -0,0 +1,162 @@
+"""
+Bulk programming of self-describing RFID cards
+
+A list of tracks is queued, then every new card presented to the reader
+gets the payload of the next track written to it and is registered in
+the database. The content hashes for the payloads are computed in a
+background thread, so queueing returns at once even for large files.
+"""
+import os
+import threading
+import logging
+from controllers.rfid_controller import RFIDController
+from utils.card_payload import encode_payload
+from utils.file_handler import get_file_path, content_hash
+
+logger = logging.getLogger(__name__)
+
+class CardProgrammer:
+    """
+    Queue of tracks waiting to be written to cards
+    """
+    def __init__(self, on_prepared=None):
+        """
+        Args:
+            on_prepared (callable): Called with each item once its payload
+                is ready, or with the item and an 'error' if it failed
+        """
+        self.preparing = []
+        self.pending = []
+        self.programmed = []
+        self.on_prepared = on_prepared
+        self._run = None
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """True while tracks are being prepared or waiting for a card"""
+        return bool(self.pending or self.preparing)
+
+    def start(self, directory, items):
+        """
+        Queue tracks for programming.
+
+        The files are only checked here; their payloads are computed in a
+        background thread and the items move from preparing to pending
+        one by one.
+
+        Args:
+            directory (str): Music directory
+            items (list): Dicts with mp3_filename and optional name
+
+        Returns:
+            list: The queued items, without payloads yet
+
+        Raises:
+            ValueError: If a file is invalid
+            FileNotFoundError: If a file does not exist
+        """
+        queued = []
+        for item in items:
+            filename = item['mp3_filename']
+            path = get_file_path(directory, filename)
+            name = item.get('name') or os.path.splitext(os.path.basename(filename))[0]
+            queued.append({'mp3_filename': filename, 'name': name, 'path': path})
+
+        run = object()
+        with self._lock:
+            self._run = run
+            self.preparing = [self._public(item) for item in queued]
+            self.pending = []
+            self.programmed = []
+        threading.Thread(target=self._prepare, args=(run, queued), daemon=True).start()
+        logger.info(f"Kartenprogrammierung gestartet: {len(queued)} Karten")
+        return [self._public(item) for item in queued]
+
+    @staticmethod
+    def _public(item):
+        """The item without its absolute path"""
+        return {key: value for key, value in item.items() if key != 'path'}
+
+    def _prepare(self, run, queued):
+        """Compute the payloads of the queued items (runs in a background thread)"""
+        for item in queued:
+            prepared = self._public(item)
+            try:
+                prepared['payload'] = encode_payload(content_hash(item['path']), item['mp3_filename'])
+            except OSError as e:
+                logger.error(f"Karte für {item['mp3_filename']} kann nicht vorbereitet werden: {e}")
+                prepared['error'] = str(e)
+
+            with self._lock:
+                if self._run is not run:
+                    return
+                self.preparing.pop(0)
+                if 'payload' in prepared:
+                    self.pending.append(prepared)
+            if self.on_prepared:
+                try:
+                    self.on_prepared(prepared)
+                except Exception as e:
+                    logger.error(f"Fehler im Kartenprogrammierungs-Callback: {e}")
+
+    def cancel(self):
+        """Drop all pending tracks"""
+        with self._lock:
+            self._run = None
+            self.preparing = []
+            self.pending = []
+        logger.info("Kartenprogrammierung abgebrochen")
+
+    def status(self):
+        """Get preparing, pending and programmed tracks"""
+        with self._lock:
+            return {
+                'preparing': list(self.preparing),
+                'pending': list(self.pending),
+                'programmed': list(self.programmed)
+            }
+
+    def program(self, tag_id, write):
+        """
+        Write the next pending payload to the card in the field.
+
+        Must be called within an application context.
+
+        Args:
+            tag_id (str): ID of the card in the field
+            write (callable): Writes text to the card in the field and
+                returns the ID of the written card (or None)
+
+        Returns:
+            dict: The programmed item, or None if nothing was programmed
+        """
+        with self._lock:
+            if not self.pending:
+                if self.preparing:
+                    logger.info(f"Karte {tag_id} nicht programmiert, die Titel werden noch vorbereitet")
+                return None
+            if any(done['tag_id'] == tag_id for done in self.programmed):
+                logger.info(f"Karte {tag_id} wurde bereits programmiert")
+                return None
+            item = self.pending[0]
+
+        written_id = write(item['payload'])
+        if written_id != tag_id:
+            logger.error(f"Karte {tag_id} konnte nicht beschrieben werden")
+            return None
+
+        if not RFIDController.register_tag(tag_id, item['name'], item['mp3_filename']):
+            logger.error(f"Karte {tag_id} beschrieben, aber nicht registriert")
+            return None
+
+        done = dict(item, tag_id=tag_id)
+        with self._lock:
+            if self.pending and self.pending[0] is item:
+                self.pending.pop(0)
+            self.programmed.append(done)
+        logger.info(f"Karte {tag_id} programmiert: {item['mp3_filename']}")
+        return done
+
+# Shared programmer for the routes and the scan loops
+card_programmer = CardProgrammer()
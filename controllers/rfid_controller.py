@@ -8,6 +8,7 @@ from datetime import datetime
 from flask import current_app
 from models import RFIDTag, db
 from utils.rfid_shared import get_rfid_handler
+from utils.generation import TAGS, bump_generation
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +37,7 @@ class RFIDController:
                 existing_tag.name = name
                 existing_tag.mp3_filename = mp3_filename
                 db.session.commit()
+                bump_generation(TAGS, [tag_id])
                 return True
             
             # Create new tag
@@ -47,6 +49,7 @@ class RFIDController:
             
             db.session.add(new_tag)
             db.session.commit()
+            bump_generation(TAGS, [tag_id])
             logger.info(f"Registered RFID tag {tag_id}")
             return True
             
@@ -74,6 +77,7 @@ class RFIDController:
             
             db.session.delete(tag)
             db.session.commit()
+            bump_generation(TAGS, [tag_id])
             logger.info(f"Unregistered RFID tag {tag_id}")
             return True
             
@@ -1,8 +1,28 @@
+import os
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
+# Relative SQLite paths are resolved against the instance folder
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///kids_audio_player.db')
+
 class Base(DeclarativeBase):
     pass
 
 # Create a single instance of SQLAlchemy
-db = SQLAlchemy(model_class=Base)
\ No newline at end of file
+db = SQLAlchemy(model_class=Base)
+
+def create_db_app():
+    """
+    Create a Flask app that only provides the database.
+
+    For processes that read the tags but do not serve the web app (e.g.
+    rfid_service.py); importing app would also start the job scheduler,
+    the watchdog, the bus and the multiroom node.
+    """
+    from flask import Flask
+    from config import BASE_DIR
+    app = Flask('app', root_path=BASE_DIR, instance_path=os.path.join(BASE_DIR, 'instance'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
@@ -13,4 +13,34 @@ class RFIDTag(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
-        return f'<RFIDTag {self.name} ({self.tag_id})>'
\ No newline at end of file
+        return f'<RFIDTag {self.name} ({self.tag_id})>'
+
+class TrackLoudness(db.Model):
+    """Model for the loudness analysis result of a track"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(500), unique=True, nullable=False)
+    file_size = db.Column(db.Integer, nullable=False)
+    file_mtime = db.Column(db.Float, nullable=False)
+    integrated_lufs = db.Column(db.Float, nullable=True)
+    peak_dbfs = db.Column(db.Float, nullable=True)
+    gain_db = db.Column(db.Float, nullable=False, default=0.0)
+    analyzed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<TrackLoudness {self.filename} ({self.gain_db:+.1f} dB)>'
+
+class BackgroundJob(db.Model):
+    """Model for a job of the background scheduler (see utils/jobs.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(100), nullable=False)
+    key = db.Column(db.String(500), nullable=True, index=True)
+    args = db.Column(db.Text, nullable=False, default='{}')
+    priority = db.Column(db.Integer, nullable=False, default=5)
+    state = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.kind} #{self.id} ({self.state})>'
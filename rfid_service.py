@@ -2,17 +2,21 @@
 RFID Service
 
 This module runs the RFID reader service independently from the web application.
+It only sets up the database (db.create_db_app) and does not import app, so
+the web app's scheduler, watchdog, bus and multiroom node are not started.
 """
 import os
 import logging
 import time
-from app import app
+from db import create_db_app
 from utils.rfid_shared import get_rfid_handler
 from utils.player import start_playback, stop_playback
-from models import RFIDTag, Song, db
+from utils.tag_mapping import TagMappingCache
+from utils.change_notify import ChangeSubscriber
+from utils.log_pipeline import setup_logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (queued, written by a background thread)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 def main():
@@ -28,6 +32,12 @@ def main():
             
         logger.info("[INIT] RFID reader initialized successfully")
         
+        # Cache the tag mappings; the web app notifies us about changes
+        tag_cache = TagMappingCache(create_db_app())
+        subscriber = ChangeSubscriber('rfid-service', tag_cache.handle_notification)
+        subscriber.start()
+        tag_cache.reload()
+        
         # Start continuous scanning
         current_tag = None
         
@@ -45,20 +55,15 @@ def main():
                         logger.debug(f"[DEBUG] RFID: Neuer Tag erkannt: {tag_id}")
                         current_tag = tag_id
                         
-                        # Get tag info from database
-                        with app.app_context():
-                            tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
-                            if tag:
-                                # Get the associated song
-                                song = Song.query.get(tag.song_id)
-                                if song:
-                                    # Start playback
-                                    start_playback(song.filename)
-                                    logger.info(f"Playing song: {song.title}")
-                                else:
-                                    logger.error(f"No song found for tag {tag_id}")
-                            else:
-                                logger.debug(f"Tag {tag_id} not registered")
+                        # Look up the tag in the cached mappings
+                        mapping = tag_cache.get(tag_id)
+                        if mapping and mapping[1]:
+                            name, mp3_filename = mapping
+                            # Start playback
+                            start_playback(mp3_filename)
+                            logger.info(f"Playing song: {name}")
+                        else:
+                            logger.debug(f"Tag {tag_id} not registered")
                                 
                 else:
                     # No tag detected
@@ -1,10 +1,18 @@
 """
 API routes for the MP3 player
 """
+import os
 import logging
 import json
+import time
 from datetime import datetime
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, jsonify, current_app, request, send_file
+from models import RFIDTag
+from utils.generation import TAGS, EVENTS, get_generation, bump_generation
+from utils.response_cache import cached_json_response
+from utils.event_bus import BusError
+from utils.file_handler import get_file_path, COVER_EXTENSIONS
+from utils.transcode import resolve_playback_path
 
 logger = logging.getLogger(__name__)
 
@@ -34,21 +42,118 @@ def emit_event(event_type, data):
         "data": data,
         "timestamp": datetime.utcnow().isoformat()
     }
+    bump_generation(EVENTS)
     logger.debug(f"Stored RFID event: {event_type}, data: {data}")
 
 @api_bp.route('/rfid/status')
 def rfid_status():
     """Polling endpoint for RFID tag status"""
-    # Return the latest RFID event
-    if latest_rfid_event["event"] is None:
-        return jsonify({
-            "status": "waiting",
-            "message": "No RFID activity yet"
-        })
+    def build():
+        event = latest_rfid_event
+        # Return the latest RFID event
+        if event["event"] is None:
+            return {
+                "status": "waiting",
+                "message": "No RFID activity yet"
+            }, None
+        
+        return {
+            "status": "active",
+            "event": event["event"],
+            "data": event["data"],
+            "timestamp": event["timestamp"]
+        }, None
+
+    return cached_json_response('rfid-status', EVENTS, get_generation(EVENTS), None, build)
+
+@api_bp.route('/rfid/readers')
+def rfid_readers():
+    """Latency statistics of the readers in the reader pool"""
+    # The reader pool lives in the process that owns the readers
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('rfid.readers'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+
+@api_bp.route('/multiroom')
+def multiroom_status():
+    """Clock offset, followers and drift correction of synchronized playback"""
+    # The multiroom node lives in the process that owns the audio output
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('multiroom.status'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+
+@api_bp.route('/audio')
+def audio_status():
+    """Decoded frames, underruns, xruns and flagged tracks and devices of the audio output"""
+    # Playback runs in the process that owns the audio output
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('audio.telemetry'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+
+def _load_tags():
+    """Load all tags as dictionaries for the search index"""
+    return [{
+        "tag_id": tag.tag_id,
+        "name": tag.name,
+        "mp3_filename": tag.mp3_filename
+    } for tag in RFIDTag.query.all()]
+
+@api_bp.route('/search')
+def search():
+    """Fuzzy search over song titles, artists, albums and tag names"""
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind')
+    if kind not in (None, 'song', 'tag'):
+        return jsonify({"error": f"Invalid kind: {kind}"}), 400
+    
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    
+    try:
+        start = time.perf_counter()
+        library_search = current_app.extensions['library_search']
+        library_search.refresh(get_generation(TAGS), _load_tags)
+        results = [dict(payload, score=score) for score, payload in library_search.search(query, limit=limit, kind=kind)]
+        took_ms = (time.perf_counter() - start) * 1000
+        
+        response = jsonify(results)
+        response.headers['Server-Timing'] = f"search;dur={took_ms:.2f}"
+        return response
+    except Exception as e:
+        logger.error(f"Error searching: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@api_bp.route('/cover/<path:filename>')
+def cover(filename):
+    """Get the cover image of a song (revalidated with its ETag)"""
+    if os.path.splitext(filename)[1].lower() not in COVER_EXTENSIONS:
+        return jsonify({"error": "Not an image"}), 400
+    try:
+        path = get_file_path(current_app.extensions['library'].directory, filename)
+    except ValueError:
+        return jsonify({"error": "Invalid file path"}), 400
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
+
+    response = send_file(path, conditional=True, etag=True, max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@api_bp.route('/play/<path:filename>')
+def play(filename):
+    """Stream a song (a transcoded copy if one is available)"""
+    try:
+        source_path = get_file_path(current_app.extensions['library'].directory, filename)
+    except ValueError:
+        return jsonify({"error": "Invalid file path"}), 400
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
     
-    return jsonify({
-        "status": "active",
-        "event": latest_rfid_event["event"],
-        "data": latest_rfid_event["data"],
-        "timestamp": latest_rfid_event["timestamp"]
-    })
\ No newline at end of file
+    path = resolve_playback_path(source_path)
+    mimetype = 'audio/mpeg' if path.lower().endswith('.mp3') else None
+    return send_file(path, mimetype=mimetype, conditional=True, max_age=3600)
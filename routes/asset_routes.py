@@ -0,0 +1,42 @@
+"""
+Routes for fingerprinted static assets
+"""
+import logging
+from flask import Blueprint, Response, current_app, request, jsonify, abort
+from utils.http_cache import choose_encoding
+
+logger = logging.getLogger(__name__)
+
+# Create blueprint
+assets_bp = Blueprint('assets', __name__, url_prefix='/assets')
+
+# The URL changes with the content, so clients may keep assets forever
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+@assets_bp.route('/<path:name>')
+def get_asset(name):
+    """Serve a fingerprinted asset, compressed if the client supports it"""
+    pipeline = current_app.extensions.get('assets')
+    asset = pipeline.get(name) if pipeline else None
+    if asset is None:
+        abort(404)
+
+    if request.if_none_match.contains(asset.digest):
+        response = Response(status=304)
+    else:
+        encoding = choose_encoding()
+        if encoding not in asset.bodies:
+            encoding = None
+        response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(asset.digest)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@assets_bp.route('/manifest.json')
+def get_manifest():
+    """Logical asset names and their current URLs"""
+    pipeline = current_app.extensions.get('assets')
+    return jsonify(pipeline.manifest() if pipeline else {})
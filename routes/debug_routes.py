@@ -0,0 +1,146 @@
+"""
+Debug endpoints, only available with the admin token
+"""
+import hmac
+import logging
+from functools import wraps
+from flask import Blueprint, request, jsonify, Response, current_app
+from config import ADMIN_TOKEN
+from utils.log_pipeline import get_pipeline
+from utils.profiler import sample_stacks, format_collapsed, thread_dump, ProfilerBusy
+from utils.response_cache import response_cache
+from utils.event_bus import BusError
+
+logger = logging.getLogger(__name__)
+
+# Create blueprint
+debug_bp = Blueprint('debug', __name__, url_prefix='/debug')
+
+def admin_required(view):
+    """Require the admin token in the X-Admin-Token header or the token parameter"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Debug endpoints are disabled (ADMIN_TOKEN not set)"}), 404
+        token = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+        if not hmac.compare_digest(token, ADMIN_TOKEN):
+            logger.warning(f"Unauthorized debug request from {request.remote_addr}")
+            return jsonify({"error": "Unauthorized"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@debug_bp.route('/logs')
+@admin_required
+def get_logs():
+    """
+    Get the newest log records from memory.
+
+    Query parameters: limit (default 100), level (e.g. WARNING) and since
+    (sequence number of the last record already seen).
+    """
+    pipeline = get_pipeline()
+    if not pipeline:
+        return jsonify({"error": "Logging pipeline not running"}), 503
+
+    try:
+        limit = min(int(request.args.get('limit', 100)), pipeline.ring.records.maxlen)
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "limit and since must be numbers"}), 400
+    level = logging.getLevelName(request.args.get('level', 'NOTSET').upper())
+    if not isinstance(level, int):
+        return jsonify({"error": "Unknown level"}), 400
+
+    return jsonify({
+        "records": pipeline.ring.get_records(limit, level, since),
+        "dropped": pipeline.queue_handler.dropped
+    })
+
+@debug_bp.route('/profile')
+@admin_required
+def profile():
+    """
+    Sample the stacks of all threads for some seconds.
+
+    Query parameters: seconds (default 5, max 60), interval_ms (default 10)
+    and format ('collapsed' for flamegraph.pl/speedscope, or 'json').
+    """
+    try:
+        seconds = float(request.args.get('seconds', 5))
+        interval = float(request.args.get('interval_ms', 10)) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+        return jsonify({"error": "seconds must be 0-60, interval_ms 1-1000"}), 400
+
+    logger.info(f"Profiling all threads for {seconds} s")
+    try:
+        stacks, samples = sample_stacks(seconds, interval)
+    except ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+
+    if request.args.get('format') == 'json':
+        return jsonify({
+            "samples": samples,
+            "stacks": [{"stack": stack.split(';'), "count": count} for stack, count in stacks.most_common()]
+        })
+    return Response(format_collapsed(stacks), mimetype='text/plain')
+
+@debug_bp.route('/threads')
+@admin_required
+def threads():
+    """Live thread dump with the CPU time of each thread"""
+    return jsonify(thread_dump())
+
+@debug_bp.route('/cache')
+@admin_required
+def cache_stats():
+    """Size and hit rate of the response cache"""
+    return jsonify(response_cache.stats())
+
+@debug_bp.route('/sockets')
+@admin_required
+def socket_stats():
+    """Queued, coalesced and dropped Socket.IO events per client"""
+    emitter = current_app.extensions.get('event_emitter')
+    if not emitter:
+        return jsonify({"error": "Event emitter not running"}), 503
+    return jsonify({"totals": emitter.stats, "clients": emitter.client_stats()})
+
+@debug_bp.route('/jobs')
+@admin_required
+def job_stats():
+    """Queued and running background jobs"""
+    # The scheduler runs in the process that owns the reader
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('jobs.status'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+
+@debug_bp.route('/watchdog')
+@admin_required
+def watchdog_status():
+    """Health, restarts and recovery times of the watched components"""
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('watchdog.status'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+
+@debug_bp.route('/metrics')
+@admin_required
+def metrics_text():
+    """Metrics of the reader process in the Prometheus text format"""
+    try:
+        text = current_app.extensions['event_bus'].request('metrics')
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@debug_bp.route('/scheduling')
+@admin_required
+def scheduling_status():
+    """Configured scheduling roles and the threads and processes they were applied to"""
+    try:
+        return jsonify(current_app.extensions['event_bus'].request('sched.status'))
+    except BusError as e:
+        return jsonify({"error": str(e)}), 503
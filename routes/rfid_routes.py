@@ -2,10 +2,14 @@
 Routes for RFID tag management
 """
 import logging
-from flask import Blueprint, request, jsonify, render_template, redirect, url_for, flash
+from flask import Blueprint, request, jsonify, render_template, redirect, url_for, flash, current_app
 from controllers.rfid_controller import RFIDController
 from models import RFIDTag, db
-from utils.rfid_shared import get_rfid_handler
+from utils.generation import TAGS, get_generation, bump_generation
+from utils.pagination import paginate
+from utils.http_cache import page_headers
+from utils.response_cache import cached_json_response
+from utils.event_bus import BusError
 import os
 
 logger = logging.getLogger(__name__)
@@ -16,15 +20,8 @@ rfid_bp = Blueprint('rfid', __name__, url_prefix='/rfid')
 @rfid_bp.route('/')
 def rfid_management():
     """RFID tag management page"""
-    # Get all available MP3 files from the music directory
-    from utils.file_handler import get_mp3_files
-    from config import MUSIC_DIR
-    
-    # Get all tags and MP3 files for the template
-    tags = RFIDController.get_all_tags()
-    mp3_files = get_mp3_files(MUSIC_DIR)
-    
-    return render_template('rfid_management.html', tags=tags, mp3_files=mp3_files)
+    # Tags and MP3 files are loaded page by page from the JSON endpoints
+    return render_template('rfid_management.html')
 
 @rfid_bp.route('/rfid/register', methods=['POST'])
 def register_rfid():
@@ -52,6 +49,7 @@ def register_rfid():
         
         db.session.add(new_tag)
         db.session.commit()
+        bump_generation(TAGS, [tag_id])
         
         return jsonify({
             'message': 'Tag registered successfully',
@@ -86,24 +84,19 @@ def unregister_tag(tag_id):
     flash('RFID-Tag erfolgreich entfernt', 'success')
     return redirect(url_for('rfid.rfid_management'))
 
+def owner_request(topic, data=None):
+    """Send a request to the process that owns the reader (may be this one)"""
+    return current_app.extensions['event_bus'].request(topic, data)
+
 @rfid_bp.route('/scan', methods=['GET'])
 def scan_rfid():
     """Scan for an RFID tag"""
     try:
-        # Get the shared RFID handler
-        rfid_handler = get_rfid_handler()
-        
-        if not rfid_handler:
-            logger.error("RFID handler not initialized")
-            return jsonify({"error": "RFID handler not initialized"}), 500
-            
-        # Try to read a tag once
-        tag_id, text = rfid_handler.read_once()
+        # Try to read a tag once (including the text stored on it)
+        result = owner_request('rfid.scan')
+        tag_id, text = result['tag_id'], result['text']
         
         if tag_id:
-            # Convert tag_id to string for consistency
-            tag_id = str(tag_id)
-            
             # Check if tag is already registered
             existing_tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
             
@@ -128,6 +121,43 @@ def scan_rfid():
         logger.error(f"Error scanning RFID tag: {e}")
         return jsonify({"error": str(e)}), 500
 
+def program_response(data):
+    """Forward a card programming request to the reader process"""
+    try:
+        result = owner_request('rfid.program', data)
+    except BusError as e:
+        logger.error(f"Card programming request failed: {e}")
+        return jsonify({'error': str(e)}), 503
+    return jsonify(result), result.pop('status', 200)
+
+@rfid_bp.route('/program', methods=['GET'])
+def program_status():
+    """Get the state of the bulk card programming"""
+    return program_response({'action': 'status'})
+
+@rfid_bp.route('/program', methods=['POST'])
+def program_cards():
+    """
+    Start bulk programming of self-describing cards.
+
+    Expects JSON with a list of items ({"mp3_filename": ..., "name": ...}).
+    Every new card presented to the reader gets the next track written to
+    it and is registered. Returns at once, the payloads are prepared in
+    the background.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items or not all(
+            isinstance(item, dict) and item.get('mp3_filename') for item in items):
+        return jsonify({'error': 'items with mp3_filename required'}), 400
+
+    return program_response({'action': 'start', 'items': items})
+
+@rfid_bp.route('/program', methods=['DELETE'])
+def cancel_programming():
+    """Cancel the bulk card programming"""
+    return program_response({'action': 'cancel'})
+
 @rfid_bp.route('/simulate', methods=['POST'])
 def simulate_tag():
     """Simulate an RFID tag for testing (only works in simulation mode)"""
@@ -270,16 +300,32 @@ def test_rfid_read():
 
 @rfid_bp.route('/rfid/tags', methods=['GET'])
 def get_tags():
-    """Get all registered RFID tags"""
+    """Get registered RFID tags (supports q, prefix, sort, limit and cursor)"""
     try:
-        tags = RFIDTag.query.all()
-        return jsonify([{
-            "id": tag.id,
-            "tag_id": tag.tag_id,
-            "name": tag.name,
-            "mp3_filename": tag.mp3_filename
-        } for tag in tags])
+        generation = get_generation(TAGS)
+
+        def build():
+            tags = [{
+                "id": tag.id,
+                "tag_id": tag.tag_id,
+                "name": tag.name,
+                "mp3_filename": tag.mp3_filename
+            } for tag in RFIDTag.query.all()]
+
+            tags, next_cursor, total = paginate(
+                tags,
+                request.args,
+                sort_keys=('id', 'name', 'tag_id', 'mp3_filename'),
+                search_fields=('name', 'tag_id', 'mp3_filename'),
+                id_key='id',
+                default_sort='name'
+            )
+            return tags, page_headers(next_cursor, total, generation)
+
+        return cached_json_response('tags', TAGS, generation, request.args, build)
         
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting RFID tags: {e}")
         return jsonify({"error": str(e)}), 500
@@ -294,6 +340,7 @@ def delete_tag(tag_id):
             
         db.session.delete(tag)
         db.session.commit()
+        bump_generation(TAGS, [tag.tag_id])
         
         return jsonify({"message": "Tag deleted successfully"})
         
@@ -0,0 +1,72 @@
+"""
+Routes other boxes pull the music library from (see utils/fleet_sync.py)
+"""
+import hmac
+import logging
+from functools import wraps
+from flask import Blueprint, Response, request, jsonify, current_app
+from config import SYNC_TOKEN
+from utils.fleet_sync import MAX_BATCH_BYTES
+from utils.http_cache import json_response, is_not_modified, not_modified_response
+
+logger = logging.getLogger(__name__)
+
+# Create blueprint
+sync_bp = Blueprint('sync', __name__, url_prefix='/sync')
+
+def sync_token_required(view):
+    """Require SYNC_TOKEN in the X-Sync-Token header if it is set"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if SYNC_TOKEN:
+            token = request.headers.get('X-Sync-Token', '')
+            if not hmac.compare_digest(token, SYNC_TOKEN):
+                logger.warning(f"Unauthorized sync request from {request.remote_addr}")
+                return jsonify({"error": "Unauthorized"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@sync_bp.route('/manifest')
+@sync_token_required
+def get_manifest():
+    """Files of the music directory with their chunk hashes (built in the background)"""
+    manifest = current_app.extensions['sync_index'].current()
+    if manifest is None:
+        response = jsonify({"error": "Manifest is being built"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    etag = f"sync-{manifest['digest']}"
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+    return json_response(manifest, etag=etag)
+
+@sync_bp.route('/chunks', methods=['POST'])
+@sync_token_required
+def get_chunks():
+    """
+    Get the data of several chunks in one response.
+
+    Expects JSON {"chunks": [hash, ...]}. The body is the data of the
+    chunks in the order of the X-Chunks header, which lists the chunks
+    that were found; the caller knows their sizes from the manifest.
+    """
+    hashes = (request.get_json(silent=True) or {}).get('chunks')
+    if not isinstance(hashes, list):
+        return jsonify({"error": "chunks missing"}), 400
+
+    index = current_app.extensions['sync_index']
+    sent, parts, total = [], [], 0
+    for chunk_hash in hashes:
+        data = index.read_chunk(str(chunk_hash))
+        if data is None:
+            continue
+        if parts and total + len(data) > MAX_BATCH_BYTES:
+            break
+        sent.append(chunk_hash)
+        parts.append(data)
+        total += len(data)
+
+    response = Response(b''.join(parts), mimetype='application/octet-stream')
+    response.headers['X-Chunks'] = ','.join(sent)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,201 @@
+"""
+Run the Kids Audio Player as several processes
+
+One process owns the RFID reader and the audio output (APP_ROLE=owner),
+the others only serve HTTP and WebSocket clients (APP_ROLE=web). All of
+them talk over the local socket bus (utils/event_bus.py). Each process
+listens on its own port, starting at --port with the owner; put a proxy
+with sticky sessions in front of them (e.g. nginx with ip_hash), since
+Socket.IO long-polling needs all requests of a client on one process.
+
+    python serve.py --workers 4                 # owner on 5000, web on 5001-5003
+    python serve.py --loadtest 1,2,4 --seconds 5  # throughput per worker count
+
+The load test starts the given numbers of workers in simulation mode,
+runs client processes against them and prints requests per second. It
+also checks that an event from the owner reaches every worker.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import tempfile
+import subprocess
+import http.client
+import multiprocessing
+
+def run_worker(role, port):
+    """Run one process of the deployment"""
+    os.environ['APP_ROLE'] = role
+    import app as application
+    from config import LOG_LEVEL
+
+    # Werkzeug logs every request at INFO, follow the configured level
+    logging.getLogger('werkzeug').setLevel(LOG_LEVEL)
+
+    if role == 'owner':
+        if application.reader_pool:
+            application.reader_pool.start()
+        elif application.rfid_handler:
+            application.rfid_handler.start()
+    application.socketio.run(application.app, host='0.0.0.0', port=port,
+                             debug=False, use_reloader=False, allow_unsafe_werkzeug=True)
+
+def start_workers(count, port, env=None):
+    """
+    Start an owner and count - 1 web workers.
+
+    Returns:
+        list: (Popen, port) per process, the owner first
+    """
+    processes = []
+    for index in range(count):
+        role = 'owner' if index == 0 else 'web'
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', role, '--port', str(port + index)],
+            env=dict(os.environ, **(env or {}), APP_ROLE=role, EVENT_BUS='socket')
+        )
+        processes.append((process, port + index))
+    return processes
+
+def stop_workers(processes):
+    for process, _ in processes:
+        process.send_signal(signal.SIGTERM)
+    for process, _ in processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def get_json(port, path, timeout=2.0):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    finally:
+        connection.close()
+
+def wait_ready(processes, timeout=60):
+    """Wait until every process answers HTTP requests"""
+    deadline = time.monotonic() + timeout
+    for process, port in processes:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Worker on port {port} exited with {process.returncode}")
+            try:
+                if get_json(port, '/api/rfid/status')[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Worker on port {port} did not start")
+            time.sleep(0.2)
+
+def _client(args):
+    """Send requests to one port for some seconds, return the number of answers"""
+    port, path, seconds = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    count = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                count += 1
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.close()
+    return count
+
+def check_event_propagation(processes, timeout=10):
+    """
+    Let the owner see a simulated tag and wait until all workers know.
+
+    Returns:
+        float: Seconds until the last worker reported the event, None on timeout
+    """
+    tag_id = f"loadtest-{os.getpid()}"
+    started = time.monotonic()
+    with open('/tmp/rfid_simulation.txt', 'w') as f:
+        f.write(tag_id)
+    time.sleep(0.5)
+    with open('/tmp/rfid_simulation.txt', 'w') as f:
+        f.write('No tag')
+
+    pending = {port for _, port in processes}
+    while pending and time.monotonic() - started < timeout:
+        for port in list(pending):
+            status, data = get_json(port, '/api/rfid/status')
+            if status == 200 and data.get('event') == 'tag_removed':
+                pending.discard(port)
+        time.sleep(0.05)
+    return None if pending else time.monotonic() - started
+
+def loadtest(worker_counts, seconds, clients, port, path):
+    """Measure the throughput for each number of workers"""
+    directory = tempfile.mkdtemp(prefix='kap-loadtest-')
+    env = {
+        'RFID_SIMULATION': '1',
+        'LOUDNESS_ANALYSIS': '0',
+        'MAPPING_EXPORT': '0',
+        'LOG_LEVEL': 'WARNING',
+        'BUS_DIR': os.path.join(directory, 'bus'),
+        'CHANGE_NOTIFY_DIR': os.path.join(directory, 'notify')
+    }
+    print(f"{os.cpu_count()} CPU cores, {clients} client processes, {seconds} s per run, GET {path}")
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'event to all workers':>22}")
+
+    baseline = None
+    for count in worker_counts:
+        processes = start_workers(count, port, env)
+        try:
+            wait_ready(processes)
+            latency = check_event_propagation(processes)
+            ports = [p for _, p in processes]
+            with multiprocessing.Pool(clients) as pool:
+                started = time.monotonic()
+                total = sum(pool.map(_client, [(ports[i % count], path, seconds) for i in range(clients)]))
+                elapsed = time.monotonic() - started
+        finally:
+            stop_workers(processes)
+
+        rate = total / elapsed
+        baseline = baseline or rate
+        event = f"{latency * 1000:.0f} ms" if latency is not None else 'not received'
+        print(f"{count:>8} {rate:>10.0f} {rate / baseline:>7.2f}x {event:>22}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Kids Audio Player as several processes")
+    parser.add_argument('--workers', type=int, default=2, help="number of processes (including the owner)")
+    parser.add_argument('--port', type=int, default=5000, help="port of the owner, web workers follow")
+    parser.add_argument('--loadtest', help="comma-separated worker counts to measure, e.g. 1,2,4")
+    parser.add_argument('--seconds', type=float, default=5, help="duration of each load test run")
+    parser.add_argument('--clients', type=int, default=8, help="client processes of the load test")
+    parser.add_argument('--path', default='/api/songs?limit=50', help="URL requested by the load test")
+    parser.add_argument('--worker', choices=('owner', 'web'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.port)
+    elif args.loadtest:
+        loadtest([int(n) for n in args.loadtest.split(',')], args.seconds, args.clients, args.port, args.path)
+    else:
+        processes = start_workers(args.workers, args.port)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            while all(process.poll() is None for process, _ in processes):
+                time.sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            stop_workers(processes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+// Page for registering tags (templates/index.html)
+let currentTagId = null;
+const socket = io();
+
+// Handle WebSocket events (state events are acknowledged,
+// the server only sends the next state after the ack)
+socket.on("connect", () => {
+    console.log("Connected to server");
+});
+
+socket.on("tag_detected", (data, ack) => {
+    if (ack) ack();
+    console.log("Tag detected:", data);
+    currentTagId = data.tag_id;
+    updateStatus(`Tag erkannt: ${data.tag_id}`);
+    document.getElementById("registration-form").style.display = "block";
+});
+
+socket.on("tag_removed", (data, ack) => {
+    if (ack) ack();
+    console.log("Tag removed:", data);
+    currentTagId = null;
+    updateStatus("Kein Tag erkannt");
+    document.getElementById("registration-form").style.display = "none";
+    document.getElementById("now-playing").style.display = "none";
+});
+
+socket.on("song_playing", (data, ack) => {
+    if (ack) ack();
+    document.getElementById("now-playing").style.display = "block";
+    document.getElementById("current-song").textContent = data.title;
+});
+
+function updateStatus(message) {
+    document.getElementById("status").textContent = message;
+}
+
+// Library state: our copy of the song list and its generation,
+// for fetching only the changes
+let songs = [];
+let libraryGeneration = null;
+let libraryEpoch = null;
+
+// MP3 list state: only the rows in view (plus some overscan) are in the DOM,
+// padding on the item container stands in for the others
+const OVERSCAN_ROWS = 5;
+const mp3List = document.getElementById("mp3-list");
+const mp3Items = document.getElementById("mp3-items");
+let rowHeight = 0;
+let renderedRange = null;
+let renderScheduled = false;
+
+// Load available MP3s
+function loadMP3s() {
+    return fetch("/api/songs")
+        .then((response) => {
+            libraryGeneration = response.headers.get("X-Generation");
+            libraryEpoch = response.headers.get("X-Epoch");
+            return response.json();
+        })
+        .then((list) => {
+            songs = list;
+            displaySongs();
+        })
+        .catch((error) => console.error("Error loading MP3s:", error));
+}
+
+// Fetch only the songs that changed since our copy and patch the list
+function loadSongChanges() {
+    if (libraryGeneration === null || document.hidden) return;
+    const params = new URLSearchParams({ since: libraryGeneration, epoch: libraryEpoch });
+    fetch("/api/songs/changes?" + params)
+        .then((response) => (response.ok ? response.json() : null))
+        .then((changes) => {
+            if (!changes) return;
+            if (changes.reset) return loadMP3s();
+            if (changes.upserts.length || changes.removed.length) {
+                applySongChanges(changes.upserts, changes.removed);
+            }
+            libraryGeneration = changes.generation;
+            libraryEpoch = changes.epoch;
+        })
+        .catch((error) => console.error("Error loading song changes:", error));
+}
+
+// Patch the song list with changed and removed songs
+function applySongChanges(upserts, removed) {
+    const removedSet = new Set(removed);
+    const changed = new Map(upserts.map((song) => [song.filename, song]));
+    songs = songs
+        .filter((song) => !removedSet.has(song.filename))
+        .map((song) => {
+            const update = changed.get(song.filename);
+            changed.delete(song.filename);
+            return update || song;
+        });
+    // New songs go to the end, like in the server's scan order
+    songs.push(...changed.values());
+    displaySongs();
+}
+
+// Fill the select and redraw the list after the songs changed
+function displaySongs() {
+    const select = document.getElementById("mp3-select");
+    const selected = select.value;
+    const options = document.createDocumentFragment();
+    const empty = document.createElement("option");
+    empty.value = "";
+    empty.textContent = "MP3 auswählen";
+    options.appendChild(empty);
+    songs.forEach((song) => {
+        const option = document.createElement("option");
+        option.value = song.filename;
+        option.textContent = song.title;
+        options.appendChild(option);
+    });
+    select.replaceChildren(options);
+    select.value = selected;
+
+    renderedRange = null;
+    renderVisibleSongs();
+}
+
+// Render the rows of the MP3 list that are in view
+function renderVisibleSongs() {
+    renderScheduled = false;
+    if (songs.length === 0) {
+        mp3Items.replaceChildren();
+        mp3Items.style.padding = "";
+        return;
+    }
+
+    if (!rowHeight) {
+        // Render one row first to measure its height
+        mp3Items.replaceChildren(createSongItem(songs[0]));
+        rowHeight = mp3Items.firstChild.offsetHeight;
+        if (!rowHeight) return;
+    }
+
+    const listTop = mp3Items.getBoundingClientRect().top - mp3List.getBoundingClientRect().top + mp3List.scrollTop;
+    const scrollTop = Math.max(0, mp3List.scrollTop - listTop);
+    const start = Math.max(0, Math.floor(scrollTop / rowHeight) - OVERSCAN_ROWS);
+    const end = Math.min(songs.length, start + Math.ceil(mp3List.clientHeight / rowHeight) + 2 * OVERSCAN_ROWS);
+    if (renderedRange && renderedRange.start === start && renderedRange.end === end) return;
+    renderedRange = { start, end };
+
+    const rows = document.createDocumentFragment();
+    for (let index = start; index < end; index++) {
+        rows.appendChild(createSongItem(songs[index]));
+    }
+    mp3Items.style.paddingTop = `${start * rowHeight}px`;
+    mp3Items.style.paddingBottom = `${(songs.length - end) * rowHeight}px`;
+    mp3Items.replaceChildren(rows);
+}
+
+function createSongItem(song) {
+    const item = document.createElement("div");
+    item.className = "mp3-item";
+    item.textContent = song.title;
+    item.dataset.filename = song.filename;
+    return item;
+}
+
+function scheduleRender() {
+    if (!renderScheduled) {
+        renderScheduled = true;
+        requestAnimationFrame(renderVisibleSongs);
+    }
+}
+
+mp3List.addEventListener("scroll", scheduleRender, { passive: true });
+
+// One click handler for all rows
+mp3Items.addEventListener("click", (event) => {
+    const item = event.target.closest(".mp3-item");
+    if (item) document.getElementById("mp3-select").value = item.dataset.filename;
+});
+
+function registerTag() {
+    if (!currentTagId) {
+        alert("Bitte warten Sie, bis ein Tag erkannt wird!");
+        return;
+    }
+
+    const name = document.getElementById("tag-name").value.trim();
+    const mp3 = document.getElementById("mp3-select").value;
+
+    if (!name || !mp3) {
+        alert("Bitte Name und MP3 auswählen!");
+        return;
+    }
+
+    fetch("/rfid/register", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+            tag_id: currentTagId,
+            name: name,
+            mp3_filename: mp3,
+        }),
+    })
+        .then((response) => {
+            if (!response.ok) {
+                return response.json().then((data) => {
+                    throw new Error(data.error || "Fehler bei der Registrierung");
+                });
+            }
+            return response.json();
+        })
+        .then((data) => {
+            alert("Tag erfolgreich registriert!");
+            document.getElementById("registration-form").style.display = "none";
+            document.getElementById("tag-name").value = "";
+            document.getElementById("mp3-select").value = "";
+        })
+        .catch((error) => {
+            console.error("Error:", error);
+            alert(`Fehler: ${error.message}`);
+        });
+}
+
+// Load MP3s when page loads and pick up library changes afterwards
+loadMP3s();
+setInterval(loadSongChanges, 15000);
+
+// Cache the library and covers for flaky Wi-Fi
+if ("serviceWorker" in navigator) {
+    navigator.serviceWorker
+        .register("/sw.js")
+        .catch((error) => console.error("Service worker not available:", error));
+}
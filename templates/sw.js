@@ -0,0 +1,250 @@
+// Service worker of the Kids Audio Player
+//
+// Keeps the pages, the library lists and the covers in Cache Storage and
+// revalidates them with their ETags, so an unchanged library costs only a
+// 304. When the network is gone the cached copies are served. Tracks the
+// user pinned are stored completely and played from the cache, the least
+// recently played ones are evicted when the audio quota is exceeded.
+
+const CACHE_VERSION = 'v1';
+const PAGE_CACHE = `kap-pages-${CACHE_VERSION}`;
+const ASSET_CACHE = `kap-assets-${CACHE_VERSION}`;
+const DATA_CACHE = `kap-data-${CACHE_VERSION}`;
+const COVER_CACHE = `kap-covers-${CACHE_VERSION}`;
+const AUDIO_CACHE = `kap-audio-${CACHE_VERSION}`;
+const CACHES = [PAGE_CACHE, ASSET_CACHE, DATA_CACHE, COVER_CACHE, AUDIO_CACHE];
+
+// Maximum size of the pinned tracks in bytes
+const AUDIO_QUOTA_BYTES = {{ audio_quota_bytes }};
+
+// Key of the pinned track index (url -> {size, lastUsed}) in the audio cache
+const AUDIO_INDEX_KEY = '/__sw/audio-index';
+
+const PAGES = ['/', '/rfid/'];
+
+self.addEventListener('install', event => {
+    event.waitUntil((async () => {
+        const pages = await caches.open(PAGE_CACHE);
+        await Promise.all(PAGES.map(url => pages.add(url).catch(() => null)));
+
+        // Fingerprinted assets never change, cache the current ones up front
+        try {
+            const manifest = await (await fetch('/assets/manifest.json')).json();
+            const assets = await caches.open(ASSET_CACHE);
+            await assets.addAll(Object.values(manifest));
+        } catch (error) {
+            console.warn('Assets not cached:', error);
+        }
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names
+            .filter(name => name.startsWith('kap-') && !CACHES.includes(name))
+            .map(name => caches.delete(name)));
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (url.pathname.startsWith('/assets/')) {
+        event.respondWith(cacheFirst(request, ASSET_CACHE));
+    } else if (url.pathname.startsWith('/api/play/')) {
+        event.respondWith(playAudio(request, url));
+    } else if (url.pathname.startsWith('/api/cover/')) {
+        event.respondWith(revalidate(request, COVER_CACHE, true));
+    } else if (url.pathname === '/api/songs' || url.pathname === '/rfid/rfid/tags') {
+        event.respondWith(revalidate(request, DATA_CACHE, false));
+    } else if (request.mode === 'navigate' || PAGES.includes(url.pathname)) {
+        event.respondWith(revalidate(request, PAGE_CACHE, false));
+    }
+});
+
+// Immutable responses: the cached copy is always right
+async function cacheFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    if (response.ok) await cache.put(request, response.clone());
+    return response;
+}
+
+// Ask the server whether the cached copy is still current (ETag), fall
+// back to the cached copy when the network is down. With stale set, the
+// cached copy is answered right away and revalidated in the background.
+async function revalidate(request, cacheName, stale) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+
+    const update = (async () => {
+        const headers = new Headers(request.headers);
+        const etag = cached && cached.headers.get('ETag');
+        if (etag) headers.set('If-None-Match', etag);
+        const response = await fetch(request.url, { headers, credentials: 'same-origin', cache: 'no-store' });
+        if (response.status === 304 && cached) return cached;
+        if (response.ok) await cache.put(request, response.clone());
+        return response;
+    })();
+
+    if (stale && cached) {
+        update.catch(() => null);
+        return cached;
+    }
+    try {
+        return await update;
+    } catch (error) {
+        if (cached) return cached;
+        if (request.mode === 'navigate') {
+            const page = await caches.match('/', { cacheName: PAGE_CACHE });
+            if (page) return page;
+        }
+        throw error;
+    }
+}
+
+// Play pinned tracks from the cache, everything else from the network
+async function playAudio(request, url) {
+    const key = url.pathname;
+    const cache = await caches.open(AUDIO_CACHE);
+    const cached = await cache.match(key);
+    if (!cached) return fetch(request);
+
+    touchAudio(key);
+    return rangeResponse(request, cached);
+}
+
+// Answer a Range request (sent by <audio>) from a complete cached response.
+// Blob slices refer to the cached body, so a seek in an audiobook does not
+// copy the whole track into memory.
+async function rangeResponse(request, response) {
+    const range = request.headers.get('Range');
+    if (!range) return response;
+
+    const blob = await response.blob();
+    const size = blob.size;
+    const match = /^bytes=(\d*)-(\d*)$/.exec(range.trim());
+    let start, end;
+    if (match && match[1]) {
+        start = parseInt(match[1], 10);
+        end = match[2] ? Math.min(parseInt(match[2], 10), size - 1) : size - 1;
+    } else if (match && match[2]) {
+        start = Math.max(0, size - parseInt(match[2], 10));
+        end = size - 1;
+    }
+    if (start === undefined || start > end || start >= size) {
+        return new Response(null, { status: 416, headers: { 'Content-Range': `bytes */${size}` } });
+    }
+
+    return new Response(blob.slice(start, end + 1), {
+        status: 206,
+        headers: {
+            'Content-Type': response.headers.get('Content-Type') || 'audio/mpeg',
+            'Content-Length': String(end - start + 1),
+            'Content-Range': `bytes ${start}-${end}/${size}`,
+            'Accept-Ranges': 'bytes'
+        }
+    });
+}
+
+// Updates of the pinned track index run one after the other
+let indexQueue = Promise.resolve();
+
+function updateAudioIndex(change) {
+    const result = indexQueue.then(async () => {
+        const cache = await caches.open(AUDIO_CACHE);
+        const stored = await cache.match(AUDIO_INDEX_KEY);
+        const index = stored ? await stored.json() : {};
+        const value = await change(index, cache);
+        await cache.put(AUDIO_INDEX_KEY, new Response(JSON.stringify(index),
+            { headers: { 'Content-Type': 'application/json' } }));
+        return value;
+    });
+    indexQueue = result.catch(() => null);
+    return result;
+}
+
+function touchAudio(key) {
+    updateAudioIndex(index => {
+        if (index[key]) index[key].lastUsed = Date.now();
+    }).catch(() => null);
+}
+
+// Remove the least recently played tracks until the pinned tracks fit
+async function evictAudio(index, cache, keep) {
+    let total = Object.values(index).reduce((sum, entry) => sum + entry.size, 0);
+    const oldest = Object.keys(index)
+        .filter(key => key !== keep)
+        .sort((a, b) => index[a].lastUsed - index[b].lastUsed);
+    const evicted = [];
+    while (total > AUDIO_QUOTA_BYTES && oldest.length) {
+        const key = oldest.shift();
+        total -= index[key].size;
+        delete index[key];
+        await cache.delete(key);
+        evicted.push(filenameOf(key));
+    }
+    return evicted;
+}
+
+async function pinAudio(key) {
+    const response = await fetch(key, { cache: 'no-store' });
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    const body = await response.blob();
+    if (body.size > AUDIO_QUOTA_BYTES) throw new Error('Track is larger than the audio quota');
+
+    return updateAudioIndex(async (index, cache) => {
+        await cache.put(key, new Response(body, {
+            headers: { 'Content-Type': response.headers.get('Content-Type') || 'audio/mpeg' }
+        }));
+        index[key] = { size: body.size, lastUsed: Date.now() };
+        return evictAudio(index, cache, key);
+    });
+}
+
+function unpinAudio(key) {
+    return updateAudioIndex(async (index, cache) => {
+        delete index[key];
+        await cache.delete(key);
+    });
+}
+
+function audioKey(filename) {
+    return `/api/play/${encodeURIComponent(filename)}`;
+}
+
+function filenameOf(key) {
+    return decodeURIComponent(key.slice('/api/play/'.length));
+}
+
+// Messages from the page: {type: 'pin' | 'unpin' | 'pinned', filename}
+// The answer goes to the port of the MessageChannel the page passed
+self.addEventListener('message', event => {
+    const message = event.data || {};
+    const port = event.ports[0];
+    const reply = data => port && port.postMessage(data);
+
+    let work;
+    if (message.type === 'pin') {
+        work = pinAudio(audioKey(message.filename)).then(evicted => ({ ok: true, evicted }));
+    } else if (message.type === 'unpin') {
+        work = unpinAudio(audioKey(message.filename)).then(() => ({ ok: true }));
+    } else if (message.type === 'pinned') {
+        work = updateAudioIndex(index => ({
+            ok: true,
+            quota: AUDIO_QUOTA_BYTES,
+            used: Object.values(index).reduce((sum, entry) => sum + entry.size, 0),
+            filenames: Object.keys(index).map(filenameOf)
+        }));
+    } else {
+        return;
+    }
+    event.waitUntil(work.then(reply, error => reply({ ok: false, error: error.message })));
+});
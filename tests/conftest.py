@@ -0,0 +1,39 @@
+"""
+Shared setup of the tests
+
+The configuration is read from the environment when config is imported,
+so the environment is pointed at a temporary directory and the simulated
+reader before any module of the app is loaded.
+"""
+import os
+import sys
+import tempfile
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='kap-tests-')
+
+os.environ.setdefault('RFID_SIMULATION', '1')
+os.environ.setdefault('LOUDNESS_ANALYSIS', '0')
+os.environ.setdefault('MAPPING_EXPORT', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}")
+os.environ.setdefault('MAPPING_FILE', os.path.join(TEST_DIR, 'mappings.json'))
+os.environ.setdefault('CHANGE_NOTIFY_DIR', os.path.join(TEST_DIR, 'notify'))
+os.environ.setdefault('BUS_DIR', os.path.join(TEST_DIR, 'bus'))
+os.environ.setdefault('JOBS_LOCK_FILE', os.path.join(TEST_DIR, 'jobs.lock'))
+os.environ.setdefault('SYNC_INDEX_FILE', os.path.join(TEST_DIR, 'sync-index.json'))
+
+FAKE_MPG123 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_mpg123.py')
+
+@pytest.fixture
+def fake_mpg123():
+    """
+    Command of a fake mpg123 for Mpg123Process (see tests/fake_mpg123.py).
+
+    Returns:
+        callable: Builds the command from the fake's options, e.g.
+            fake_mpg123('--stall-at', '39')
+    """
+    def command(*options):
+        return (sys.executable, FAKE_MPG123) + tuple(options)
+    return command
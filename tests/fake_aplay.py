@@ -0,0 +1,29 @@
+"""
+Stand-in for aplay in the tests
+
+Reads raw 16-bit stereo PCM at 44.1 kHz into a 0.2 s buffer and reports
+on stderr, like aplay, when the buffer ran dry.
+"""
+import os
+import sys
+import time
+
+BYTES_PER_S = 44100 * 4
+BUFFER_S = 0.2
+
+def main():
+    buffered_until = None
+    while True:
+        data = os.read(0, 4096)
+        if not data:
+            break
+        now = time.monotonic()
+        if buffered_until is not None and now > buffered_until:
+            print(f'underrun!!! (at least {(now - buffered_until) * 1000:.3f} ms long)', file=sys.stderr, flush=True)
+        buffered_until = max(buffered_until or now, now)
+        if buffered_until - now > BUFFER_S:
+            time.sleep(buffered_until - now - BUFFER_S)
+        buffered_until += len(data) / BYTES_PER_S
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Stand-in for mpg123 in remote control mode (mpg123 -R) in the tests
+
+Waits for LOAD (and an optional JUMP), then reports the decoded frames as
+'@F' lines in real time. Decoding may run up to --buffer-s seconds ahead
+of playback, like mpg123 filling the output buffer. A stall can be put
+after a frame, with a decode error on stderr, to look like a broken file
+or a hanging decoder.
+
+    python tests/fake_mpg123.py --frames 400 --stall-at 39   # hangs once
+    python tests/fake_mpg123.py --stall-after 5              # hangs after every (re)start
+"""
+import os
+import sys
+import time
+import select
+import argparse
+
+DECODE_ERROR = '[src/libmpg123/layer3.c:1050] error: part2_3_length (3264) too large for available bit count (3240)'
+
+def read_commands():
+    """Read the commands until LOAD and the ones that follow right after"""
+    commands = b''
+    while b'LOAD' not in commands:
+        data = os.read(0, 4096)
+        if not data:
+            break
+        commands += data
+    while select.select([0], [], [], 0.02)[0]:
+        data = os.read(0, 4096)
+        if not data:
+            break
+        commands += data
+    return commands.decode().splitlines()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake mpg123 -R")
+    parser.add_argument('--frames', type=int, default=120, help="frames of the track")
+    parser.add_argument('--frame-s', type=float, default=0.026, help="duration of one frame")
+    parser.add_argument('--buffer-s', type=float, default=0.0, help="seconds decoded ahead of playback")
+    parser.add_argument('--stall-at', type=int, help="stall after this frame, unless restarted with JUMP")
+    parser.add_argument('--stall-after', type=int, help="stall this many frames after every (re)start")
+    parser.add_argument('--stall-s', type=float, default=3600.0, help="duration of the stall")
+    parser.add_argument('--decode-error', action='store_true', help="report a decode error at the stall")
+    # mpg123 options passed by the player (-R, -a <device>, -f <scale>)
+    args, _ = parser.parse_known_args()
+
+    start = 0
+    for line in read_commands():
+        if line.startswith('JUMP '):
+            start = int(line[5:])
+    if args.stall_after is not None:
+        stall_at = start + args.stall_after
+    else:
+        stall_at = args.stall_at if start == 0 else None
+
+    print('@P 2', flush=True)
+    buffered_until = time.monotonic()
+    for frame in range(start, args.frames):
+        now = time.monotonic()
+        buffered_until = max(buffered_until, now)
+        if buffered_until - now > args.buffer_s:
+            time.sleep(buffered_until - now - args.buffer_s)
+        buffered_until += args.frame_s
+        print(f'@F {frame} {args.frames - frame} {frame * args.frame_s:.2f} '
+              f'{(args.frames - frame) * args.frame_s:.2f}', flush=True)
+        if frame == stall_at:
+            if args.decode_error:
+                print(DECODE_ERROR, file=sys.stderr, flush=True)
+            time.sleep(args.stall_s)
+    print('@P 0', flush=True)
+
+    # mpg123 -R quits at the end of its input
+    while os.read(0, 4096):
+        pass
+
+if __name__ == '__main__':
+    main()
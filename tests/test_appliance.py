@@ -0,0 +1,27 @@
+"""
+Memory and startup budgets of the headless appliance
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+from config import APPLIANCE_MAX_RSS_MB, APPLIANCE_MAX_STARTUP_S
+
+APPLIANCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'appliance.py')
+
+def test_startup_budget():
+    # The startup time includes the interpreter start of the child
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, APPLIANCE, '--report'],
+        capture_output=True, text=True, env=dict(os.environ, RFID_SIMULATION='1'), timeout=60
+    )
+    elapsed = time.perf_counter() - started
+    assert result.returncode == 0, result.stderr
+    figures = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert figures['heavy_modules'] == []
+    if figures['rss_mb'] is not None:
+        assert figures['rss_mb'] <= APPLIANCE_MAX_RSS_MB
+    assert elapsed <= APPLIANCE_MAX_STARTUP_S
@@ -0,0 +1,89 @@
+"""
+Underruns, xruns and decode errors counted by the audio telemetry
+
+Fake tracks are played through the mpg123 player and through the mixer
+with stalls shorter and longer than the output buffer. Only the audible
+ones may be counted, and a track that keeps underrunning is flagged.
+"""
+import os
+import sys
+import time
+import wave
+import pytest
+from config import AUDIO_FLAG_PLAYS
+from utils.audio_telemetry import telemetry
+from utils.player import Mpg123Process
+
+FAKE_APLAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_aplay.py')
+
+# Output buffer of the fake mpg123
+BUFFER_S = 0.5
+
+def play(command, track, stall_at, stall):
+    """Play a fake track to the end and return its telemetry session"""
+    options = ['--frames', '120', '--buffer-s', str(BUFFER_S)]
+    if stall:
+        options += ['--stall-at', str(stall_at), '--stall-s', str(stall), '--decode-error']
+    decoder = Mpg123Process(f'/music/{track}', ['-a', 'fake'], command=command(*options), track=track)
+    while decoder.is_playing():
+        time.sleep(0.05)
+    decoder.stop()
+    return decoder.telemetry
+
+@pytest.mark.parametrize('track, stall, underruns', [
+    ('clean.mp3', 0.0, 0),
+    ('short-stall.mp3', 0.3, 0),
+    ('long-stall.mp3', 1.2, 1),
+])
+def test_mpg123_underruns(fake_mpg123, track, stall, underruns):
+    session = play(fake_mpg123, track, 60, stall)
+
+    assert session.underruns == underruns
+    assert session.underrun_seconds == pytest.approx(max(0.0, stall - BUFFER_S) * underruns, abs=0.15)
+    assert session.decode_errors == (1 if stall else 0)
+    assert 119 <= session.frames <= 120
+
+def test_track_that_keeps_underrunning_is_flagged(fake_mpg123):
+    play(fake_mpg123, 'fine.mp3', 60, 0.0)
+    for _ in range(AUDIO_FLAG_PLAYS):
+        play(fake_mpg123, 'heavy.mp3', 60, 1.2)
+
+    flagged = telemetry.flagged()
+    assert 'heavy.mp3' in flagged['tracks']
+    assert 'fine.mp3' not in flagged['tracks']
+    assert 'fake' in flagged['devices']
+
+@pytest.mark.parametrize('stall, underruns', [(0.2, 0), (1.2, 1)])
+def test_mixer_underruns(tmp_path, stall, underruns):
+    np = pytest.importorskip('numpy')
+    from utils.mixer import Mixer, AlsaSink, SAMPLE_RATE
+
+    path = str(tmp_path / 'tone.wav')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        tone = (np.sin(np.arange(SAMPLE_RATE * 4) * 2 * np.pi * 440 / SAMPLE_RATE) * 8000).astype('<i2')
+        f.writeframes(np.repeat(tone[:, np.newaxis], 2, axis=1).tobytes())
+
+    # aplay buffers 0.2 s and the pipe to it about 0.37 s
+    mixer = Mixer(AlsaSink('fake-card', command=(sys.executable, FAKE_APLAY)), 0, 0, 0)
+    mixer.start()
+    try:
+        mixer.play(path, track=f'tone-{stall}.wav')
+        time.sleep(1.0)
+        read = mixer.current.decoder.read
+        def stalled_read(frames):
+            mixer.current.decoder.read = read
+            time.sleep(stall)
+            return read(frames)
+        mixer.current.decoder.read = stalled_read
+        session = mixer.current.session
+        while mixer.is_playing():
+            time.sleep(0.05)
+        time.sleep(0.3)
+    finally:
+        mixer.close()
+
+    assert session.underruns == underruns
+    assert session.xruns == underruns
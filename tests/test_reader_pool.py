@@ -0,0 +1,31 @@
+"""
+Load test of the reader pool with fake readers
+
+The latency per reader should stay flat as readers are added, as long as
+the polls fit into one interval.
+"""
+import time
+import pytest
+from utils.mfrc522_fake import FakeCard, FakeMFRC522
+from utils.mfrc522_fast import FastMFRC522
+from utils.reader_pool import PooledReader, ReaderPool
+
+DURATION = 1.0
+
+@pytest.mark.parametrize('count', [1, 2, 4, 8])
+def test_latency_stays_flat(count):
+    readers = []
+    for i in range(count):
+        chip = FakeMFRC522(FakeCard([i, 1, 2, 3]) if i % 2 else None)
+        readers.append(PooledReader(f"r{i}", FastMFRC522(chip)))
+    pool = ReaderPool(readers, read_text=True)
+    end = time.monotonic() + DURATION
+    while time.monotonic() < end:
+        pool.poll_next()
+    stats = pool.stats()
+
+    assert len(stats) == count
+    # Every reader is polled once per interval, however many there are
+    assert min(s['polls'] for s in stats) >= DURATION / pool.interval - 1
+    assert max(s['avg_lag_ms'] for s in stats) < 10
+    assert max(s['max_lag_ms'] for s in stats) < pool.interval * 1000 / 2
@@ -0,0 +1,36 @@
+"""
+Several processes behind serve.py: every worker answers and learns about
+the owner's events
+"""
+import os
+import pytest
+import serve
+from db import db, create_db_app
+from models import RFIDTag
+
+PORT = int(os.environ.get('TEST_SERVE_PORT', '5390'))
+
+@pytest.fixture(scope='module')
+def workers(tmp_path_factory):
+    # Create the tables first, the workers would race for them
+    with create_db_app().app_context():
+        RFIDTag.metadata.create_all(db.engine)
+
+    directory = tmp_path_factory.mktemp('serve')
+    env = {
+        'BUS_DIR': str(directory / 'bus'),
+        'CHANGE_NOTIFY_DIR': str(directory / 'notify')
+    }
+    processes = serve.start_workers(2, PORT, env)
+    try:
+        serve.wait_ready(processes)
+        yield processes
+    finally:
+        serve.stop_workers(processes)
+
+def test_workers_answer(workers):
+    for _, port in workers:
+        assert serve._client((port, '/api/songs?limit=50', 0.5)) > 0
+
+def test_event_reaches_all_workers(workers):
+    assert serve.check_event_propagation(workers) is not None
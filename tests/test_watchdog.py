@@ -0,0 +1,134 @@
+"""
+Recovery of a wedged reader and of stalled decoders through the watchdog
+"""
+import time
+import threading
+import pytest
+from config import WATCHDOG_READER_TIMEOUT_MS
+from utils.mfrc522_fast import FastMFRC522
+from utils.mfrc522_fake import FakeMFRC522, FakeCard
+from utils.player import Mpg123Process
+from utils.rfid_handler import RFIDHandler
+from utils.watchdog import create_watchdog
+
+class WedgingTransport:
+    """Transport of the fake chip that hangs or fails on request until reset"""
+    def __init__(self, chip):
+        self.chip = chip
+        self.mode = None           # None, 'hang' or 'fail'
+        self.resets = 0
+        self._released = threading.Event()
+
+    def wedge(self, mode):
+        self._released.clear()
+        self.mode = mode
+
+    def _access(self):
+        if self.mode == 'hang':
+            self._released.wait()
+        elif self.mode == 'fail':
+            raise OSError("SPI transfer failed")
+
+    def reset(self):
+        self.resets += 1
+        self.mode = None
+        self._released.set()
+
+    def read(self, register):
+        self._access()
+        return self.chip.read(register)
+
+    def write(self, register, value):
+        self._access()
+        self.chip.write(register, value)
+
+    def read_many(self, register, count):
+        self._access()
+        return self.chip.read_many(register, count)
+
+    def write_many(self, register, values):
+        self._access()
+        self.chip.write_many(register, values)
+
+@pytest.fixture
+def watchdog():
+    watchdog = create_watchdog()
+    if watchdog is None:
+        pytest.skip("WATCHDOG_ENABLED=0")
+    watchdog.start()
+    yield watchdog
+    watchdog.stop()
+
+@pytest.mark.parametrize('mode', ['hang', 'fail'])
+def test_wedged_reader_recovers(mode):
+    transport = WedgingTransport(FakeMFRC522(FakeCard([1, 2, 3, 4])))
+    reader = FastMFRC522(transport)
+    handler = RFIDHandler(reader=reader)
+
+    # Time of every poll that completed in the current detection loop
+    polls = []
+    poll = reader.read_id_no_block
+    def timed_poll():
+        tag_id = poll()
+        if threading.current_thread() is handler.thread:
+            polls.append(time.monotonic())
+        return tag_id
+    reader.read_id_no_block = timed_poll
+
+    events = []
+    handler.register_callback(lambda tag_id, status: events.append((tag_id, status)))
+    watchdog = create_watchdog(handler)
+    if watchdog is None:
+        pytest.skip("WATCHDOG_ENABLED=0")
+    watchdog.start()
+    handler.start()
+    try:
+        time.sleep(0.5)
+        before = len(events)
+        wedged = time.monotonic()
+        transport.wedge(mode)
+        reader_timeout = WATCHDOG_READER_TIMEOUT_MS / 1000
+        while not transport.resets or polls[-1] <= wedged + reader_timeout:
+            time.sleep(0.01)
+            if time.monotonic() - wedged > 10:
+                break
+        recovered = polls[-1] - wedged
+        time.sleep(0.3)
+    finally:
+        handler.stop()
+        watchdog.stop()
+
+    assert transport.resets >= 1
+    assert recovered < 1.0
+    # The tag stayed on the reader, the recovery must not repeat its events
+    assert events[before:] == []
+
+def test_stalled_decoder_resumes(watchdog, fake_mpg123):
+    decoder = Mpg123Process('/music/track.mp3', command=fake_mpg123('--frames', '400', '--stall-at', '39'))
+    try:
+        while decoder.frame < 39:
+            time.sleep(0.01)
+        hung = time.monotonic()
+        while decoder.restarts == 0 or decoder.frame <= 40:
+            time.sleep(0.005)
+            if time.monotonic() - hung > 10:
+                break
+        recovered = time.monotonic() - hung
+    finally:
+        decoder.stop()
+
+    assert decoder.restarts >= 1
+    assert recovered < 1.0
+    assert decoder.frame > 40
+
+def test_hanging_decoder_backs_off(watchdog, fake_mpg123):
+    # Hangs 5 frames after every restart, so it is restarted less and less often
+    decoder = Mpg123Process('/music/broken.mp3', command=fake_mpg123('--frames', '400', '--stall-after', '5'))
+    try:
+        time.sleep(8)
+        restarts = decoder.restarts
+    finally:
+        decoder.stop()
+
+    assert 2 <= restarts <= 5
+    assert watchdog.status()['decoder']['backoff_s'] > 1
@@ -0,0 +1,176 @@
+"""
+Static asset pipeline without a build step
+
+At startup the stylesheets and scripts under static/ are fingerprinted
+(the content hash becomes part of the URL) and compressed once with gzip
+and, if available, brotli. The icons under static/svg/ are bundled into a
+single sprite; every icon gets a <view> element, so `sprite.svg#play`
+shows only the play icon, both in <img> tags and in CSS. References to
+the single icons in CSS and JS are rewritten to the sprite.
+
+A fingerprinted URL never changes its content, so it is served with an
+immutable one-year cache lifetime and a reload only fetches what changed.
+"""
+import os
+import re
+import hashlib
+import mimetypes
+import logging
+from utils.http_cache import compress, brotli, COMPRESS_MIN_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Files taken into the pipeline, relative to the static folder
+ASSET_DIRS = ('css', 'js')
+ICON_DIR = 'svg'
+SPRITE_NAME = 'svg/sprite.svg'
+
+# Space between two icons in the sprite, keeps neighbours out of a view
+SPRITE_GAP = 4
+
+_SVG_ROOT = re.compile(r'<svg\b([^>]*)>(.*)</svg>\s*$', re.S)
+_VIEWBOX = re.compile(r'\bviewBox="([^"]+)"')
+_SIZE_ATTRS = re.compile(r'\s(?:xmlns|width|height|x|y|id)="[^"]*"')
+_ICON_REF = re.compile(r'/static/svg/([\w-]+)\.svg')
+
+class Asset:
+    """
+    A fingerprinted file with its compressed variants
+    """
+    def __init__(self, name, body, mimetype):
+        self.name = name
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        self.mimetype = mimetype
+        self.bodies = {None: body}
+        if len(body) >= COMPRESS_MIN_SIZE:
+            self.bodies['gzip'] = compress(body, 'gzip')
+            if brotli is not None:
+                self.bodies['br'] = compress(body, 'br')
+
+    @property
+    def fingerprinted_name(self):
+        root, ext = os.path.splitext(self.name)
+        return f"{root}.{self.digest}{ext}"
+
+def build_sprite(icons):
+    """
+    Bundle SVG icons into one sprite.
+
+    Args:
+        icons (dict): Icon name -> SVG source
+
+    Returns:
+        str: The sprite, with one <view> per icon
+    """
+    parts = []
+    views = []
+    x = 0
+    height = 0
+    for name, source in sorted(icons.items()):
+        match = _SVG_ROOT.search(source)
+        viewbox = _VIEWBOX.search(source)
+        if not match or not viewbox:
+            logger.warning(f"Icon {name} is not a plain SVG, skipped")
+            continue
+        _, _, w, h = (float(v) for v in viewbox.group(1).replace(',', ' ').split())
+        attrs = _SIZE_ATTRS.sub('', match.group(1))
+        parts.append(f'<svg id="icon-{name}" x="{x:g}" y="0" width="{w:g}" height="{h:g}"{attrs}>'
+                     f'{match.group(2).strip()}</svg>')
+        views.append(f'<view id="{name}" viewBox="{x:g} 0 {w:g} {h:g}"/>')
+        x += w + SPRITE_GAP
+        height = max(height, h)
+
+    width = max(x - SPRITE_GAP, 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width:g} {height:g}">'
+            + ''.join(views) + ''.join(parts) + '</svg>')
+
+class AssetPipeline:
+    """
+    Fingerprinted, precompressed assets of a static folder
+    """
+    def __init__(self, static_dir, url_prefix='/assets'):
+        self.static_dir = static_dir
+        self.url_prefix = url_prefix
+        self._assets = {}      # logical name -> Asset
+        self._by_url = {}      # fingerprinted name -> Asset
+
+    def _add(self, name, body, mimetype=None):
+        mimetype = mimetype or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        asset = Asset(name, body, mimetype)
+        self._assets[name] = asset
+        self._by_url[asset.fingerprinted_name] = asset
+        return asset
+
+    def build(self):
+        """
+        Hash, rewrite and compress all assets.
+
+        Returns:
+            int: Number of assets
+        """
+        self._assets = {}
+        self._by_url = {}
+
+        icon_dir = os.path.join(self.static_dir, ICON_DIR)
+        icons = {}
+        if os.path.isdir(icon_dir):
+            for filename in os.listdir(icon_dir):
+                root, ext = os.path.splitext(filename)
+                if ext.lower() == '.svg' and f"{ICON_DIR}/{filename}" != SPRITE_NAME:
+                    with open(os.path.join(icon_dir, filename), encoding='utf-8') as f:
+                        icons[root] = f.read()
+        sprite = None
+        if icons:
+            sprite = self._add(SPRITE_NAME, build_sprite(icons).encode('utf-8'), 'image/svg+xml')
+
+        def rewrite(match):
+            if sprite and match.group(1) in icons:
+                return f"{self.url_prefix}/{sprite.fingerprinted_name}#{match.group(1)}"
+            return match.group(0)
+
+        for directory in ASSET_DIRS:
+            base = os.path.join(self.static_dir, directory)
+            if not os.path.isdir(base):
+                continue
+            for dirpath, _, filenames in os.walk(base):
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, self.static_dir).replace(os.sep, '/')
+                    with open(path, 'rb') as f:
+                        body = f.read()
+                    if name.endswith(('.css', '.js')):
+                        body = _ICON_REF.sub(rewrite, body.decode('utf-8')).encode('utf-8')
+                    self._add(name, body)
+
+        size = sum(len(a.bodies[None]) for a in self._assets.values())
+        logger.info(f"Asset pipeline: {len(self._assets)} assets ({size} bytes), {len(icons)} icons in the sprite")
+        return len(self._assets)
+
+    def url(self, name):
+        """
+        Get the URL of an asset.
+
+        Args:
+            name (str): Path relative to the static folder, e.g. 'css/styles.css'
+                or 'svg/play.svg' (resolved to the sprite view)
+
+        Returns:
+            str: Fingerprinted URL, or the plain static URL for unknown files
+        """
+        asset = self._assets.get(name)
+        if asset:
+            return f"{self.url_prefix}/{asset.fingerprinted_name}"
+
+        root, ext = os.path.splitext(name)
+        sprite = self._assets.get(SPRITE_NAME)
+        if sprite and ext == '.svg' and os.path.dirname(root) == ICON_DIR:
+            return f"{self.url_prefix}/{sprite.fingerprinted_name}#{os.path.basename(root)}"
+        return f"/static/{name}"
+
+    def get(self, fingerprinted_name):
+        """Get an asset by its fingerprinted name (None if unknown)"""
+        return self._by_url.get(fingerprinted_name)
+
+    def manifest(self):
+        """Logical name -> fingerprinted URL of all assets"""
+        return {name: self.url(name) for name in sorted(self._assets)}
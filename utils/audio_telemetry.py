@@ -0,0 +1,375 @@
+"""
+Audio telemetry for the Kids Audio Player
+
+Every playback gets a session that the decoder feeds from its status
+output: mpg123 reports the decoded frames and the position on stdout,
+decode errors on stderr, and aplay reports ALSA xruns on stderr. The
+readers run in their own threads, so a full pipe can never block the
+decoder.
+
+Underruns are detected from the position: playback through a blocking
+ALSA write keeps a constant distance to the wall clock, and that distance
+only grows when the output ran dry. The smallest distance per second is
+compared with the one before; an increase of more than AUDIO_UNDERRUN_MS
+is counted as an underrun of that length. This works with mpg123, which
+does not report the underruns it recovers from.
+
+Tracks and output devices that underrun in several of their last plays
+are flagged, e.g. a file that is too heavy to decode in real time or a
+USB sound card with a bad cable. Counters are exported through
+utils.metrics and status().
+"""
+import re
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+from utils.metrics import metrics
+from config import AUDIO_UNDERRUN_MS, AUDIO_FLAG_PLAYS, AUDIO_FLAG_WINDOW
+
+logger = logging.getLogger(__name__)
+
+# Seconds over which the smallest lag is taken
+LAG_WINDOW = 1.0
+
+# Tracks kept in the statistics, the least recently played are dropped
+MAX_TRACKS = 500
+
+# Sessions kept in status() after they ended
+RECENT_SESSIONS = 20
+
+# Lines of mpg123 and aplay on stderr
+XRUN_LINE = re.compile(r'underrun|overrun|xrun', re.IGNORECASE)
+XRUN_LENGTH = re.compile(r'at least ([\d.]+) ms')
+DECODE_ERROR_LINE = re.compile(r'error|illegal audio-mpeg-header|resync|skipped \d+ bytes', re.IGNORECASE)
+
+metrics.describe('audio_decoded_frames_total', 'counter', 'Frames decoded (MP3 frames with mpg123, sample frames with the mixer)')
+metrics.describe('audio_underruns_total', 'counter', 'Playback that fell behind the wall clock')
+metrics.describe('audio_underrun_seconds', 'summary', 'Length of the underruns')
+metrics.describe('audio_xruns_total', 'counter', 'Xruns reported by the audio output')
+metrics.describe('audio_decode_errors_total', 'counter', 'Errors reported by the decoder')
+metrics.describe('audio_position_seconds', 'gauge', 'Position of the current track')
+metrics.describe('audio_flagged', 'gauge', '1 if a track or device underran in several of its last plays')
+
+def classify(line):
+    """
+    Classify a line the decoder or the output wrote to stderr.
+
+    Returns:
+        tuple: ('xrun', milliseconds or None), ('decode_error', message)
+            or None for other output
+    """
+    if XRUN_LINE.search(line):
+        length = XRUN_LENGTH.search(line)
+        return 'xrun', float(length.group(1)) if length else None
+    if DECODE_ERROR_LINE.search(line):
+        return 'decode_error', line.strip()
+    return None
+
+class LagTracker:
+    """
+    Detects underruns from the distance between position and wall clock
+    """
+    def __init__(self, threshold=AUDIO_UNDERRUN_MS / 1000, window=LAG_WINDOW, clock=time.monotonic):
+        """
+        Args:
+            threshold (float): Seconds the lag must grow to count as underrun
+            window (float): Seconds over which the smallest lag is taken
+            clock (callable): Time source
+        """
+        self.threshold = threshold
+        self.window = window
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """Start over, e.g. after a seek or a restarted decoder"""
+        self.started = None
+        self.baseline = None
+        self._window_min = None
+        self._window_end = None
+
+    def update(self, position):
+        """
+        Record the position reached.
+
+        Args:
+            position (float): Seconds of audio written or decoded
+
+        Returns:
+            float: Seconds lost if an underrun was detected, otherwise None
+        """
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        if self._window_end is None:
+            # A window starts with an update, not during a gap, so that it
+            # also sees the output being refilled after the gap
+            self._window_end = now + self.window
+        lag = now - self.started - position
+        if self._window_min is None or lag < self._window_min:
+            self._window_min = lag
+        if now < self._window_end:
+            return None
+        return self._close_window()
+
+    def finish(self):
+        """Evaluate the last, incomplete window"""
+        if self._window_min is None:
+            return None
+        return self._close_window()
+
+    def _close_window(self):
+        lag, self._window_min, self._window_end = self._window_min, None, None
+        if self.baseline is None or lag < self.baseline:
+            self.baseline = lag
+            return None
+        lost = lag - self.baseline
+        if lost <= self.threshold:
+            return None
+        self.baseline = lag
+        return lost
+
+class PlaybackSession:
+    """
+    Telemetry of one playback of a track
+    """
+    def __init__(self, owner, track, device, engine, track_lag=True):
+        """
+        Args:
+            owner (AudioTelemetry): Collects the session when it ends
+            track (str): Track name
+            device (str): Output device
+            engine (str): 'mpg123' or 'mixer'
+            track_lag (bool): Detect underruns from the position (False if
+                the caller reports them, like the mixer)
+        """
+        self.owner = owner
+        self.track = track
+        self.device = device
+        self.engine = engine
+        self.lag = LagTracker() if track_lag else None
+        self.frames = 0
+        self.position = 0.0
+        self.underruns = 0
+        self.underrun_seconds = 0.0
+        self.xruns = 0
+        self.decode_errors = 0
+        self.last_error = None
+        self.restarts = 0
+        self.started = time.time()
+        self.ended = None
+        self._end_lock = threading.Lock()
+
+    def progress(self, position, frames=1):
+        """
+        Record decoded frames.
+
+        Args:
+            position (float): Position in the track in seconds
+            frames (int): Frames decoded since the last call
+        """
+        if self.ended:
+            return
+        self.frames += frames
+        self.position = position
+        metrics.inc('audio_decoded_frames_total', frames, device=self.device, engine=self.engine)
+        metrics.set('audio_position_seconds', position, device=self.device)
+        if self.lag:
+            lost = self.lag.update(position)
+            if lost:
+                self.underrun(lost)
+
+    def underrun(self, seconds):
+        """Record an underrun of the given length"""
+        self.underruns += 1
+        self.underrun_seconds += seconds
+        metrics.inc('audio_underruns_total', device=self.device)
+        metrics.observe('audio_underrun_seconds', seconds, device=self.device)
+        logger.info(f"Unterlauf von {seconds * 1000:.0f} ms bei {self.position:.1f} s: {self.track} ({self.device})")
+
+    def xrun(self, milliseconds=None):
+        """Record an xrun reported by the output"""
+        self.xruns += 1
+        metrics.inc('audio_xruns_total', device=self.device)
+        length = f" ({milliseconds:.0f} ms)" if milliseconds is not None else ''
+        logger.info(f"Xrun{length} bei {self.position:.1f} s: {self.track} ({self.device})")
+
+    def decode_error(self, message):
+        """Record an error reported by the decoder"""
+        self.decode_errors += 1
+        self.last_error = message
+        metrics.inc('audio_decode_errors_total', device=self.device)
+        logger.debug(f"Decoder-Fehler in {self.track}: {message}")
+
+    def stderr_line(self, line):
+        """Record a line the decoder wrote to stderr"""
+        kind = classify(line)
+        if kind is None:
+            return
+        if kind[0] == 'xrun':
+            self.xrun(kind[1])
+        else:
+            self.decode_error(kind[1])
+
+    def resumed(self):
+        """The decoder was restarted or jumped, the lag starts over"""
+        self.restarts += 1
+        if self.lag:
+            self.lag.reset()
+
+    def end(self):
+        """The playback ended or was stopped"""
+        # Called by the status reader and by stop(), the second call
+        # returns once the session was counted
+        with self._end_lock:
+            if self.ended:
+                return
+            if self.lag:
+                lost = self.lag.finish()
+                if lost:
+                    self.underrun(lost)
+            self.ended = time.time()
+            metrics.set('audio_position_seconds', 0, device=self.device)
+            self.owner.finished(self)
+
+    def as_dict(self):
+        return {
+            'track': self.track,
+            'device': self.device,
+            'engine': self.engine,
+            'frames': self.frames,
+            'position_s': round(self.position, 2),
+            'underruns': self.underruns,
+            'underrun_ms': round(self.underrun_seconds * 1000),
+            'xruns': self.xruns,
+            'decode_errors': self.decode_errors,
+            'last_error': self.last_error,
+            'restarts': self.restarts,
+            'started': self.started,
+            'ended': self.ended
+        }
+
+class _Stats:
+    """Plays of a track or device and how many of them underran"""
+    def __init__(self, window):
+        self.plays = 0
+        self.underruns = 0
+        self.underrun_seconds = 0.0
+        self.xruns = 0
+        self.decode_errors = 0
+        self.recent = deque(maxlen=window)   # True for plays with underruns or xruns
+        self.flagged = False
+
+    def add(self, session, flag_plays):
+        """
+        Add a finished session.
+
+        Returns:
+            bool: True if the flag changed
+        """
+        self.plays += 1
+        self.underruns += session.underruns
+        self.underrun_seconds += session.underrun_seconds
+        self.xruns += session.xruns
+        self.decode_errors += session.decode_errors
+        self.recent.append(bool(session.underruns or session.xruns))
+        flagged = sum(self.recent) >= flag_plays
+        changed, self.flagged = flagged != self.flagged, flagged
+        return changed
+
+    def as_dict(self):
+        return {
+            'plays': self.plays,
+            'underruns': self.underruns,
+            'underrun_ms': round(self.underrun_seconds * 1000),
+            'xruns': self.xruns,
+            'decode_errors': self.decode_errors,
+            'recent_troubled': sum(self.recent),
+            'recent_plays': len(self.recent),
+            'flagged': self.flagged
+        }
+
+class AudioTelemetry:
+    """
+    Playback sessions and per-track and per-device statistics
+    """
+    def __init__(self, flag_plays=AUDIO_FLAG_PLAYS, flag_window=AUDIO_FLAG_WINDOW, max_tracks=MAX_TRACKS):
+        self.flag_plays = flag_plays
+        self.flag_window = flag_window
+        self.max_tracks = max_tracks
+        self.active = []
+        self.recent = deque(maxlen=RECENT_SESSIONS)
+        self.tracks = OrderedDict()
+        self.devices = {}
+        self._lock = threading.Lock()
+
+    def start(self, track, device, engine, track_lag=True):
+        """
+        Start a session for a playback.
+
+        Returns:
+            PlaybackSession: Fed by the decoder, ended when playback stops
+        """
+        session = PlaybackSession(self, track, device, engine, track_lag)
+        with self._lock:
+            self.active.append(session)
+        return session
+
+    def finished(self, session):
+        """Add an ended session to the statistics"""
+        with self._lock:
+            if session in self.active:
+                self.active.remove(session)
+            self.recent.append(session)
+            track = self.tracks.pop(session.track, None) or _Stats(self.flag_window)
+            self.tracks[session.track] = track
+            while len(self.tracks) > self.max_tracks:
+                name, dropped = self.tracks.popitem(last=False)
+                if dropped.flagged:
+                    metrics.set('audio_flagged', 0, track=name)
+            device = self.devices.setdefault(session.device, _Stats(self.flag_window))
+            changes = [(kind, name, stats) for kind, name, stats in
+                       (('track', session.track, track), ('device', session.device, device))
+                       if stats.add(session, self.flag_plays)]
+
+        for kind, name, stats in changes:
+            metrics.set('audio_flagged', 1 if stats.flagged else 0, **{kind: name})
+            if stats.flagged:
+                logger.warning(f"Wiedergabe stockt regelmäßig ({kind} {name}): "
+                               f"{sum(stats.recent)} der letzten {len(stats.recent)} Wiedergaben mit Unterlauf")
+            else:
+                logger.info(f"Wiedergabe läuft wieder flüssig ({kind} {name})")
+
+    def flagged(self):
+        """Names of the tracks and devices that underrun regularly"""
+        with self._lock:
+            return self._flagged()
+
+    def _flagged(self):
+        return {
+            'tracks': [name for name, stats in self.tracks.items() if stats.flagged],
+            'devices': [name for name, stats in self.devices.items() if stats.flagged]
+        }
+
+    def status(self, limit=20):
+        """
+        Current sessions and statistics.
+
+        Args:
+            limit (int): Number of tracks listed, the ones with the most
+                underruns and xruns first
+        """
+        with self._lock:
+            tracks = sorted(self.tracks.items(), key=lambda item: (item[1].flagged, item[1].underruns + item[1].xruns,
+                                                                   item[1].decode_errors), reverse=True)
+            return {
+                'playing': [session.as_dict() for session in self.active],
+                'recent': [session.as_dict() for session in reversed(self.recent)],
+                'devices': {name: stats.as_dict() for name, stats in self.devices.items()},
+                'tracks': {name: stats.as_dict() for name, stats in tracks[:limit]},
+                'flagged': self._flagged()
+            }
+
+# Telemetry of this process
+telemetry = AudioTelemetry()
@@ -0,0 +1,59 @@
+"""
+Runs event callbacks outside the loops that detect the events
+
+The RFID loops poll at real-time priority and are watched by the
+watchdog. Tag callbacks look up the database, resolve and start tracks
+and publish events, which can take much longer than a poll. They run
+one after another in a worker thread with the default priority, so the
+loop keeps polling while a tap is handled. The worker is started from the
+loop and would inherit its real-time settings, so it resets them first.
+"""
+import queue
+import threading
+import logging
+from utils import sched_policy
+
+logger = logging.getLogger(__name__)
+
+# Queued callbacks above which a warning is logged
+BACKLOG_WARNING = 20
+
+class CallbackWorker:
+    """
+    Calls functions in the order they were submitted in one thread
+    """
+    def __init__(self, name):
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """Queue a call, the worker thread is started on first use"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._queue.put((func, args))
+        backlog = self._queue.qsize()
+        if backlog > BACKLOG_WARNING:
+            logger.warning(f"{self.name}: {backlog} Callbacks warten")
+
+    def pending(self):
+        """Number of queued calls"""
+        return self._queue.qsize()
+
+    def join(self):
+        """Wait until all queued calls are done"""
+        self._queue.join()
+
+    def _run(self):
+        sched_policy.reset_thread()
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"{self.name}: Fehler im Callback: {e}")
+            finally:
+                self._queue.task_done()
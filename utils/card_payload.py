@@ -0,0 +1,176 @@
+"""
+Self-describing RFID cards
+
+A card can carry a reference to its track in the text blocks that
+SimpleMFRC522 uses (48 characters). The payload holds a prefix of the
+content hash of the file, the end of its relative path as a hint and a
+checksum:
+
+    K1:<12 hex hash>:<4 hex CRC>:<path hint>
+
+With the payload, playback can start straight from the card while the
+database mapping is verified in the background.
+"""
+import os
+import binascii
+import threading
+import unicodedata
+import logging
+from collections import namedtuple
+from utils.file_handler import content_hash, get_file_path
+
+logger = logging.getLogger(__name__)
+
+VERSION = 'K1'
+HASH_LENGTH = 12
+CARD_TEXT_LENGTH = 48
+HINT_LENGTH = CARD_TEXT_LENGTH - len(VERSION) - HASH_LENGTH - 4 - 3
+
+CardPayload = namedtuple('CardPayload', ['version', 'hash_prefix', 'path_hint'])
+
+# German umlauts are spelled out, other accents are dropped by ascii_hint
+_TRANSLITERATION = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'Ä': 'Ae', 'Ö': 'Oe', 'Ü': 'Ue', 'ß': 'ss'})
+
+def ascii_hint(relative_path):
+    """
+    Reduce a path to the ASCII text that is stored on cards.
+
+    Not every reader backend can write latin-1 (SimpleMFRC522 writes
+    ASCII), so the hint is limited to ASCII and all backends write the
+    same bytes.
+
+    Args:
+        relative_path (str): Path of the file relative to the music directory
+
+    Returns:
+        str: The path with '/' separators and ASCII characters only
+    """
+    hint = relative_path.replace(os.sep, '/').translate(_TRANSLITERATION)
+    return unicodedata.normalize('NFKD', hint).encode('ascii', errors='ignore').decode('ascii')
+
+def _checksum(version, hash_prefix, path_hint):
+    """CRC-16 over the payload fields"""
+    data = f"{version}:{hash_prefix}:{path_hint}".encode('latin-1')
+    return f"{binascii.crc_hqx(data, 0xFFFF):04x}"
+
+def encode_payload(file_hash, relative_path):
+    """
+    Build the card text for a track.
+
+    Args:
+        file_hash (str): Hex content hash of the file
+        relative_path (str): Path of the file relative to the music directory
+
+    Returns:
+        str: Card text of at most 48 characters
+    """
+    hash_prefix = file_hash[:HASH_LENGTH].lower()
+    # Keep the end of the path which holds the file name
+    hint = ascii_hint(relative_path)[-HINT_LENGTH:]
+    return f"{VERSION}:{hash_prefix}:{_checksum(VERSION, hash_prefix, hint)}:{hint}"
+
+def decode_payload(text):
+    """
+    Parse the text of a card.
+
+    Returns:
+        CardPayload: The payload, or None if the card does not hold a valid one
+    """
+    if not text:
+        return None
+    text = text.rstrip(' \x00')
+    parts = text.split(':', 3)
+    if len(parts) != 4 or parts[0] != VERSION:
+        return None
+
+    version, hash_prefix, checksum, hint = parts
+    if len(hash_prefix) != HASH_LENGTH or not hint:
+        return None
+    try:
+        if _checksum(version, hash_prefix, hint) != checksum:
+            logger.warning(f"Card payload checksum mismatch: {text!r}")
+            return None
+    except UnicodeEncodeError:
+        return None
+    return CardPayload(version, hash_prefix, hint)
+
+class CardResolver:
+    """
+    Resolves card payloads to files of the library without the database
+    """
+    def __init__(self, library):
+        self.library = library
+        self._hash_index = {}
+        self._hash_generation = None
+        self._indexing = False
+        self._lock = threading.Lock()
+
+    def _index_hashes(self, generation, songs):
+        """Hash all songs of the library (runs in a background thread)"""
+        index = {}
+        for song in songs:
+            try:
+                path = os.path.join(self.library.directory, song['filename'])
+                index[content_hash(path)[:HASH_LENGTH]] = song['filename']
+            except OSError:
+                continue
+        with self._lock:
+            self._hash_index = index
+            self._hash_generation = generation
+            self._indexing = False
+        logger.info(f"Card hash index built for {len(index)} songs")
+
+    def _lookup_hash(self, hash_prefix):
+        """Look up a hash prefix, (re)building the index in the background if needed"""
+        generation = self.library.refresh()
+        with self._lock:
+            if self._hash_generation != generation and not self._indexing:
+                self._indexing = True
+                threading.Thread(
+                    target=self._index_hashes,
+                    args=(generation, list(self.library.get_songs())),
+                    daemon=True
+                ).start()
+            return self._hash_index.get(hash_prefix)
+
+    def resolve(self, text):
+        """
+        Find the file a card refers to.
+
+        The path hint is tried first because it needs no hashing; if the
+        file moved, the content hash finds it at its new place.
+
+        Args:
+            text (str): Text read from the card
+
+        Returns:
+            str: Relative filename, or None if the card has no usable payload
+        """
+        payload = decode_payload(text)
+        if not payload:
+            return None
+
+        # Complete relative path. It comes from the card and must not
+        # point outside the library.
+        hint = payload.path_hint
+        if len(hint) < HINT_LENGTH:
+            if '..' in hint.replace('\\', '/').split('/') or hint.startswith(('/', '\\')):
+                logger.warning(f"Card payload with unsafe path hint: {payload}")
+            elif os.path.isfile(os.path.join(self.library.directory, hint)):
+                try:
+                    get_file_path(self.library.directory, hint)
+                    return hint
+                except (ValueError, FileNotFoundError):
+                    pass
+
+        filename = self._lookup_hash(payload.hash_prefix)
+        if filename:
+            return filename
+
+        # Truncated or moved path, match the end of the filename
+        for song in self.library.get_songs():
+            if ascii_hint(song['filename']).endswith(payload.path_hint):
+                return song['filename']
+
+        logger.warning(f"Card payload does not match any file: {payload}")
+        return None
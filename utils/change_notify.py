@@ -0,0 +1,176 @@
+"""
+Change notifications between processes
+
+The web app and the RFID service run as separate processes. When the web
+app changes a data set (e.g. registers a tag), it sends a small datagram
+to every subscriber socket in a shared directory. Subscribers learn about
+the change within milliseconds and only reload the entries that changed,
+so they can cache data indefinitely without polling the database.
+
+There is no broker: every subscriber binds its own AF_UNIX datagram socket
+in the directory and publishers send to all sockets they find there.
+Sockets of processes that died are removed by the next publisher.
+"""
+import os
+import glob
+import json
+import time
+import socket
+import threading
+import logging
+from config import CHANGE_NOTIFY_DIR
+from utils.generation import EPOCH, add_listener
+
+logger = logging.getLogger(__name__)
+
+# Larger change sets are sent without keys, subscribers then reload everything
+MAX_KEYS = 500
+MAX_MESSAGE_SIZE = 65536
+
+_send_socket = None
+_send_lock = threading.Lock()
+
+def _socket_dir(directory=None):
+    directory = directory or CHANGE_NOTIFY_DIR
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
+
+def publish(topic, generation, keys=None, directory=None):
+    """
+    Send a change notification to all subscribers.
+
+    Never blocks: if a subscriber's queue is full, its message is dropped
+    and it notices the gap in the generations.
+
+    Args:
+        topic (str): Name of the changed data set (e.g. TAGS)
+        generation (int): Generation after the change
+        keys (list): Changed keys, None if unknown
+        directory (str): Socket directory, defaults to CHANGE_NOTIFY_DIR
+    """
+    if keys is not None and len(keys) > MAX_KEYS:
+        keys = None
+    send_all({
+        'topic': topic,
+        'source': f"{os.getpid()}-{EPOCH}",
+        'generation': generation,
+        'keys': keys
+    }, directory)
+
+def send_to(message, path, timeout=0):
+    """
+    Send a message to one socket without blocking.
+
+    Args:
+        message (dict): JSON-serializable message
+        path (str): Socket path
+        timeout (float): Seconds to keep retrying while the subscriber's
+            queue is full (0 drops the message at once)
+
+    Returns:
+        bool: True if the message was sent
+    """
+    global _send_socket
+
+    data = json.dumps(message).encode('utf-8')
+    deadline = time.monotonic() + timeout
+    while True:
+        with _send_lock:
+            if _send_socket is None:
+                _send_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                _send_socket.setblocking(False)
+            try:
+                _send_socket.sendto(data, path)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Message {message.get('topic')} dropped, subscriber {path} is busy")
+                    return False
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is listening any more
+                logger.debug(f"Removing stale notification socket {path}")
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                return False
+            except OSError as e:
+                logger.warning(f"Message {message.get('topic')} to {path} failed: {e}")
+                return False
+        time.sleep(0.005)
+
+def send_all(message, directory=None, exclude=None):
+    """
+    Send a message to all sockets in a directory without blocking.
+
+    Args:
+        message (dict): JSON-serializable message
+        directory (str): Socket directory, defaults to CHANGE_NOTIFY_DIR
+        exclude (str): Socket path to skip (e.g. the sender's own)
+
+    Returns:
+        int: Number of sockets the message was sent to
+    """
+    sent = 0
+    for path in glob.glob(os.path.join(_socket_dir(directory), '*.sock')):
+        if path != exclude and send_to(message, path):
+            sent += 1
+    return sent
+
+def install(directory=None):
+    """Publish every generation bump that happened in this process"""
+    add_listener(lambda topic, generation, keys, remote: remote or publish(topic, generation, keys, directory))
+
+class ChangeSubscriber:
+    """
+    Receives change notifications in a background thread
+    """
+    def __init__(self, name, callback, directory=None):
+        """
+        Args:
+            name (str): Name of the subscriber, used in the socket name
+            callback (callable): Called with each message (a dict with
+                topic, source, generation and keys)
+            directory (str): Socket directory, defaults to CHANGE_NOTIFY_DIR
+        """
+        self.callback = callback
+        self.path = os.path.join(_socket_dir(directory), f"{name}-{os.getpid()}.sock")
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        """Bind the socket and start receiving"""
+        if self.sock:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1.0)
+        os.chmod(self.path, 0o600)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logger.info(f"Listening for change notifications on {self.path}")
+
+    def stop(self):
+        """Stop receiving and remove the socket"""
+        sock, self.sock = self.sock, None
+        if sock:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _run(self):
+        while self.sock:
+            try:
+                data = self.sock.recv(MAX_MESSAGE_SIZE)
+            except socket.timeout:
+                continue
+            except (OSError, AttributeError):
+                break
+            try:
+                self.callback(json.loads(data))
+            except Exception as e:
+                logger.error(f"Error handling change notification: {e}")
@@ -0,0 +1,56 @@
+"""
+Clocks for the RFID loops
+
+The detection, debounce and simulation loops take their time from a clock
+object instead of calling the time module directly. The system clock is
+used in production; the virtual clock only advances when the code sleeps,
+so hours of simulated activity run in seconds and always give the same
+timings.
+"""
+import time
+
+class SystemClock:
+    """
+    Wall clock backed by the time module
+    """
+    def time(self):
+        """Seconds since the epoch"""
+        return time.time()
+
+    def monotonic(self):
+        """Monotonic seconds for measuring intervals"""
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """Wait for the given number of seconds"""
+        time.sleep(seconds)
+
+class VirtualClock:
+    """
+    Clock that advances only when sleep() or advance() is called
+    """
+    def __init__(self, start=0.0, epoch=1700000000.0):
+        """
+        Args:
+            start (float): Initial monotonic time
+            epoch (float): Wall clock time at the initial monotonic time
+        """
+        self.now = start
+        self.epoch = epoch - start
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def advance(self, seconds):
+        """Move the clock forward without sleeping"""
+        self.sleep(seconds)
+
+# Shared clock for code that is not given one explicitly
+system_clock = SystemClock()
@@ -0,0 +1,347 @@
+"""
+Message bus between the reader process and the web workers
+
+One process owns the RFID reader and the audio output; any number of web
+workers serve HTTP and WebSocket clients. They talk through a bus:
+
+- publish/subscribe: the owner publishes tag and playback events, every
+  worker passes them on to its own Socket.IO clients
+- retained messages: the last message of a topic is kept, so a worker
+  that starts later knows the current state
+- request/reply: workers ask the owner for things only it can do, e.g.
+  reading a tag on demand
+
+InProcessBus delivers within one process (the default, one process does
+everything). LocalSocketBus connects the processes of one machine with
+AF_UNIX datagram sockets in BUS_DIR, like utils/change_notify.py, without
+a broker. Its retained messages are written to BUS_DIR by a background
+thread, requests are answered in a small thread pool, and replies larger
+than one datagram are sent in parts.
+"""
+import os
+import json
+import time
+import uuid
+import base64
+import fnmatch
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import EVENT_BUS, BUS_DIR
+from utils.generation import EPOCH, add_listener, bump_generation
+from utils.change_notify import ChangeSubscriber, send_all, send_to, MAX_MESSAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Retained messages published within this time are written together
+RETAIN_FLUSH_DELAY = 0.5
+
+# Threads answering requests of other processes
+HANDLER_THREADS = 4
+
+# Replies above one datagram are split into parts of this many bytes
+# (base64 and the message around it must fit into MAX_MESSAGE_SIZE)
+REPLY_PART_SIZE = (MAX_MESSAGE_SIZE - 1024) * 3 // 4
+
+# Larger replies are answered with an error
+MAX_REPLY_SIZE = 4 * 1024 * 1024
+
+# Seconds a part may wait for room in the requester's socket queue
+REPLY_SEND_TIMEOUT = 1.0
+
+class BusError(Exception):
+    """Raised when a request cannot be answered"""
+
+class InProcessBus:
+    """
+    Bus within one process
+    """
+    def __init__(self):
+        self.source = f"{os.getpid()}-{EPOCH}"
+        self._subscribers = []   # (pattern, callback)
+        self._handlers = {}      # topic -> handler
+        self._retained = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def subscribe(self, pattern, callback):
+        """
+        Call a function for every message of matching topics.
+
+        Args:
+            pattern (str): Topic or wildcard pattern (e.g. 'rfid.*')
+            callback (callable): Called with (topic, data)
+        """
+        with self._lock:
+            self._subscribers.append((pattern, callback))
+
+    def publish(self, topic, data=None, retain=False):
+        """
+        Send a message to all subscribers.
+
+        Args:
+            topic (str): Topic of the message
+            data: JSON-serializable payload
+            retain (bool): Keep the message as the current state of the topic
+        """
+        self._deliver({'topic': topic, 'data': data, 'retain': retain, 'source': self.source})
+
+    def retained(self, topic, default=None):
+        """Get the last retained message of a topic"""
+        with self._lock:
+            return self._retained.get(topic, default)
+
+    def handle(self, topic, handler):
+        """
+        Answer requests of a topic in this process.
+
+        Args:
+            topic (str): Request topic
+            handler (callable): Called with the request data, returns the
+                reply data
+        """
+        with self._lock:
+            self._handlers[topic] = handler
+
+    def request(self, topic, data=None, timeout=2.0):
+        """
+        Send a request and wait for the reply.
+
+        Raises:
+            BusError: If nobody handles the topic or the handler failed
+        """
+        handler = self._handlers.get(topic)
+        if handler is None:
+            raise BusError(f"No handler for {topic}")
+        try:
+            return handler(data)
+        except Exception as e:
+            raise BusError(f"{topic} failed: {e}") from e
+
+    def _deliver(self, message):
+        topic = message['topic']
+        with self._lock:
+            if message.get('retain'):
+                self._retained[topic] = message['data']
+            subscribers = [cb for pattern, cb in self._subscribers if fnmatch.fnmatchcase(topic, pattern)]
+        for callback in subscribers:
+            try:
+                callback(topic, message['data'])
+            except Exception as e:
+                logger.error(f"Error handling bus message {topic}: {e}")
+
+class LocalSocketBus(InProcessBus):
+    """
+    Bus between the processes of one machine over AF_UNIX datagram sockets
+    """
+    def __init__(self, name, directory=None):
+        super().__init__()
+        self.directory = directory or BUS_DIR
+        self._receiver = ChangeSubscriber(name, self._receive, self.directory)
+        self._retained_dir = os.path.join(self.directory, 'retained')
+        self._replies = {}   # request id -> [threading.Event, reply, parts]
+        self._unsaved = {}   # topic -> retained message not written yet
+        self._flush_wake = threading.Event()
+        self._flusher = None
+        self._executor = ThreadPoolExecutor(max_workers=HANDLER_THREADS, thread_name_prefix='bus-handler')
+
+    def start(self):
+        """Bind the socket and load the retained state of the other processes"""
+        self._receiver.start()
+        os.makedirs(self._retained_dir, mode=0o700, exist_ok=True)
+        for filename in os.listdir(self._retained_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._retained_dir, filename), encoding='utf-8') as f:
+                    message = json.load(f)
+                with self._lock:
+                    self._retained[message['topic']] = message['data']
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Retained bus message {filename} unreadable: {e}")
+        self._flusher = threading.Thread(target=self._flush_loop, name='bus-retained', daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._receiver.stop()
+        self._flush_retained()
+
+    def publish(self, topic, data=None, retain=False, local=True):
+        """
+        Send a message to all subscribers in all processes.
+
+        Args:
+            retain (bool): Keep the message as the current state of the
+                topic (only for state, every retained message is written
+                to disk)
+            local (bool): Also deliver to the subscribers of this process
+        """
+        message = {'topic': topic, 'data': data, 'retain': retain, 'source': self.source}
+        if retain:
+            with self._lock:
+                self._retained[topic] = data
+                self._unsaved[topic] = message
+            self._flush_wake.set()
+        if local:
+            self._deliver(message)
+        if len(json.dumps(message)) > MAX_MESSAGE_SIZE:
+            logger.error(f"Bus message {topic} too large, not sent to other processes")
+            return
+        send_all(message, self.directory, exclude=self._receiver.path)
+
+    def _flush_loop(self):
+        """Write retained messages in the background, the latest per topic"""
+        while True:
+            self._flush_wake.wait()
+            time.sleep(RETAIN_FLUSH_DELAY)
+            self._flush_wake.clear()
+            self._flush_retained()
+
+    def _flush_retained(self):
+        """Keep the retained messages on disk for processes that start later"""
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {}
+        for topic, message in unsaved.items():
+            path = os.path.join(self._retained_dir, f"{topic}.json")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(self._retained_dir, mode=0o700, exist_ok=True)
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(message, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Retained bus message {topic} not saved: {e}")
+
+    def request(self, topic, data=None, timeout=2.0):
+        """Send a request to the process that handles the topic and wait for the reply"""
+        if topic in self._handlers:
+            return super().request(topic, data)
+
+        request_id = uuid.uuid4().hex
+        waiter = [threading.Event(), None, {}]
+        self._replies[request_id] = waiter
+        try:
+            sent = send_all({
+                'topic': topic, 'data': data, 'source': self.source,
+                'request': request_id, 'reply_to': self._receiver.path
+            }, self.directory, exclude=self._receiver.path)
+            if not sent or not waiter[0].wait(timeout):
+                raise BusError(f"No reply for {topic}")
+        finally:
+            self._replies.pop(request_id, None)
+
+        reply = waiter[1]
+        if reply.get('error'):
+            raise BusError(reply['error'])
+        return reply.get('data')
+
+    def _receive(self, message):
+        if message.get('source') == self.source:
+            return
+
+        if 'reply' in message:
+            waiter = self._replies.get(message['reply'])
+            if waiter is None:
+                return
+            if 'part' in message:
+                # Part of a large reply, complete once all parts arrived
+                parts = waiter[2]
+                parts[message['part']] = message['chunk']
+                if len(parts) < message['parts']:
+                    return
+                try:
+                    payload = b''.join(base64.b64decode(parts[i]) for i in range(message['parts']))
+                    message = json.loads(payload)
+                except (KeyError, ValueError) as e:
+                    message = {'error': f"{message['topic']}: broken reply ({e})"}
+            waiter[1] = message
+            waiter[0].set()
+            return
+
+        if 'request' in message:
+            handler = self._handlers.get(message['topic'])
+            if handler is None:
+                return
+            # Answered in a pool thread, so a slow handler does not hold up
+            # the messages behind it
+            self._executor.submit(self._answer, handler, message)
+            return
+
+        self._deliver(message)
+
+    def _answer(self, handler, message):
+        """Run a request handler and send the reply, in parts if it is large"""
+        topic, reply_to = message['topic'], message['reply_to']
+        reply = {'topic': topic, 'reply': message['request'], 'source': self.source}
+        try:
+            reply['data'] = handler(message.get('data'))
+        except Exception as e:
+            reply['error'] = f"{topic} failed: {e}"
+
+        try:
+            payload = json.dumps(reply).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            reply.pop('data', None)
+            reply['error'] = f"{topic} failed: reply not serializable ({e})"
+            payload = json.dumps(reply).encode('utf-8')
+        if len(payload) <= REPLY_PART_SIZE:
+            send_to(reply, reply_to)
+            return
+        if len(payload) > MAX_REPLY_SIZE:
+            logger.error(f"Reply to {topic} too large ({len(payload)} bytes)")
+            send_to({'topic': topic, 'reply': message['request'], 'source': self.source,
+                     'error': f"{topic} failed: reply too large"}, reply_to)
+            return
+
+        count = -(-len(payload) // REPLY_PART_SIZE)
+        for index in range(count):
+            part = payload[index * REPLY_PART_SIZE:(index + 1) * REPLY_PART_SIZE]
+            if not send_to({'topic': topic, 'reply': message['request'], 'source': self.source,
+                            'part': index, 'parts': count, 'chunk': base64.b64encode(part).decode('ascii')},
+                           reply_to, timeout=REPLY_SEND_TIMEOUT):
+                return
+
+def bridge_generations(bus, names):
+    """
+    Keep generation counters in step across processes.
+
+    A data set changed in one worker (e.g. a tag registered there) bumps
+    the generation in all workers, so their caches are invalidated too.
+    The bridged bumps are marked as remote, so only the worker where the
+    change happened publishes it again (change notifications, export).
+
+    Args:
+        bus: The bus
+        names (tuple): Data sets to bridge (e.g. (TAGS,))
+    """
+    if not isinstance(bus, LocalSocketBus):
+        return
+
+    def on_bump(name, generation, keys, remote):
+        if name in names and not remote:
+            bus.publish('generation', {'name': name, 'keys': keys}, local=False)
+
+    def on_message(topic, data):
+        bump_generation(data['name'], data.get('keys'), remote=True)
+
+    add_listener(on_bump)
+    bus.subscribe('generation', on_message)
+
+def create_bus(name):
+    """
+    Create the bus configured with EVENT_BUS ('inprocess' or 'socket').
+
+    Args:
+        name (str): Name of this process, used in the socket name
+    """
+    if EVENT_BUS == 'socket':
+        bus = LocalSocketBus(name)
+    else:
+        bus = InProcessBus()
+    bus.start()
+    return bus
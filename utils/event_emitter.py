@@ -0,0 +1,223 @@
+"""
+Socket.IO event emission off the reader threads
+
+The RFID loops only put events into a queue; a background thread sends
+them. Events that arrive within one window (default 50 ms) are coalesced:
+for state events such as tag_detected/tag_removed only the latest state
+per reader is sent, so a flapping card produces one event instead of a
+burst.
+
+Clients join rooms: ROOM_ALL for every event, or reader:<id> for the
+events of one reader. Other events are broadcast to the rooms in one
+call. State events are sent to every client on its own and acknowledged
+by the client. While a client has not acknowledged the last state, newer
+states replace the pending one instead of queueing up, so a slow tablet
+only gets the current state and never holds up the others.
+"""
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ROOM_ALL = 'all'
+
+# State events: only the latest event of a channel (per reader) matters
+STATE_CHANNELS = {
+    'tag_detected': 'tag',
+    'tag_removed': 'tag',
+    'song_playing': 'playback'
+}
+
+def reader_room(reader_id):
+    """Name of the room for the events of one reader"""
+    return f"reader:{reader_id}"
+
+class ClientState:
+    """
+    Rooms and unacknowledged state events of one client
+    """
+    def __init__(self, sid, rooms):
+        self.sid = sid
+        self.rooms = set(rooms)
+        self.inflight = {}          # state key -> time sent
+        self.pending = OrderedDict()  # state key -> (event, data)
+        self.dropped = 0
+
+    def wants(self, room):
+        return room is None or ROOM_ALL in self.rooms or room in self.rooms
+
+class EventEmitter:
+    """
+    Queue and thread that coalesce and send Socket.IO events
+    """
+    def __init__(self, socketio, window=0.05, ack_timeout=1.0, clock=time.monotonic):
+        """
+        Args:
+            socketio: The Flask-SocketIO instance
+            window (float): Seconds events are collected before sending
+            ack_timeout (float): Seconds after which an unacknowledged state
+                event no longer holds back newer ones (clients without acks)
+            clock (callable): Monotonic time source
+        """
+        self.socketio = socketio
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.clock = clock
+        self._queue = OrderedDict()   # coalescing key -> (event, data, room)
+        self._sequence = 0
+        self._clients = {}
+        self._cond = threading.Condition()
+        self._wakeup = False
+        self._thread = None
+        self._running = False
+        self.stats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'dropped_stale': 0}
+
+    def emit(self, event, data=None, room=None):
+        """
+        Queue an event. Never blocks on the network.
+
+        Args:
+            event (str): Event name
+            data: JSON-serializable payload
+            room (str): Room to send to (None for all clients)
+        """
+        channel = STATE_CHANNELS.get(event)
+        with self._cond:
+            if channel:
+                key = (channel, room)
+                if key in self._queue:
+                    # Replace the older state, sent at the latest position
+                    del self._queue[key]
+                    self.stats['coalesced'] += 1
+            else:
+                self._sequence += 1
+                key = self._sequence
+            self._queue[key] = (event, data, room)
+            self.stats['queued'] += 1
+            self._cond.notify()
+
+    def add_client(self, sid, rooms=(ROOM_ALL,)):
+        with self._cond:
+            self._clients[sid] = ClientState(sid, rooms)
+
+    def set_rooms(self, sid, rooms):
+        with self._cond:
+            client = self._clients.get(sid)
+            if client:
+                client.rooms = set(rooms)
+
+    def remove_client(self, sid):
+        with self._cond:
+            self._clients.pop(sid, None)
+
+    def client_stats(self):
+        with self._cond:
+            return [{
+                'sid': c.sid,
+                'rooms': sorted(c.rooms),
+                'inflight': len(c.inflight),
+                'pending': len(c.pending),
+                'dropped': c.dropped
+            } for c in self._clients.values()]
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='socket-emitter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _on_ack(self, sid, key):
+        with self._cond:
+            client = self._clients.get(sid)
+            if client and client.inflight.pop(key, None) is not None and client.pending:
+                self._wakeup = True
+                self._cond.notify()
+
+    def _next_timeout(self):
+        """Seconds until the oldest unacknowledged event times out (None if none)"""
+        sent = [t for c in self._clients.values() if c.pending for t in c.inflight.values()]
+        if not sent:
+            return None
+        return max(0.0, min(sent) + self.ack_timeout - self.clock())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue and not self._wakeup:
+                    timeout = self._next_timeout()
+                    if timeout == 0:
+                        break
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                collecting = bool(self._queue)
+
+            if collecting:
+                # Let the burst settle, later events replace earlier states
+                time.sleep(self.window)
+
+            with self._cond:
+                batch = list(self._queue.items())
+                self._queue.clear()
+                self._wakeup = False
+                clients = list(self._clients.values())
+
+            for key, (event, data, room) in batch:
+                try:
+                    if isinstance(key, tuple):
+                        self._queue_state(clients, key, event, data, room)
+                    else:
+                        self._broadcast(event, data, room)
+                except Exception as e:
+                    logger.error(f"Fehler beim Senden von {event}: {e}")
+            for client in clients:
+                self._flush(client)
+
+    def _broadcast(self, event, data, room):
+        """Send an event to everyone in the room in one call"""
+        to = [ROOM_ALL, room] if room else None
+        if data is None:
+            self.socketio.emit(event, to=to)
+        else:
+            self.socketio.emit(event, data, to=to)
+        self.stats['sent'] += 1
+
+    def _queue_state(self, clients, key, event, data, room):
+        with self._cond:
+            for client in clients:
+                if client.wants(room):
+                    if key in client.pending:
+                        # The client has not seen the older state, drop it
+                        client.dropped += 1
+                        self.stats['dropped_stale'] += 1
+                    client.pending[key] = (event, data)
+
+    def _flush(self, client):
+        """Send the pending states a client can take now"""
+        now = self.clock()
+        with self._cond:
+            ready = []
+            for key in list(client.pending):
+                sent = client.inflight.get(key)
+                if sent is None or now - sent >= self.ack_timeout:
+                    ready.append((key,) + client.pending.pop(key))
+                    client.inflight[key] = now
+
+        for key, event, data in ready:
+            callback = lambda *args, sid=client.sid, key=key: self._on_ack(sid, key)
+            try:
+                self.socketio.emit(event, data if data is not None else {}, to=client.sid, callback=callback)
+                self.stats['sent'] += 1
+            except Exception as e:
+                logger.warning(f"Event {event} an {client.sid} nicht gesendet: {e}")
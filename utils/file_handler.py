@@ -1,14 +1,29 @@
 import os
+import hashlib
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
-def get_mp3_files(directory):
+# Audio formats that can be played after transcoding them to MP3
+SOURCE_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.aac', '.wma')
+
+# Image formats used as cover next to a song
+COVER_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+# Cache of content hashes, keyed by path, size and modification time
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def get_mp3_files(directory, extensions=('.mp3',), checkpoint=None):
     """
     Get all MP3 files from a directory.
     
     Args:
         directory (str): Path to the directory containing MP3 files
+        extensions (tuple): File extensions to include (lower case)
+        checkpoint (callable): Called before each file, lets a background
+            job pause or give up the scan
         
     Returns:
         list: List of dictionaries with song information
@@ -24,7 +39,9 @@ def get_mp3_files(directory):
         # Walk through directory and get all MP3 files
         for root, _, files in os.walk(directory):
             for file in files:
-                if file.lower().endswith('.mp3'):
+                if file.lower().endswith(extensions):
+                    if checkpoint:
+                        checkpoint()
                     full_path = os.path.join(root, file)
                     relative_path = os.path.relpath(full_path, directory)
                     base_name = os.path.splitext(file)[0]
@@ -32,11 +49,16 @@ def get_mp3_files(directory):
                     # Check for image with the same name
                     image_path = find_cover_image(directory, base_name)
                     
+                    # Artist and album from the ID3 tags, if present
+                    metadata = read_id3_tags(full_path)
+                    
                     # Basic song info
                     song_info = {
                         'filename': relative_path,
                         'title': base_name,  # Use filename as title
-                        'cover_image': image_path
+                        'cover_image': image_path,
+                        'artist': metadata.get('artist'),
+                        'album': metadata.get('album')
                     }
                     
                     songs.append(song_info)
@@ -48,6 +70,129 @@ def get_mp3_files(directory):
         logger.error(f"Error getting MP3 files: {e}")
         raise
 
+# ID3v2 text frames we are interested in (v2.3/v2.4 and v2.2 names)
+ID3_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album'
+}
+
+# Only the beginning of the tag is parsed, text frames usually come first
+ID3_MAX_READ = 64 * 1024
+
+def _decode_id3_text(data):
+    """Decode the payload of an ID3v2 text frame"""
+    if not data:
+        return None
+    encoding = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}.get(data[0], 'latin-1')
+    text = data[1:].decode(encoding, errors='replace')
+    return text.split('\x00')[0].strip() or None
+
+def read_id3_tags(path):
+    """
+    Read title, artist and album from the ID3 tags of an MP3 file.
+    
+    Args:
+        path (str): Full path of the MP3 file
+        
+    Returns:
+        dict: Found values for 'title', 'artist' and 'album'
+    """
+    tags = {}
+    
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(10)
+            
+            # ID3v2 tag at the beginning of the file
+            if len(header) == 10 and header[:3] == b'ID3':
+                version = header[3]
+                size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+                data = f.read(min(size, ID3_MAX_READ))
+                
+                id_length, header_length = (3, 6) if version == 2 else (4, 10)
+                pos = 0
+                while pos + header_length <= len(data) and len(tags) < 3:
+                    frame_id = data[pos:pos + id_length].decode('latin-1')
+                    if not frame_id.strip('\x00'):
+                        break  # Padding reached
+                    
+                    size_bytes = data[pos + id_length:pos + id_length * 2]
+                    if version == 4:
+                        frame_size = (size_bytes[0] << 21) | (size_bytes[1] << 14) | (size_bytes[2] << 7) | size_bytes[3]
+                    else:
+                        frame_size = int.from_bytes(size_bytes, 'big')
+                    
+                    payload = data[pos + header_length:pos + header_length + frame_size]
+                    if frame_id in ID3_FRAMES and ID3_FRAMES[frame_id] not in tags:
+                        value = _decode_id3_text(payload)
+                        if value:
+                            tags[ID3_FRAMES[frame_id]] = value
+                    pos += header_length + frame_size
+            
+            # Fall back to the ID3v1 tag at the end of the file
+            if len(tags) < 3:
+                f.seek(0, os.SEEK_END)
+                if f.tell() >= 128:
+                    f.seek(-128, os.SEEK_END)
+                    trailer = f.read(128)
+                    if trailer[:3] == b'TAG':
+                        for key, start in (('title', 3), ('artist', 33), ('album', 63)):
+                            value = trailer[start:start + 30].split(b'\x00')[0].decode('latin-1').strip()
+                            if value and key not in tags:
+                                tags[key] = value
+                                
+    except Exception as e:
+        logger.debug(f"Could not read ID3 tags from {path}: {e}")
+        
+    return tags
+
+# Sample rates by MPEG version (bits of the frame header) and rate index
+MPEG_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),    # MPEG-1
+    2: (22050, 24000, 16000),    # MPEG-2
+    0: (11025, 12000, 8000)      # MPEG-2.5
+}
+
+def read_mp3_format(path):
+    """
+    Read the sample rate and samples per frame from the first MPEG frame.
+
+    Args:
+        path (str): Full path of the MP3 file
+
+    Returns:
+        tuple: (sample rate, samples per frame), None if no frame header was found
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(10)
+            offset = 0
+            if len(header) == 10 and header[:3] == b'ID3':
+                offset = 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+            f.seek(offset)
+            data = f.read(ID3_MAX_READ)
+    except OSError as e:
+        logger.debug(f"Could not read MPEG header from {path}: {e}")
+        return None
+
+    pos = data.find(b'\xff')
+    while 0 <= pos < len(data) - 3:
+        version = (data[pos + 1] >> 3) & 3
+        layer = (data[pos + 1] >> 1) & 3
+        bitrate_index = data[pos + 2] >> 4
+        rate_index = (data[pos + 2] >> 2) & 3
+        if (data[pos + 1] & 0xe0 == 0xe0 and version in MPEG_SAMPLE_RATES and layer
+                and bitrate_index not in (0, 15) and rate_index != 3):
+            if layer == 3:
+                samples = 384                      # Layer I
+            elif layer == 2 or version == 3:
+                samples = 1152                     # Layer II, MPEG-1 Layer III
+            else:
+                samples = 576                      # MPEG-2/2.5 Layer III
+            return MPEG_SAMPLE_RATES[version][rate_index], samples
+        pos = data.find(b'\xff', pos + 1)
+    return None
+
 def find_cover_image(directory, base_name):
     """
     Find cover image for a song.
@@ -59,9 +204,7 @@ def find_cover_image(directory, base_name):
     Returns:
         str: Relative path to the cover image if found, None otherwise
     """
-    image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-    
-    for ext in image_extensions:
+    for ext in COVER_EXTENSIONS:
         image_name = base_name + ext
         image_path = os.path.join(directory, image_name)
         
@@ -71,6 +214,61 @@ def find_cover_image(directory, base_name):
     # No matching image found
     return None
 
+def list_files(directory, extensions):
+    """
+    List the files of a directory tree with their size and modification time.
+    
+    Hidden files and directories (starting with '.') are skipped.
+    
+    Args:
+        directory (str): Base directory
+        extensions (tuple): File extensions to include (lower case)
+        
+    Returns:
+        dict: Relative path -> os.stat_result
+    """
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if name.startswith('.') or not name.lower().endswith(extensions):
+                continue
+            full_path = os.path.join(root, name)
+            try:
+                files[os.path.relpath(full_path, directory)] = os.stat(full_path)
+            except OSError as e:
+                logger.debug(f"Could not stat {full_path}: {e}")
+    return files
+
+def content_hash(path):
+    """
+    Get the SHA-256 hash of a file's content.
+    
+    The hash is cached by path, size and modification time, so a file is
+    only read again after it changed.
+    
+    Args:
+        path (str): Full path of the file
+        
+    Returns:
+        str: Hex digest of the content
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    
+    with _hash_lock:
+        if key in _hash_cache:
+            return _hash_cache[key]
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    
+    with _hash_lock:
+        _hash_cache[key] = digest.hexdigest()
+    return _hash_cache[key]
+
 def get_file_path(base_dir, filename):
     """
     Get the full path of a file given its relative path.
@@ -0,0 +1,685 @@
+"""
+Library sync between boxes with content-defined chunks
+
+Every box can serve its music directory to other boxes under /sync and
+pull from a peer or a hub. Files are split into chunks at positions
+chosen by their content (a gear rolling hash, as in FastCDC), so an edit
+in the middle of an audiobook, a new ID3 tag or a re-cut file only
+changes the chunks around the edit; all other chunks keep their hashes.
+
+The manifest lists per file its size, modification time, SHA-256 and
+chunk hashes. A pulling box compares it with its own index, fetches only
+the chunks it does not have anywhere in its library, stages them in
+MUSIC_DIR/.sync and assembles each changed file in a temporary file that
+replaces the old one atomically after its SHA-256 was checked. An
+interrupted pull resumes with the chunks already staged.
+
+    python -m utils.fleet_sync pull http://hub:5000 [--delete]
+    python -m utils.fleet_sync self-check     # two local app instances
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+import logging
+import urllib.request
+from collections import deque
+from config import MUSIC_DIR, SYNC_TOKEN, SYNC_INDEX_FILE
+from utils.file_handler import list_files, SOURCE_EXTENSIONS, COVER_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# NumPy is optional, it only makes finding the chunk boundaries faster
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Chunks are at least CHUNK_MIN and at most CHUNK_MAX bytes, on average
+# about CHUNK_MIN + 2 ** CHUNK_AVG_BITS (320 KB)
+CHUNK_MIN = 64 * 1024
+CHUNK_AVG_BITS = 18
+CHUNK_MAX = 1024 * 1024
+CHUNKING = {'algorithm': 'gear-blake2b128', 'min': CHUNK_MIN, 'avg_bits': CHUNK_AVG_BITS, 'max': CHUNK_MAX}
+
+# The low bits of the gear hash only depend on the last few bytes, so the
+# boundary test uses the high bits
+CUT_MASK = ((1 << CHUNK_AVG_BITS) - 1) << (32 - CHUNK_AVG_BITS)
+
+# Fixed pseudo-random table, must be the same on every box
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+_GEAR_NP = np.array(GEAR, dtype=np.uint32) if np is not None else None
+
+READ_SIZE = 1024 * 1024
+
+# Upper limit of the chunk data sent in one response
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# Files that are synced
+SYNC_EXTENSIONS = SOURCE_EXTENSIONS + COVER_EXTENSIONS
+
+# Staging directory inside the music directory (same file system, so the
+# assembled files can be renamed into place)
+STAGING_DIR = '.sync'
+
+class SyncError(Exception):
+    """Raised when a pull cannot be completed"""
+
+def _chunk_digest():
+    return hashlib.blake2b(digest_size=16)
+
+class _GearScanner:
+    """
+    Finds the positions after which a chunk may end
+
+    The gear hash only depends on the last 32 bytes, so the candidates do
+    not depend on where the current chunk started and a file can be
+    scanned block by block.
+    """
+    def __init__(self):
+        self.hash = 0
+        self.tail = b''
+
+    def scan(self, block, offset):
+        """
+        Args:
+            block (bytes): Next block of the file
+            offset (int): Position of the block in the file
+
+        Returns:
+            list: End positions (exclusive) that satisfy the boundary test
+        """
+        if _GEAR_NP is not None:
+            window = self.tail + block
+            gear = _GEAR_NP[np.frombuffer(window, dtype=np.uint8)]
+            # Sum of gear[i - k] << k for k < 32, built in five doubling steps
+            hashes = gear.copy()
+            shift = 1
+            while shift < min(32, len(hashes)):
+                hashes[shift:] += hashes[:-shift] << np.uint32(shift)
+                shift *= 2
+            hits = np.flatnonzero((hashes[len(self.tail):] & CUT_MASK) == 0)
+            self.tail = window[-31:]
+            return (hits + (offset + 1)).tolist()
+
+        value = self.hash
+        hits = []
+        for index, byte in enumerate(block):
+            value = ((value << 1) + GEAR[byte]) & 0xFFFFFFFF
+            if not value & CUT_MASK:
+                hits.append(offset + index + 1)
+        self.hash = value
+        return hits
+
+def chunk_file(path):
+    """
+    Split a file into content-defined chunks.
+
+    Args:
+        path (str): Full path of the file
+
+    Returns:
+        tuple: (SHA-256 of the file, list of [chunk hash, size])
+    """
+    file_digest = hashlib.sha256()
+    chunk_digest = _chunk_digest()
+    scanner = _GearScanner()
+    candidates = deque()
+    chunks = []
+    start = position = 0
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            file_digest.update(block)
+            candidates.extend(scanner.scan(block, position))
+            end = position + len(block)
+            view = memoryview(block)
+            fed = position
+
+            while True:
+                while candidates and candidates[0] < start + CHUNK_MIN:
+                    candidates.popleft()
+                if candidates and candidates[0] <= start + CHUNK_MAX:
+                    cut = candidates.popleft()
+                elif start + CHUNK_MAX <= end:
+                    cut = start + CHUNK_MAX
+                else:
+                    break
+                chunk_digest.update(view[fed - position:cut - position])
+                chunks.append([chunk_digest.hexdigest(), cut - start])
+                chunk_digest = _chunk_digest()
+                start = fed = cut
+
+            chunk_digest.update(view[fed - position:])
+            position = end
+
+    if position > start:
+        chunks.append([chunk_digest.hexdigest(), position - start])
+    return file_digest.hexdigest(), chunks
+
+class SyncIndex:
+    """
+    Chunk lists of the files in a music directory
+
+    Entries are kept by size and modification time, so only new or
+    changed files are read again, and saved to a JSON file so a restart
+    does not chunk the whole library again. Requests are served from the
+    last finished manifest (current()); new and changed files are chunked
+    in the background.
+    """
+    def __init__(self, directory, index_file=None, max_age=10.0):
+        """
+        Args:
+            directory (str): Music directory
+            index_file (str): JSON file for the entries (None keeps them in memory)
+            max_age (float): Seconds a manifest is served before the
+                directory is checked again in the background
+        """
+        self.directory = directory
+        self.index_file = index_file
+        self.max_age = max_age
+        self._entries = {}
+        self._locations = {}
+        self._manifest = None
+        self._checked = 0
+        self._requested = 0
+        self._refresh_hook = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.index_file or not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('chunking') == CHUNKING:
+                # Served until the first check of the directory finished
+                self._entries = data.get('files', {})
+                self._publish(self._entries)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Sync-Index {self.index_file} nicht lesbar: {e}")
+
+    def _save(self):
+        if not self.index_file:
+            return
+        os.makedirs(os.path.dirname(self.index_file) or '.', exist_ok=True)
+        tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'chunking': CHUNKING, 'files': self._entries}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_file)
+
+    def _publish(self, entries):
+        """Make a manifest of the entries the one that is served"""
+        locations = {}
+        for rel_path, entry in entries.items():
+            offset = 0
+            for chunk_hash, size in entry['chunks']:
+                locations.setdefault(chunk_hash, (rel_path, offset, size))
+                offset += size
+        digest = hashlib.sha256(json.dumps(entries, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        with self._lock:
+            self._locations = locations
+            self._manifest = {'chunking': CHUNKING, 'files': entries, 'digest': digest}
+
+    def set_refresh_hook(self, hook):
+        """
+        Hand rebuilds of the manifest to a background job instead of a thread.
+
+        Args:
+            hook (callable): Called without arguments when the manifest is
+                older than max_age; it should end up calling manifest(refresh=True)
+        """
+        self._refresh_hook = hook
+
+    def current(self):
+        """
+        Get the last finished manifest without reading the directory.
+
+        If it is older than max_age, a rebuild is started in the background.
+
+        Returns:
+            dict: The manifest (see manifest()), None until the first build finished
+        """
+        now = time.monotonic()
+        if now - max(self._checked, self._requested) >= self.max_age:
+            self._requested = now
+            self._request_refresh()
+        return self._manifest
+
+    def _request_refresh(self):
+        if self._refresh_hook:
+            try:
+                self._refresh_hook()
+            except Exception as e:
+                logger.error(f"Sync-Index-Job nicht eingereiht: {e}")
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_thread, name='sync-index', daemon=True).start()
+
+    def _refresh_thread(self):
+        try:
+            self.manifest(refresh=True)
+        except Exception as e:
+            logger.error(f"Sync-Index nicht aktualisiert: {e}")
+        finally:
+            self._refreshing = False
+
+    def manifest(self, refresh=False, checkpoint=None):
+        """
+        Get the manifest of the directory, chunking new and changed files.
+
+        Reads the directory in the calling thread; request handlers use
+        current() instead.
+
+        Args:
+            refresh (bool): Check the directory even if the last check is recent
+            checkpoint (callable): Called for every file (e.g. JobContext.checkpoint)
+
+        Returns:
+            dict: chunking parameters, files (relative path -> size, mtime_ns,
+                sha256, chunks) and digest of the manifest
+        """
+        with self._build_lock:
+            if self._manifest and not refresh and time.monotonic() - self._checked < self.max_age:
+                return self._manifest
+
+            changed = False
+            entries = {}
+            for rel_path, stat in list_files(self.directory, SYNC_EXTENSIONS).items():
+                if checkpoint:
+                    checkpoint()
+                rel_path = rel_path.replace(os.sep, '/')
+                entry = self._entries.get(rel_path)
+                if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    started = time.monotonic()
+                    try:
+                        sha256, chunks = chunk_file(os.path.join(self.directory, rel_path))
+                    except OSError as e:
+                        logger.warning(f"{rel_path} nicht gelesen: {e}")
+                        continue
+                    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256, 'chunks': chunks}
+                    logger.debug(f"{rel_path}: {len(chunks)} Chunks in {time.monotonic() - started:.2f} s")
+                    changed = True
+                entries[rel_path] = entry
+
+            if changed or entries.keys() != self._entries.keys() or self._manifest is None:
+                self._entries = entries
+                self._publish(entries)
+                try:
+                    self._save()
+                except OSError as e:
+                    logger.warning(f"Sync-Index nicht gespeichert: {e}")
+            self._checked = time.monotonic()
+            return self._manifest
+
+    def locate(self, chunk_hash):
+        """Get (relative path, offset, size) of a chunk in the last manifest, None if unknown"""
+        return self._locations.get(chunk_hash)
+
+    def read_chunk(self, chunk_hash):
+        """
+        Read a chunk from the library.
+
+        Returns:
+            bytes: The chunk, None if it is unknown or the file changed
+        """
+        location = self.locate(chunk_hash)
+        if location is None:
+            return None
+        rel_path, offset, size = location
+        try:
+            with open(os.path.join(self.directory, rel_path), 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+        except OSError:
+            return None
+        return data if _verify(data, chunk_hash) else None
+
+def _verify(data, chunk_hash):
+    digest = _chunk_digest()
+    digest.update(data)
+    return digest.hexdigest() == chunk_hash
+
+def _target_path(directory, rel_path):
+    """Full path of a file from a manifest, refusing paths outside the directory"""
+    parts = rel_path.split('/')
+    if rel_path.startswith('/') or any(part in ('', '.', '..') or part.startswith('.') for part in parts):
+        raise SyncError(f"Invalid path in manifest: {rel_path}")
+    return os.path.join(directory, *parts)
+
+class SyncClient:
+    """
+    Pulls the library of a peer into a local directory
+    """
+    def __init__(self, peer, index, token=None, timeout=30):
+        """
+        Args:
+            peer (str): Base URL of the peer or hub (e.g. http://hub:5000)
+            index (SyncIndex): Index of the local music directory
+            token (str): Sync token of the peer, defaults to SYNC_TOKEN
+            timeout (float): Seconds per HTTP request
+        """
+        self.peer = peer.rstrip('/')
+        self.index = index
+        self.directory = index.directory
+        self.token = SYNC_TOKEN if token is None else token
+        self.timeout = timeout
+        self.staging = os.path.join(self.directory, STAGING_DIR)
+        self.stats = {}
+
+    def _request(self, path, body=None):
+        headers = {'Accept': 'application/json'}
+        if self.token:
+            headers['X-Sync-Token'] = self.token
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.peer + path, data=data, headers=headers)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except OSError as e:
+            raise SyncError(f"Request {path} to {self.peer} failed: {e}") from e
+
+    def fetch_manifest(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                with self._request('/sync/manifest') as response:
+                    manifest = json.load(response)
+                break
+            except SyncError as e:
+                # 503 while the peer builds its first manifest in the background
+                if getattr(e.__cause__, 'code', None) != 503 or time.monotonic() > deadline:
+                    raise
+                time.sleep(1)
+        if manifest.get('chunking') != CHUNKING:
+            raise SyncError(f"Peer uses different chunking: {manifest.get('chunking')}")
+        return manifest
+
+    def fetch_chunks(self, hashes, sizes):
+        """
+        Fetch chunks from the peer and stage them.
+
+        Args:
+            hashes (list): Chunk hashes
+            sizes (dict): Chunk hash -> size from the manifest
+        """
+        chunk_dir = os.path.join(self.staging, 'chunks')
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        batch, batch_bytes = [], 0
+        batches = []
+        for chunk_hash in hashes:
+            if batch and batch_bytes + sizes[chunk_hash] > MAX_BATCH_BYTES:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(chunk_hash)
+            batch_bytes += sizes[chunk_hash]
+        if batch:
+            batches.append(batch)
+
+        for batch in batches:
+            with self._request('/sync/chunks', {'chunks': batch}) as response:
+                sent = [h for h in response.headers.get('X-Chunks', '').split(',') if h]
+                for chunk_hash in sent:
+                    if chunk_hash not in sizes:
+                        raise SyncError(f"Peer sent unknown chunk {chunk_hash}")
+                    data = response.read(sizes[chunk_hash])
+                    if not _verify(data, chunk_hash):
+                        raise SyncError(f"Chunk {chunk_hash} is corrupt")
+                    tmp_path = os.path.join(chunk_dir, f"{chunk_hash}.tmp")
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, os.path.join(chunk_dir, chunk_hash))
+                    self.stats['chunks_fetched'] += 1
+                    self.stats['bytes_fetched'] += len(data)
+            missing = set(batch) - set(sent)
+            if missing:
+                raise SyncError(f"Peer does not have {len(missing)} chunks any more, pull again")
+
+    def _read_chunk(self, chunk_hash, size, sizes):
+        """Get a chunk from the staging directory, the local library or the peer"""
+        staged = os.path.join(self.staging, 'chunks', chunk_hash)
+        if os.path.exists(staged):
+            with open(staged, 'rb') as f:
+                return f.read()
+
+        data = self.index.read_chunk(chunk_hash)
+        if data is not None:
+            self.stats['bytes_reused'] += size
+            return data
+
+        # The local copy changed during the pull (e.g. it was replaced)
+        self.fetch_chunks([chunk_hash], sizes)
+        with open(staged, 'rb') as f:
+            return f.read()
+
+    def _assemble(self, rel_path, entry, sizes):
+        """Write a file from its chunks and move it into place"""
+        target = _target_path(self.directory, rel_path)
+        tmp_path = os.path.join(self.staging, f"{entry['sha256']}.part")
+        digest = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for chunk_hash, size in entry['chunks']:
+                data = self._read_chunk(chunk_hash, size, sizes)
+                digest.update(data)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if digest.hexdigest() != entry['sha256']:
+            os.unlink(tmp_path)
+            raise SyncError(f"{rel_path} does not match the manifest after assembly")
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.utime(tmp_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        os.replace(tmp_path, target)
+
+    def pull(self, delete=False):
+        """
+        Bring the local directory to the state of the peer.
+
+        Args:
+            delete (bool): Also remove local files the peer does not have
+
+        Returns:
+            dict: Statistics of the pull
+        """
+        started = time.monotonic()
+        self.stats = {
+            'files': 0, 'files_updated': 0, 'files_deleted': 0, 'bytes_total': 0,
+            'chunks_fetched': 0, 'bytes_fetched': 0, 'bytes_reused': 0, 'seconds': 0.0
+        }
+        remote = self.fetch_manifest()['files']
+        local = self.index.manifest(refresh=True)['files']
+        self.stats['files'] = len(remote)
+
+        changed = {rel: entry for rel, entry in remote.items()
+                   if local.get(rel, {}).get('sha256') != entry['sha256']}
+        for rel_path in changed:
+            _target_path(self.directory, rel_path)
+
+        sizes = {}
+        for entry in changed.values():
+            sizes.update((h, size) for h, size in entry['chunks'])
+            self.stats['bytes_total'] += entry['size']
+
+        chunk_dir = os.path.join(self.staging, 'chunks')
+        staged = set(os.listdir(chunk_dir)) if os.path.isdir(chunk_dir) else set()
+        missing = [h for h in sizes if h not in staged and self.index.locate(h) is None]
+        logger.info(f"Sync von {self.peer}: {len(changed)} Dateien geändert, "
+                    f"{len(missing)} von {len(sizes)} Chunks fehlen")
+        if missing:
+            self.fetch_chunks(missing, sizes)
+
+        for rel_path, entry in changed.items():
+            self._assemble(rel_path, entry, sizes)
+            self.stats['files_updated'] += 1
+
+        if delete:
+            for rel_path in set(local) - set(remote):
+                try:
+                    os.unlink(_target_path(self.directory, rel_path))
+                    self.stats['files_deleted'] += 1
+                except (OSError, SyncError) as e:
+                    logger.warning(f"{rel_path} nicht gelöscht: {e}")
+
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.index.manifest(refresh=True)
+        self.stats['seconds'] = round(time.monotonic() - started, 3)
+        logger.info(f"Sync von {self.peer} fertig: {self.stats}")
+        return self.stats
+
+def _file_hashes(manifest):
+    return {rel_path: entry['sha256'] for rel_path, entry in manifest['files'].items()}
+
+def _self_check(port=5700):
+    """
+    Run two app instances (hub and box) and pull from one to the other.
+
+    The box starts with an older copy of the library: one audiobook with
+    a chapter inserted in the middle and a new ID3 tag at the start, one
+    file missing and one file the hub no longer has.
+    """
+    global _GEAR_NP
+    import random
+    import tempfile
+    import subprocess
+
+    root = tempfile.mkdtemp(prefix='kap-sync-')
+    rng = random.Random(45)
+    def noise(size):
+        return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+    dirs = {name: os.path.join(root, name, 'music') for name in ('hub', 'box')}
+    for directory in dirs.values():
+        os.makedirs(os.path.join(directory, 'Hörbuch'))
+
+    book = noise(40 * 1024 * 1024)
+    chapter = noise(300 * 1024)
+    middle = len(book) // 2
+    files = {
+        'hub': {
+            'Hörbuch/teil1.mp3': b'ID3 new tag' + book[:middle] + chapter + book[middle:],
+            'Hörbuch/teil2.mp3': noise(6 * 1024 * 1024),
+            'lied.mp3': noise(3 * 1024 * 1024)
+        },
+        'box': {
+            'Hörbuch/teil1.mp3': book,
+            'alt.mp3': noise(2 * 1024 * 1024),
+        }
+    }
+    files['box']['lied.mp3'] = files['hub']['lied.mp3']
+    for name, contents in files.items():
+        for rel_path, data in contents.items():
+            with open(os.path.join(dirs[name], rel_path), 'wb') as f:
+                f.write(data)
+
+    # Both scanner implementations must find the same boundaries
+    if _GEAR_NP is not None:
+        sample = os.path.join(root, 'sample.bin')
+        with open(sample, 'wb') as f:
+            f.write(book[:3 * 1024 * 1024])
+        fast = chunk_file(sample)
+        saved, _GEAR_NP = _GEAR_NP, None
+        try:
+            slow = chunk_file(sample)
+        finally:
+            _GEAR_NP = saved
+        print(f"NumPy and pure Python chunking agree: {fast == slow}")
+        if fast != slow:
+            return 1
+
+    processes = []
+    for offset, name in enumerate(('hub', 'box')):
+        base = os.path.join(root, name)
+        env = dict(os.environ,
+                   MUSIC_DIR=dirs[name],
+                   DATABASE_URL=f"sqlite:///{os.path.join(base, 'db.sqlite')}",
+                   SYNC_INDEX_FILE=os.path.join(base, 'sync-index.json'),
+                   MAPPING_FILE=os.path.join(base, 'mappings.json'),
+                   CHANGE_NOTIFY_DIR=os.path.join(base, 'notify'),
+                   BUS_DIR=os.path.join(base, 'bus'),
+                   RFID_SIMULATION='1', LOUDNESS_ANALYSIS='0', LOG_LEVEL='WARNING', SYNC_ENABLED='1',
+                   JOBS_LOCK_FILE=os.path.join(base, 'jobs.lock'))
+        serve = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'serve.py')
+        processes.append(subprocess.Popen(
+            [sys.executable, serve, '--worker', 'owner', '--port', str(port + offset)], env=env))
+
+    try:
+        for offset in range(2):
+            client = SyncClient(f"http://127.0.0.1:{port + offset}", SyncIndex(root))
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    client.fetch_manifest()
+                    break
+                except SyncError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.3)
+
+        # The box pulls from the hub, as `python -m utils.fleet_sync pull` does on a box
+        box = SyncClient(f"http://127.0.0.1:{port}", SyncIndex(dirs['box']))
+        first = box.pull(delete=True)
+        second = box.pull(delete=True)
+
+        # The box serves what it pulled once its background job noticed the new files
+        hub_hashes = _file_hashes(SyncIndex(dirs['hub']).manifest())
+        deadline = time.monotonic() + 30
+        while True:
+            served = SyncClient(f"http://127.0.0.1:{port + 1}", SyncIndex(root)).fetch_manifest()
+            if _file_hashes(served) == hub_hashes or time.monotonic() > deadline:
+                break
+            time.sleep(0.5)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    same = _file_hashes(SyncIndex(dirs['box']).manifest()) == hub_hashes
+    print(f"First pull:  {first['files_updated']} files updated, {first['files_deleted']} deleted, "
+          f"{first['bytes_fetched'] / 1e6:.1f} MB fetched for {first['bytes_total'] / 1e6:.1f} MB of changed files "
+          f"({first['bytes_reused'] / 1e6:.1f} MB reused) in {first['seconds']:.2f} s")
+    print(f"Second pull: {second['files_updated']} files updated, {second['bytes_fetched']} bytes fetched")
+    print(f"Box serves the synced library: {_file_hashes(served) == hub_hashes}")
+    print(f"Libraries identical: {same}")
+    shutil.rmtree(root, ignore_errors=True)
+    return 0 if same and second['bytes_fetched'] == 0 else 1
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Sync the music library from a peer or hub")
+    commands = parser.add_subparsers(dest='command', required=True)
+    pull_parser = commands.add_parser('pull', help="pull the library of a peer")
+    pull_parser.add_argument('peer', help="base URL, e.g. http://hub:5000")
+    pull_parser.add_argument('--dir', default=MUSIC_DIR, help="music directory (default: MUSIC_DIR)")
+    pull_parser.add_argument('--delete', action='store_true', help="remove files the peer does not have")
+    check_parser = commands.add_parser('self-check', help="sync between two local app instances")
+    check_parser.add_argument('--port', type=int, default=5700)
+    args = parser.parse_args()
+
+    if args.command == 'pull':
+        index_file = SYNC_INDEX_FILE if os.path.abspath(args.dir) == os.path.abspath(MUSIC_DIR) else None
+        try:
+            stats = SyncClient(args.peer, SyncIndex(args.dir, index_file)).pull(delete=args.delete)
+        except SyncError as e:
+            logger.error(f"Sync fehlgeschlagen: {e}")
+            sys.exit(1)
+        print(json.dumps(stats, indent=2))
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
+        sys.exit(_self_check(args.port))
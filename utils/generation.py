@@ -0,0 +1,66 @@
+"""
+Generation counters for the Kids Audio Player
+
+A generation is a number that increases every time a data set changes
+(e.g. the music library or the registered RFID tags). HTTP responses use
+it to build ETags, so unchanged data can be answered with 304.
+
+Listeners are told about every bump, e.g. to notify other processes.
+Bumps that were bridged in from another process are marked as remote, so
+only the process where the change happened publishes it.
+"""
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Counters are only valid within one process lifetime, so every ETag also
+# carries the start time of the process to avoid collisions after a restart
+EPOCH = int(time.time() * 1000)
+
+LIBRARY = 'library'
+TAGS = 'tags'
+EVENTS = 'events'
+
+_generations = {}
+_listeners = []
+_lock = threading.Lock()
+
+def add_listener(listener):
+    """
+    Register a function that is called after every bump.
+
+    Args:
+        listener (callable): Called with (name, generation, keys, remote)
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def get_generation(name):
+    """Get the current generation of a data set"""
+    with _lock:
+        return _generations.get(name, 1)
+
+def bump_generation(name, keys=None, remote=False):
+    """
+    Mark a data set as changed.
+
+    Args:
+        name (str): Name of the data set (e.g. LIBRARY or TAGS)
+        keys (list): Keys of the changed entries, None if unknown
+        remote (bool): True if the change happened in another process
+
+    Returns:
+        int: The new generation
+    """
+    with _lock:
+        generation = _generations.get(name, 1) + 1
+        _generations[name] = generation
+
+    for listener in list(_listeners):
+        try:
+            listener(name, generation, keys, remote)
+        except Exception as e:
+            logger.error(f"Generation listener failed: {e}")
+    return generation
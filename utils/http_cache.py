@@ -0,0 +1,107 @@
+"""
+HTTP caching helpers: generation-based ETags and response compression
+"""
+import gzip
+import hashlib
+import json
+import logging
+from flask import request, Response
+from utils.generation import EPOCH
+
+logger = logging.getLogger(__name__)
+
+# Brotli is optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+def make_etag(name, generation, args=None):
+    """
+    Build an ETag for a data set generation and a set of query arguments.
+
+    Args:
+        name (str): Name of the data set
+        generation (int): Current generation of the data set
+        args (MultiDict): Query arguments that influence the response
+
+    Returns:
+        str: The ETag value (without quotes)
+    """
+    digest = hashlib.sha1()
+    if args:
+        for key in sorted(args.keys()):
+            for value in args.getlist(key):
+                digest.update(f"{key}={value}&".encode('utf-8'))
+    return f"{name}-{EPOCH}-{generation}-{digest.hexdigest()[:12]}"
+
+def is_not_modified(etag):
+    """Check whether the client already has the response with this ETag"""
+    return request.if_none_match.contains_weak(etag)
+
+def not_modified_response(etag):
+    """Build an empty 304 response"""
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def choose_encoding():
+    """Pick the best content encoding the client accepts"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(body, encoding):
+    """Compress a response body with the given content encoding"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+def json_response(payload, etag=None, headers=None, status=200):
+    """
+    Serialize a payload to JSON and compress it if the client supports it.
+
+    Args:
+        payload: JSON-serializable data
+        etag (str): ETag to attach to the response
+        headers (dict): Additional response headers
+        status (int): HTTP status code
+
+    Returns:
+        Response: The Flask response
+    """
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    encoding = choose_encoding() if len(body) >= COMPRESS_MIN_SIZE else None
+    if encoding:
+        body = compress(body, encoding)
+
+    response = Response(body, status=status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    if etag:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+    for key, value in (headers or {}).items():
+        if value is not None:
+            response.headers[key] = str(value)
+    return response
+
+def page_headers(next_cursor, total, generation):
+    """Response headers describing a paginated list"""
+    return {
+        'X-Next-Cursor': next_cursor,
+        'X-Total-Count': total,
+        'X-Generation': generation,
+        'X-Epoch': EPOCH
+    }
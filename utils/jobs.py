@@ -0,0 +1,635 @@
+"""
+Background jobs for the Kids Audio Player
+
+Library scans, loudness analysis and database maintenance run as jobs
+instead of on request threads. A job has a kind, JSON arguments and a
+priority (lower runs first) and is stored in the database, so jobs that
+were queued or running when the box was switched off run again after the
+next start.
+
+Jobs of a kind run either in a worker thread (light work that needs the
+app's memory, e.g. the library scan) or in a child process (CPU-heavy
+work). Both are kept away from the RFID loop and audio decoding:
+
+- worker threads and child processes run at a raised nice value
+  (JOBS_NICE)
+- CPU share: child processes are stopped and continued in a duty cycle
+  (like cpulimit), worker threads sleep in ctx.checkpoint() once they
+  used more than JOBS_CPU_SHARE of the wall time
+- pause while playing: kinds registered with pause_while_playing are not
+  started while audio plays, running child processes are stopped (with
+  their helpers such as ffmpeg, they get their own process group) and
+  threads wait in ctx.checkpoint()
+
+Only one process runs a scheduler (claim_scheduler() takes a file lock),
+since a starting scheduler requeues the jobs left running. A job is
+also only started if its row is still queued.
+"""
+import os
+import json
+import fcntl
+import time
+import heapq
+import signal
+import itertools
+import threading
+import logging
+import multiprocessing
+from collections import namedtuple, Counter
+from datetime import datetime, timedelta
+from utils import sched_policy
+from config import (JOBS_THREADS, JOBS_PROCESSES, JOBS_CPU_SHARE, JOBS_NICE,
+                    JOBS_PAUSE_WHILE_PLAYING, JOBS_MAX_ATTEMPTS, JOBS_LOCK_FILE)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+# Period of the stop/continue cycle that limits the CPU share of processes
+DUTY_PERIOD = 0.1
+
+# How often the playback state is checked
+PLAYING_CHECK_INTERVAL = 0.25
+
+# Open lock file of claim_scheduler(), held until the process exits
+_scheduler_lock = None
+
+JobKind = namedtuple('JobKind', ['name', 'func', 'priority', 'process', 'pause_while_playing', 'on_result'])
+
+class JobCancelled(Exception):
+    """Raised in a job when the scheduler shuts down"""
+
+class Job:
+    """
+    A queued or running job
+    """
+    def __init__(self, job_id, kind, args, priority, key=None, attempts=0):
+        self.id = job_id
+        self.kind = kind
+        self.args = args
+        self.priority = priority
+        self.key = key
+        self.attempts = attempts
+        self.started = None
+        self.process = None
+        self.stopped = False
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'key': self.key,
+            'priority': self.priority,
+            'attempts': self.attempts,
+            'running_s': round(time.monotonic() - self.started, 1) if self.started else None,
+            'pid': self.process.pid if self.process else None,
+            'stopped': self.stopped
+        }
+
+class JobContext:
+    """
+    Passed to thread jobs; checkpoint() should be called regularly
+    """
+    def __init__(self, scheduler, job, kind):
+        self.scheduler = scheduler
+        self.job = job
+        self.kind = kind
+        self._reset()
+
+    def _reset(self):
+        self._cpu_start = time.thread_time()
+        self._wall_start = time.monotonic()
+
+    def checkpoint(self):
+        """
+        Wait while audio plays and sleep off CPU time above the share.
+
+        Raises:
+            JobCancelled: If the scheduler is shutting down
+        """
+        if self.scheduler.wait_unpaused(self.kind):
+            self._reset()
+        if not self.scheduler.running:
+            raise JobCancelled()
+
+        share = self.scheduler.cpu_share
+        if share < 1:
+            used = time.thread_time() - self._cpu_start
+            elapsed = time.monotonic() - self._wall_start
+            if used > share * elapsed:
+                time.sleep(used / share - elapsed)
+
+def _process_main(conn, func, args, nice):
+    """Entry point of a job's child process"""
+    # Own process group, so stop and continue also reach helpers like ffmpeg
+    os.setpgrp()
+    try:
+        os.nice(nice)
+    except OSError:
+        pass
+    sched_policy.apply(sched_policy.BACKGROUND)
+    try:
+        conn.send(('ok', func(**args)))
+    except Exception as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+def claim_scheduler(path=JOBS_LOCK_FILE):
+    """
+    Make this process the one that runs background jobs.
+
+    The lock is released by the kernel when the process exits.
+
+    Returns:
+        bool: True if no other process holds the lock
+    """
+    global _scheduler_lock
+    if _scheduler_lock is not None:
+        return True
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    handle = open(path, 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        logger.info(f"Job-Scheduler läuft in einem anderen Prozess ({path})")
+        return False
+    _scheduler_lock = handle
+    return True
+
+def _demoted(func, on_result):
+    """Wrap a process job function so it runs as a thread job"""
+    def run(ctx, **args):
+        result = func(**args)
+        if on_result:
+            on_result(args, result)
+    return run
+
+class JobScheduler:
+    """
+    Priority queue of persistent jobs with bounded thread and process workers
+    """
+    def __init__(self, app, is_playing=None, threads=JOBS_THREADS, processes=JOBS_PROCESSES,
+                 cpu_share=JOBS_CPU_SHARE, nice=JOBS_NICE, max_attempts=JOBS_MAX_ATTEMPTS):
+        """
+        Args:
+            app: Flask app (for the database)
+            is_playing (callable): Returns True while audio plays
+            threads (int): Worker threads for thread jobs
+            processes (int): Child processes running at the same time
+            cpu_share (float): Share of the CPU jobs may use (0..1)
+            nice (int): Nice value of the workers
+            max_attempts (int): Starts of a job before it counts as failed
+                (jobs interrupted by a restart are started again)
+        """
+        self.app = app
+        self.is_playing = is_playing if JOBS_PAUSE_WHILE_PLAYING else None
+        self.thread_count = max(1, threads)
+        self.process_count = max(0, processes)
+        self.cpu_share = min(1.0, max(0.05, cpu_share))
+        self.nice = nice
+        self.max_attempts = max_attempts
+        self.kinds = {}
+        self.playing = False
+        self.running = False
+        self._queues = {False: [], True: []}   # process? -> heap of (priority, sequence, job)
+        self._keys = {}                        # key -> job id of queued or running jobs
+        self._active = {}                      # job id -> running Job
+        self._periodic = []                    # [interval, next due, kind, args, priority]
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._submit_lock = threading.Lock()
+        self._threads = []
+        self._context = multiprocessing.get_context('fork')
+        self.stats = Counter()
+
+    def register(self, kind, func, priority=PRIORITY_NORMAL, process=False, pause_while_playing=True, on_result=None):
+        """
+        Register a kind of job.
+
+        Args:
+            kind (str): Name of the kind (stored with the jobs)
+            func (callable): Thread jobs: func(ctx, **args); process jobs:
+                func(**args), a module-level function returning a picklable result
+            priority (int): Default priority (PRIORITY_HIGH .. PRIORITY_LOW)
+            process (bool): Run in a child process
+            pause_while_playing (bool): Hold the job while audio plays
+            on_result (callable): Called with (args, result) in the
+                scheduler after a process job finished
+        """
+        if process and not self.process_count:
+            # No child processes: run it in a worker thread, with the same
+            # func(**args) -> on_result(args, result) convention
+            func = _demoted(func, on_result)
+            process, on_result = False, None
+        self.kinds[kind] = JobKind(kind, func, priority, process, pause_while_playing, on_result)
+
+    def every(self, seconds, kind, args=None, priority=None, first=None):
+        """
+        Submit a job periodically (not persisted, register again on start).
+
+        Args:
+            seconds (float): Interval
+            first (float): Delay of the first submission, defaults to the interval
+        """
+        due = time.monotonic() + (seconds if first is None else first)
+        self._periodic.append([seconds, due, kind, args, priority])
+
+    def submit(self, kind, args=None, priority=None, key=None):
+        """
+        Queue a job.
+
+        Args:
+            kind (str): Registered kind
+            args (dict): JSON-serializable arguments
+            priority (int): Overrides the default priority of the kind
+            key (str): Jobs with the same key are only queued once
+
+        Returns:
+            int: ID of the job (of the existing one for a known key)
+        """
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown job kind: {kind}")
+        priority = self.kinds[kind].priority if priority is None else priority
+        args = args or {}
+
+        with self._submit_lock:
+            with self._cond:
+                if key and key in self._keys:
+                    return self._keys[key]
+
+            from models import BackgroundJob, db
+            with self.app.app_context():
+                row = BackgroundJob(kind=kind, key=key, args=json.dumps(args), priority=priority, state='queued')
+                db.session.add(row)
+                db.session.commit()
+                job_id = row.id
+
+            self._enqueue(Job(job_id, kind, args, priority, key))
+            self.stats['submitted'] += 1
+            return job_id
+
+    def _enqueue(self, job):
+        with self._cond:
+            process = self.kinds[job.kind].process if job.kind in self.kinds else False
+            heapq.heappush(self._queues[process], (job.priority, next(self._sequence), job))
+            if job.key:
+                self._keys[job.key] = job.id
+            self._cond.notify_all()
+
+    def _load(self):
+        """Queue the jobs a previous run left unfinished"""
+        from models import BackgroundJob, db
+        with self.app.app_context():
+            rows = BackgroundJob.query.filter(BackgroundJob.state.in_(['queued', 'running'])).all()
+            resumed = 0
+            for row in rows:
+                if row.kind not in self.kinds:
+                    row.state, row.error = 'failed', 'Unknown job kind'
+                elif row.state == 'running' and row.attempts >= self.max_attempts:
+                    row.state, row.error = 'failed', 'Interrupted too often'
+                else:
+                    row.state = 'queued'
+                    self._enqueue(Job(row.id, row.kind, json.loads(row.args or '{}'), row.priority, row.key, row.attempts))
+                    resumed += 1
+                row.updated_at = datetime.utcnow()
+            db.session.commit()
+        if resumed:
+            logger.info(f"{resumed} Hintergrund-Jobs vom letzten Lauf fortgesetzt")
+
+    def _claim(self, job):
+        """Mark a queued job as running, False if its row is not queued any more"""
+        from models import BackgroundJob, db
+        try:
+            with self.app.app_context():
+                claimed = BackgroundJob.query.filter_by(id=job.id, state='queued').update(
+                    {'state': 'running', 'attempts': job.attempts, 'updated_at': datetime.utcnow()},
+                    synchronize_session=False)
+                db.session.commit()
+            return claimed == 1
+        except Exception as e:
+            logger.error(f"Job {job.id} nicht gespeichert: {e}")
+            return True
+
+    def _update(self, job, **fields):
+        from models import BackgroundJob, db
+        try:
+            with self.app.app_context():
+                row = db.session.get(BackgroundJob, job.id)
+                if row:
+                    for name, value in fields.items():
+                        setattr(row, name, value)
+                    row.updated_at = datetime.utcnow()
+                    db.session.commit()
+        except Exception as e:
+            logger.error(f"Job {job.id} nicht gespeichert: {e}")
+
+    def start(self):
+        """Resume unfinished jobs and start the workers"""
+        if self.running:
+            return
+        self.running = True
+        self._load()
+        workers = [False] * self.thread_count + [True] * self.process_count
+        for index, process in enumerate(workers):
+            thread = threading.Thread(target=self._worker, args=(process,), daemon=True,
+                                      name=f"job-{'process' if process else 'thread'}-{index}")
+            thread.start()
+            self._threads.append(thread)
+        monitor = threading.Thread(target=self._monitor, name='job-monitor', daemon=True)
+        monitor.start()
+        self._threads.append(monitor)
+        logger.info(f"Job-Scheduler gestartet ({self.thread_count} Threads, {self.process_count} Prozesse, "
+                    f"CPU-Anteil {self.cpu_share:.0%})")
+
+    def stop(self):
+        """
+        Stop the workers. Running jobs are interrupted and run again after
+        the next start.
+        """
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+            active = list(self._active.values())
+        for job in active:
+            self._signal(job, signal.SIGCONT)
+            self._signal(job, signal.SIGTERM)
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def wait_unpaused(self, kind):
+        """
+        Block while audio plays if the kind pauses for playback.
+
+        Returns:
+            bool: True if it had to wait
+        """
+        waited = False
+        with self._cond:
+            while self.running and self.playing and kind.pause_while_playing:
+                waited = True
+                self._cond.wait(0.5)
+        return waited
+
+    def _take(self, process):
+        """Get the most urgent job a worker may start now, None on shutdown"""
+        with self._cond:
+            while self.running:
+                queue = self._queues[process]
+                held = []
+                job = None
+                while queue:
+                    entry = heapq.heappop(queue)
+                    if self.playing and self.kinds[entry[2].kind].pause_while_playing:
+                        held.append(entry)
+                    else:
+                        job = entry[2]
+                        break
+                for entry in held:
+                    heapq.heappush(queue, entry)
+                if job:
+                    job.started = time.monotonic()
+                    job.attempts += 1
+                    self._active[job.id] = job
+                    return job
+                self._cond.wait(1.0)
+        return None
+
+    def _finish(self, job, state, error=None):
+        with self._cond:
+            self._active.pop(job.id, None)
+            if job.key and self._keys.get(job.key) == job.id:
+                del self._keys[job.key]
+            self._cond.notify_all()
+        self._update(job, state=state, error=error)
+        self.stats[state] += 1
+        runtime = time.monotonic() - job.started
+        if state == 'failed':
+            logger.warning(f"Job {job.kind} #{job.id} fehlgeschlagen nach {runtime:.1f} s: {error}")
+        else:
+            logger.debug(f"Job {job.kind} #{job.id} fertig in {runtime:.1f} s")
+
+    def _worker(self, process):
+        if not process:
+            # Only this thread, the Linux scheduler treats threads as tasks
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+            except (OSError, AttributeError) as e:
+                logger.debug(f"Could not lower job thread priority: {e}")
+            sched_policy.apply_to_thread(sched_policy.BACKGROUND)
+
+        while True:
+            job = self._take(process)
+            if job is None:
+                return
+            kind = self.kinds[job.kind]
+            if not self._claim(job):
+                logger.warning(f"Job {job.kind} #{job.id} läuft schon in einem anderen Prozess")
+                with self._cond:
+                    self._active.pop(job.id, None)
+                    if job.key and self._keys.get(job.key) == job.id:
+                        del self._keys[job.key]
+                continue
+            try:
+                if process:
+                    result = self._run_process(job, kind)
+                    if kind.on_result:
+                        kind.on_result(job.args, result)
+                else:
+                    kind.func(JobContext(self, job, kind), **job.args)
+            except JobCancelled:
+                # Left as running, so the next start runs it again
+                with self._cond:
+                    self._active.pop(job.id, None)
+                continue
+            except Exception as e:
+                self._finish(job, 'failed', str(e))
+                continue
+            self._finish(job, 'done')
+
+    def _run_process(self, job, kind):
+        receiver, sender = self._context.Pipe(duplex=False)
+        child = self._context.Process(target=_process_main, args=(sender, kind.func, job.args, self.nice), daemon=True)
+        child.start()
+        sender.close()
+        job.process = child
+        try:
+            while True:
+                if receiver.poll(0.2):
+                    status, value = receiver.recv()
+                    break
+                if not self.running:
+                    raise JobCancelled()
+                if not child.is_alive() and not receiver.poll(0):
+                    raise RuntimeError(f"Worker process exited with {child.exitcode}")
+        except EOFError:
+            if not self.running:
+                raise JobCancelled()
+            raise RuntimeError(f"Worker process exited with {child.exitcode}")
+        finally:
+            self._signal(job, signal.SIGCONT)
+            if child.is_alive() and not self.running:
+                self._signal(job, signal.SIGTERM)
+            child.join(timeout=1)
+            receiver.close()
+            job.process = None
+
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
+
+    def _signal(self, job, signum):
+        """Send a signal to the process group of a job's child process"""
+        child = job.process
+        if child is None or child.pid is None:
+            return
+        try:
+            os.killpg(child.pid, signum)
+            if signum == signal.SIGSTOP:
+                job.stopped = True
+            elif signum == signal.SIGCONT:
+                job.stopped = False
+        except (ProcessLookupError, PermissionError):
+            # Not started yet or already gone
+            pass
+
+    def _check_playing(self):
+        try:
+            playing = bool(self.is_playing and self.is_playing())
+        except Exception as e:
+            logger.debug(f"Playback state unknown: {e}")
+            playing = False
+        if playing != self.playing:
+            with self._cond:
+                self.playing = playing
+                self._cond.notify_all()
+            logger.debug(f"Hintergrund-Jobs {'pausiert' if playing else 'fortgesetzt'}")
+
+    def _monitor(self):
+        """Playback state, periodic jobs and the CPU duty cycle of child processes"""
+        last_check = 0
+        while self.running:
+            now = time.monotonic()
+            if now - last_check >= PLAYING_CHECK_INTERVAL:
+                self._check_playing()
+                last_check = now
+
+            for entry in self._periodic:
+                interval, due, kind, args, priority = entry
+                if now >= due:
+                    entry[1] = now + interval
+                    try:
+                        self.submit(kind, args, priority, key=f"periodic:{kind}")
+                    except Exception as e:
+                        logger.error(f"Periodischer Job {kind} nicht eingereiht: {e}")
+
+            with self._cond:
+                children = [job for job in self._active.values() if job.process]
+            held = [job for job in children if self.playing and self.kinds[job.kind].pause_while_playing]
+            runnable = [job for job in children if job not in held]
+            for job in held:
+                self._signal(job, signal.SIGSTOP)
+            for job in runnable:
+                self._signal(job, signal.SIGCONT)
+
+            if runnable and self.cpu_share < 1:
+                time.sleep(DUTY_PERIOD * self.cpu_share)
+                for job in runnable:
+                    if self.running:
+                        self._signal(job, signal.SIGSTOP)
+                time.sleep(DUTY_PERIOD * (1 - self.cpu_share))
+            else:
+                time.sleep(DUTY_PERIOD)
+
+    def status(self):
+        """Queue lengths, running jobs and counters"""
+        with self._cond:
+            queued = Counter(entry[2].kind for queue in self._queues.values() for entry in queue)
+            running = [job.describe() for job in self._active.values()]
+        return {
+            'playing': self.playing,
+            'cpu_share': self.cpu_share,
+            'nice': self.nice,
+            'queued': dict(queued),
+            'running': running,
+            'stats': dict(self.stats)
+        }
+
+    def prune(self, days=7):
+        """Delete finished jobs older than some days"""
+        from models import BackgroundJob, db
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        with self.app.app_context():
+            count = BackgroundJob.query.filter(
+                BackgroundJob.state.in_(['done', 'failed']),
+                BackgroundJob.updated_at < cutoff
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        return count
+
+def _busy(seconds):
+    """CPU-bound work for the load test"""
+    end = time.process_time() + seconds
+    value = 0
+    while time.process_time() < end:
+        value += sum(i * i for i in range(1000))
+    return value
+
+def _thread_busy(ctx, seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        sum(i * i for i in range(1000))
+        ctx.checkpoint()
+
+def _measure_loop(duration, interval=0.01):
+    """Lateness of a 10 ms periodic loop (like the RFID poll) in ms"""
+    late = []
+    end = time.monotonic() + duration
+    next_wake = time.monotonic() + interval
+    while time.monotonic() < end:
+        time.sleep(max(0.0, next_wake - time.monotonic()))
+        late.append((time.monotonic() - next_wake) * 1000)
+        next_wake += interval
+    late.sort()
+    return late[len(late) // 2], late[int(len(late) * 0.99)], late[-1]
+
+if __name__ == '__main__':
+    # Load test: how late does a 10 ms loop (standing in for the RFID
+    # poll) wake up while CPU-heavy work runs inline or as jobs?
+    import tempfile
+    from flask import Flask
+    from db import db
+
+    logging.basicConfig(level=logging.WARNING)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tempfile.mkdtemp()}/jobs.db"
+    db.init_app(app)
+    from models import BackgroundJob
+    with app.app_context():
+        BackgroundJob.__table__.create(db.engine)
+
+    duration = 4.0
+    print(f"{os.cpu_count()} CPU cores, lateness of a 10 ms loop over {duration:.0f} s")
+    print(f"{'work':<36} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    print(f"{'none':<36} {'%7.2f %7.2f %7.2f' % _measure_loop(duration)}")
+
+    worker = threading.Thread(target=_busy, args=(duration,), daemon=True)
+    worker.start()
+    print(f"{'inline thread, no limits':<36} {'%7.2f %7.2f %7.2f' % _measure_loop(duration)}")
+    worker.join()
+
+    for label, process in (('thread job (nice, 50% share)', False), ('process job (nice, 50% share)', True)):
+        scheduler = JobScheduler(app, threads=1, processes=1, cpu_share=0.5)
+        if process:
+            scheduler.register('busy', _busy, process=True)
+        else:
+            scheduler.register('busy', _thread_busy)
+        scheduler.start()
+        scheduler.submit('busy', {'seconds': duration * 2})
+        time.sleep(0.2)
+        print(f"{label:<36} {'%7.2f %7.2f %7.2f' % _measure_loop(duration)}")
+        scheduler.stop()
@@ -0,0 +1,174 @@
+"""
+Music library for the Kids Audio Player
+
+Keeps the result of scanning the music directory in memory. The directory
+tree is only rescanned when one of its folders changed, and every change
+bumps the library generation. The differences between the scans are kept
+for a while, so clients can fetch only what changed since their copy.
+"""
+import os
+import threading
+import time
+import logging
+from collections import deque
+from utils.file_handler import get_mp3_files
+from utils.generation import LIBRARY, get_generation, bump_generation
+
+logger = logging.getLogger(__name__)
+
+# Number of rescans whose differences are kept for changes_since()
+CHANGE_LOG_SIZE = 50
+
+class Library:
+    """
+    Cached view of the MP3 files in a directory
+    """
+    def __init__(self, directory, check_interval=2.0, extensions=('.mp3',)):
+        self.directory = directory
+        self.extensions = extensions
+        self.check_interval = check_interval
+        self._songs = []
+        self._signature = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self._changes = deque()    # (generation, {filename: song or None})
+        self._base_generation = None
+        self._scan_hook = None
+
+    def set_scan_hook(self, hook):
+        """
+        Hand rescans to a background job instead of running them inline.
+
+        Args:
+            hook (callable): Called without arguments when the directory
+                changed; it should end up calling scan(). The first scan
+                still runs inline, so there is always a list to serve.
+        """
+        self._scan_hook = hook
+
+    def _compute_signature(self):
+        """
+        Build a cheap signature of the directory tree.
+
+        Adding, removing or renaming a file changes the modification time
+        of its folder, so the folder mtimes are enough to detect changes.
+        """
+        signature = []
+        for root, _, _ in os.walk(self.directory):
+            try:
+                signature.append((root, os.stat(root).st_mtime_ns))
+            except OSError:
+                continue
+        return tuple(sorted(signature))
+
+    def refresh(self, force=False):
+        """
+        Rescan the directory if it changed since the last scan.
+
+        Args:
+            force (bool): Check the directory even if the check interval
+                has not passed yet
+
+        Returns:
+            int: The current library generation
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._signature is not None and now - self._last_check < self.check_interval:
+                return get_generation(LIBRARY)
+            self._last_check = now
+
+            signature = self._compute_signature()
+            if signature == self._signature:
+                return get_generation(LIBRARY)
+
+            if self._scan_hook and self._signature is not None:
+                # Serve the previous list until the job has rescanned
+                self._scan_hook()
+                return get_generation(LIBRARY)
+
+            songs = get_mp3_files(self.directory, self.extensions)
+            return self._apply_scan(signature, songs)
+
+    def scan(self, checkpoint=None):
+        """
+        Rescan the directory now, reading the files outside the lock.
+
+        Args:
+            checkpoint (callable): Called for every file (see get_mp3_files)
+
+        Returns:
+            int: The current library generation
+        """
+        signature = self._compute_signature()
+        if signature == self._signature:
+            return get_generation(LIBRARY)
+        songs = get_mp3_files(self.directory, self.extensions, checkpoint)
+        with self._lock:
+            self._last_check = time.monotonic()
+            return self._apply_scan(signature, songs)
+
+    def _apply_scan(self, signature, songs):
+        """Replace the song list and log the differences (lock held)"""
+        diff = self._diff(self._songs, songs) if self._signature is not None else None
+        self._songs = songs
+        self._signature = signature
+        generation = bump_generation(LIBRARY, list(diff) if diff is not None else None)
+        self._log_changes(generation, diff)
+        logger.info(f"Library rescanned: {len(self._songs)} songs (generation {generation})")
+        return generation
+
+    @staticmethod
+    def _diff(old, new):
+        """Changed songs between two scans: filename -> song (None if removed)"""
+        old_by_name = {song['filename']: song for song in old}
+        diff = {}
+        for song in new:
+            if old_by_name.pop(song['filename'], None) != song:
+                diff[song['filename']] = song
+        for filename in old_by_name:
+            diff[filename] = None
+        return diff
+
+    def _log_changes(self, generation, diff):
+        if diff is None:
+            # First scan, there is nothing to compare with
+            self._changes.clear()
+            self._base_generation = generation
+            return
+        self._changes.append((generation, diff))
+        while len(self._changes) > CHANGE_LOG_SIZE:
+            self._base_generation = self._changes.popleft()[0]
+
+    def changes_since(self, generation):
+        """
+        Get the songs that changed after a generation.
+
+        Args:
+            generation (int): Library generation the client has
+
+        Returns:
+            tuple: (changed songs, removed filenames), or None if the
+                generation is too old or unknown and the full list is needed
+        """
+        self.refresh()
+        with self._lock:
+            if self._base_generation is None or not self._base_generation <= generation <= get_generation(LIBRARY):
+                return None
+            merged = {}
+            for change_generation, diff in self._changes:
+                if change_generation > generation:
+                    merged.update(diff)
+        upserts = [song for song in merged.values() if song is not None]
+        removed = [filename for filename, song in merged.items() if song is None]
+        return upserts, removed
+
+    def get_songs(self):
+        """Get the list of songs, rescanning if necessary"""
+        self.refresh()
+        return self._songs
+
+    @property
+    def generation(self):
+        """The current library generation"""
+        return get_generation(LIBRARY)
@@ -0,0 +1,260 @@
+"""
+Non-blocking logging for the Kids Audio Player
+
+Threads that log (e.g. the RFID poll loop) only put the record into a
+queue; a background listener formats the records and writes them in
+batches, flushing the output once per batch. If the queue is full, records
+are dropped instead of blocking the caller. The last records are also kept
+in memory for the /debug/logs endpoint.
+
+Per-poll messages should go through throttled(), which logs a message at
+most once per interval and counts the suppressed ones.
+"""
+import sys
+import time
+import atexit
+import queue
+import threading
+import logging
+from collections import deque
+from utils import sched_policy
+from config import LOG_LEVEL, LOG_FILE, LOG_QUEUE_SIZE, LOG_RING_SIZE
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Maximum number of records written before the output is flushed
+BATCH_SIZE = 256
+
+_STOP = object()
+
+class DroppingQueueHandler(logging.Handler):
+    """
+    Puts records into a queue without ever blocking
+    """
+    def __init__(self, log_queue):
+        super().__init__()
+        self.queue = log_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            # Resolve the message now, the arguments may change later;
+            # formatting happens in the listener thread
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class BatchStreamHandler(logging.StreamHandler):
+    """
+    Stream handler that only flushes when the listener finished a batch
+    """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        with self.lock:
+            if self.stream and hasattr(self.stream, 'flush'):
+                self.stream.flush()
+
+class BatchFileHandler(logging.FileHandler):
+    """
+    File handler that only flushes when the listener finished a batch
+    """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        with self.lock:
+            if self.stream:
+                self.stream.flush()
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last records in memory
+    """
+    def __init__(self, capacity):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+        self.sequence = 0
+
+    def emit(self, record):
+        self.sequence += 1
+        self.records.append({
+            'seq': self.sequence,
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage() + (f"\n{record.exc_text}" if record.exc_text else '')
+        })
+
+    def get_records(self, limit=100, level=logging.NOTSET, since=0):
+        """
+        Get the newest records.
+
+        Args:
+            limit (int): Maximum number of records
+            level (int): Minimum level
+            since (int): Only records with a higher sequence number
+
+        Returns:
+            list: Records as dicts, oldest first
+        """
+        with self.lock:
+            records = [r for r in self.records
+                       if r['seq'] > since and logging.getLevelName(r['level']) >= level]
+        return records[-limit:] if limit else records
+
+class LogPipeline:
+    """
+    Queue, listener thread and output handlers
+    """
+    def __init__(self, level=logging.INFO, log_file=None, queue_size=10000, ring_size=1000):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.ring = RingBufferHandler(ring_size)
+
+        formatter = logging.Formatter(LOG_FORMAT)
+        self.outputs = [BatchStreamHandler(sys.stderr)]
+        if log_file:
+            self.outputs.append(BatchFileHandler(log_file, encoding='utf-8'))
+        for handler in self.outputs:
+            handler.setFormatter(formatter)
+        self.level = level
+        self.thread = None
+        self._reported_drops = 0
+
+    def start(self):
+        """Route the root logger through the queue and start the listener"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+
+        self.thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the remaining records and stop the listener"""
+        if self.thread:
+            self.queue.put(_STOP)
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def _handle(self, record):
+        self.ring.handle(record)
+        for handler in self.outputs:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        # Writes to the SD card must not hold up playback or the reader
+        sched_policy.apply_to_thread(sched_policy.BACKGROUND)
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+
+            batch = [record]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                    continue
+                try:
+                    self._handle(record)
+                except Exception:
+                    pass
+            dropped = self.queue_handler.dropped
+            if dropped != self._reported_drops:
+                self._handle(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"{dropped - self._reported_drops} log records dropped, queue was full"
+                }))
+                self._reported_drops = dropped
+            for handler in self.outputs:
+                handler.flush_batch()
+            if stop:
+                break
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def setup_logging(level=None):
+    """
+    Set up the logging pipeline once per process.
+
+    Args:
+        level: Log level, defaults to LOG_LEVEL from the configuration
+
+    Returns:
+        LogPipeline: The pipeline
+    """
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LogPipeline(
+                level=level or LOG_LEVEL,
+                log_file=LOG_FILE,
+                queue_size=LOG_QUEUE_SIZE,
+                ring_size=LOG_RING_SIZE
+            )
+            _pipeline.start()
+            atexit.register(_pipeline.stop)
+        elif level:
+            logging.getLogger().setLevel(level)
+        return _pipeline
+
+def get_pipeline():
+    """Get the logging pipeline (None if setup_logging was not called)"""
+    return _pipeline
+
+_throttle_state = {}
+_throttle_lock = threading.Lock()
+
+def throttled(logger, key, message, interval=5.0, level=logging.DEBUG):
+    """
+    Log a message at most once per interval.
+
+    Meant for messages in poll loops. The number of messages suppressed
+    since the last one is appended.
+
+    Args:
+        logger: Logger to log to
+        key (str): Messages with the same key share one limit
+        message (str): The message
+        interval (float): Minimum seconds between two messages
+        level (int): Log level
+
+    Returns:
+        bool: True if the message was logged
+    """
+    if not logger.isEnabledFor(level):
+        return False
+
+    now = time.monotonic()
+    with _throttle_lock:
+        last, suppressed = _throttle_state.get(key, (None, 0))
+        if last is not None and now - last < interval:
+            _throttle_state[key] = (last, suppressed + 1)
+            return False
+        _throttle_state[key] = (now, 0)
+
+    if suppressed:
+        message = f"{message} ({suppressed} ähnliche Meldungen unterdrückt)"
+    logger.log(level, message)
+    return True
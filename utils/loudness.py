@@ -0,0 +1,354 @@
+"""
+Loudness analysis for the Kids Audio Player
+
+Every track is decoded once in a low-priority worker process and its
+integrated loudness (EBU R128 / ReplayGain 2.0 style) is stored in the
+database. Playback uses the stored value to scale the track to a common
+target loudness.
+"""
+import os
+import re
+import math
+import array
+import shutil
+import subprocess
+import threading
+import logging
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from utils import sched_policy
+from config import LOUDNESS_TARGET_LUFS, LOUDNESS_MAX_GAIN_DB, LOUDNESS_NICE
+
+logger = logging.getLogger(__name__)
+
+# NumPy or audioop speed up the fallback analysis, both are optional
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop  # Removed in Python 3.13
+except ImportError:
+    audioop = None
+
+# Sample rate used by the fallback analysis (mono, 16 bit)
+FALLBACK_RATE = 11025
+
+# Gating block length and thresholds from ITU-R BS.1770
+BLOCK_SECONDS = 0.4
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+_INTEGRATED_RE = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+_PEAK_RE = re.compile(r'Peak:\s+(-?[\d.]+|-inf) dBFS')
+
+def _lower_priority():
+    """Initializer for worker processes, keeps them away from playback and RFID"""
+    try:
+        os.nice(LOUDNESS_NICE)
+    except OSError as e:
+        logger.debug(f"Could not lower worker priority: {e}")
+    sched_policy.apply(sched_policy.BACKGROUND)
+
+def _analyze_ffmpeg(path):
+    """Measure loudness with the ebur128 filter of ffmpeg"""
+    result = subprocess.run(
+        ['ffmpeg', '-nostats', '-hide_banner', '-i', path,
+         '-af', 'ebur128=peak=true:framelog=verbose', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True
+    )
+    output = result.stderr.decode('utf-8', errors='replace')
+    integrated = _INTEGRATED_RE.findall(output)
+    if not integrated:
+        raise ValueError("ffmpeg did not report an integrated loudness")
+    peaks = _PEAK_RE.findall(output)
+    peak = float(peaks[-1]) if peaks and peaks[-1] != '-inf' else None
+    return float(integrated[-1]), peak
+
+def _analyze_mpg123(path):
+    """
+    Approximate the loudness from PCM decoded by mpg123.
+
+    The signal is mixed to mono and resampled to a low rate, and the
+    K-weighting filter is skipped. The gating follows BS.1770, so the
+    result is close enough to pick a playback gain.
+
+    The PCM is read block by block, so memory use does not depend on the
+    length of the track.
+    """
+    command = ['mpg123', '-q', '-s', '-m', '-r', str(FALLBACK_RATE), '-e', 's16', path]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    block_bytes = int(FALLBACK_RATE * BLOCK_SECONDS) * 2
+    powers = []
+    peak = 0
+    decoded = 0
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % 2]
+            decoded += len(data)
+            power, block_peak = _block_power(data)
+            peak = max(peak, block_peak)
+            # A short last block is only used for the peak
+            if len(data) == block_bytes:
+                powers.append(power)
+    finally:
+        process.stdout.close()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    if not decoded:
+        raise ValueError("mpg123 did not decode any samples")
+
+    peak_dbfs = 20 * math.log10(peak / 32768.0) if peak > 0 else None
+    return gated_loudness(powers), peak_dbfs
+
+def _block_power(data):
+    """
+    Mean-square power and peak of a block of 16 bit samples.
+
+    Returns:
+        tuple: (power relative to full scale, peak as absolute sample value)
+    """
+    count = len(data) // 2
+    if not count:
+        return 0.0, 0
+    if np is not None:
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float64)
+        return float(np.dot(samples, samples)) / count / (32768.0 * 32768.0), int(np.abs(samples).max())
+    if audioop is not None:
+        rms = audioop.rms(data, 2)
+        return (rms / 32768.0) ** 2, audioop.max(data, 2)
+    samples = array.array('h')
+    samples.frombytes(data)
+    return math.fsum(x * x for x in samples) / count / (32768.0 * 32768.0), max(max(samples), -min(samples))
+
+def gated_loudness(powers):
+    """
+    Compute the integrated loudness of a list of block mean-square powers.
+
+    Returns:
+        float: Loudness in LUFS, or None if the track is silent
+    """
+    def to_lufs(power):
+        return -0.691 + 10 * math.log10(power)
+
+    gated = [p for p in powers if p > 0 and to_lufs(p) > ABSOLUTE_GATE_LUFS]
+    if not gated:
+        return None
+
+    relative_gate = to_lufs(sum(gated) / len(gated)) + RELATIVE_GATE_LU
+    gated = [p for p in gated if to_lufs(p) > relative_gate]
+    return to_lufs(sum(gated) / len(gated))
+
+def analyze_file(path):
+    """
+    Measure the loudness of an audio file (runs in a worker process).
+
+    Returns:
+        tuple: (integrated loudness in LUFS or None, peak in dBFS or None)
+    """
+    if shutil.which('ffmpeg'):
+        return _analyze_ffmpeg(path)
+    return _analyze_mpg123(path)
+
+def analyze_track(path, filename, size, mtime):
+    """
+    Process job: measure one track, a broken file is stored as unmeasured.
+
+    Returns:
+        tuple: (integrated loudness in LUFS or None, peak in dBFS or None)
+    """
+    try:
+        return analyze_file(path)
+    except Exception as e:
+        logger.warning(f"Loudness analysis failed for {filename}: {e}")
+        return None, None
+
+def gain_for(integrated_lufs, peak_dbfs=None, target_lufs=LOUDNESS_TARGET_LUFS):
+    """
+    Calculate the playback gain for a measured track.
+
+    The gain is limited to LOUDNESS_MAX_GAIN_DB and never pushes the peak
+    of the track above full scale.
+    """
+    if integrated_lufs is None:
+        return 0.0
+    gain = target_lufs - integrated_lufs
+    if peak_dbfs is not None:
+        gain = min(gain, -peak_dbfs)
+    return max(-LOUDNESS_MAX_GAIN_DB, min(gain, LOUDNESS_MAX_GAIN_DB))
+
+class LoudnessAnalyzer:
+    """
+    Background job that analyzes new and changed tracks of the library
+    """
+    def __init__(self, app, library, check_interval=60):
+        self.app = app
+        self.library = library
+        self.check_interval = check_interval
+        self.gains = {}
+        self.running = False
+        self.thread = None
+        self._wakeup = threading.Event()
+        self._generation = None
+        self.scheduler = None
+        self._analyzed = None
+
+    def get_gain(self, filename):
+        """Get the playback gain of a track in dB (0 if not analyzed yet)"""
+        return self.gains.get(filename, 0.0)
+
+    def start(self):
+        """Start the background analysis"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logger.info("Loudness analyzer started")
+
+    def stop(self):
+        """Stop the background analysis after the current track"""
+        self.running = False
+        self._wakeup.set()
+
+    def trigger(self):
+        """Check the library for new tracks right away"""
+        if self.scheduler:
+            self.scheduler.submit('loudness.check', key='loudness.check')
+        else:
+            self._wakeup.set()
+
+    def schedule(self, scheduler):
+        """
+        Run the analysis as jobs of the scheduler instead of the own thread.
+
+        A periodic check job queues one process job per pending track, so
+        the analysis pauses while audio plays and resumes after a restart.
+        """
+        from utils.jobs import PRIORITY_LOW
+        self.scheduler = scheduler
+        scheduler.register('loudness.check', self._check_job, priority=PRIORITY_LOW)
+        scheduler.register('loudness.analyze', analyze_track, priority=PRIORITY_LOW,
+                           process=True, on_result=self._on_result)
+        scheduler.every(self.check_interval, 'loudness.check', first=0)
+
+    def _check_job(self, ctx):
+        """Job: queue an analysis for every new or changed track"""
+        if self._analyzed is None:
+            self._analyzed = self._load_results()
+        generation = self.library.refresh()
+        if generation == self._generation:
+            return
+        pending = self._pending_tracks(self._analyzed)
+        for filename, path, size, mtime in pending:
+            ctx.checkpoint()
+            self.scheduler.submit('loudness.analyze',
+                                  {'path': path, 'filename': filename, 'size': size, 'mtime': mtime},
+                                  key=f"loudness:{filename}")
+        if pending:
+            logger.info(f"Queued loudness analysis of {len(pending)} tracks")
+        self._generation = generation
+
+    def _on_result(self, args, result):
+        """Store the result of a loudness.analyze job"""
+        integrated, peak = result
+        self._store(args['filename'], args['size'], args['mtime'], integrated, peak)
+        if self._analyzed is not None:
+            self._analyzed[args['filename']] = (args['size'], args['mtime'])
+
+    def _load_results(self):
+        """Load previous results, so an interrupted analysis resumes where it stopped"""
+        from models import TrackLoudness
+        with self.app.app_context():
+            rows = TrackLoudness.query.all()
+            self.gains = {row.filename: row.gain_db for row in rows}
+            return {row.filename: (row.file_size, row.file_mtime) for row in rows}
+
+    def _pending_tracks(self, analyzed):
+        """Get the tracks that were never analyzed or changed since"""
+        pending = []
+        for song in self.library.get_songs():
+            path = os.path.join(self.library.directory, song['filename'])
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if analyzed.get(song['filename']) != (stat.st_size, stat.st_mtime):
+                pending.append((song['filename'], path, stat.st_size, stat.st_mtime))
+        return pending
+
+    def _store(self, filename, size, mtime, integrated, peak):
+        """Store the result of one track"""
+        from models import TrackLoudness, db
+        gain = gain_for(integrated, peak)
+        with self.app.app_context():
+            row = TrackLoudness.query.filter_by(filename=filename).first()
+            if not row:
+                row = TrackLoudness(filename=filename)
+                db.session.add(row)
+            row.file_size = size
+            row.file_mtime = mtime
+            row.integrated_lufs = integrated
+            row.peak_dbfs = peak
+            row.gain_db = gain
+            row.analyzed_at = datetime.utcnow()
+            db.session.commit()
+        self.gains[filename] = gain
+        logger.info(f"Loudness of {filename}: {integrated} LUFS, gain {gain:+.1f} dB")
+
+    def _run(self):
+        """Analysis loop"""
+        try:
+            analyzed = self._load_results()
+        except Exception as e:
+            logger.error(f"Could not load loudness results: {e}")
+            analyzed = {}
+
+        while self.running:
+            generation = self.library.refresh()
+            if generation != self._generation:
+                pending = self._pending_tracks(analyzed)
+                if pending:
+                    logger.info(f"Analyzing loudness of {len(pending)} tracks")
+                    self._analyze(pending, analyzed)
+                self._generation = generation
+
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+
+    def _analyze(self, pending, analyzed):
+        """Analyze tracks in a single low-priority worker process"""
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_lower_priority) as pool:
+            futures = {pool.submit(analyze_file, path): (filename, size, mtime)
+                       for filename, path, size, mtime in pending}
+            for future in as_completed(futures):
+                filename, size, mtime = futures[future]
+                if not self.running:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    return
+                try:
+                    integrated, peak = future.result()
+                except Exception as e:
+                    logger.warning(f"Loudness analysis failed for {filename}: {e}")
+                    integrated, peak = None, None
+                try:
+                    self._store(filename, size, mtime, integrated, peak)
+                    analyzed[filename] = (size, mtime)
+                except Exception as e:
+                    logger.error(f"Could not store loudness of {filename}: {e}")
@@ -0,0 +1,89 @@
+"""
+Read-only file with the tag mappings
+
+The web app exports the RFID tag mappings from the database into a small
+JSON file. The headless appliance reads only this file, so it needs
+neither Flask nor SQLAlchemy. The file is replaced atomically and picked
+up again when its modification time changes.
+"""
+import os
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+def export_mappings(path, tags, generation=None):
+    """
+    Write the tag mappings to a file.
+
+    Args:
+        path (str): Target file
+        tags (iterable): Objects with tag_id, name and mp3_filename
+        generation (int): Tag generation the export belongs to
+
+    Returns:
+        int: Number of exported tags
+    """
+    mappings = {t.tag_id: [t.name, t.mp3_filename] for t in tags}
+    data = {'version': FORMAT_VERSION, 'generation': generation, 'tags': mappings}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # One temporary file per writer, two exporting processes must not share it
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    logger.info(f"Exported {len(mappings)} tag mappings to {path}")
+    return len(mappings)
+
+class MappingStore:
+    """
+    Tag mappings loaded from an exported file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._tags = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Load the file if it changed since the last load"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._mtime is not None:
+                logger.warning(f"Mapping file {self.path} disappeared, keeping the loaded mappings")
+            return
+
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != FORMAT_VERSION:
+                raise ValueError(f"unsupported version {data.get('version')}")
+            self._tags = data['tags']
+            self._mtime = mtime
+            logger.info(f"Loaded {len(self._tags)} tag mappings from {self.path}")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not load mapping file {self.path}: {e}")
+
+    def get(self, tag_id):
+        """
+        Get the mapping of a tag.
+
+        Returns:
+            tuple: (name, mp3_filename), or None if the tag is not registered
+        """
+        with self._lock:
+            self._load()
+            mapping = self._tags.get(tag_id)
+        return tuple(mapping) if mapping else None
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._tags)
@@ -0,0 +1,94 @@
+"""
+Metrics for the Kids Audio Player
+
+A small registry of counters, gauges and summaries with labels, rendered
+in the Prometheus text format. The components of the process that owns
+the reader and the audio output record into the module-level registry.
+"""
+import threading
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ((name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Metrics:
+    """
+    Thread-safe registry of metric values
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}     # name -> (type, help)
+        self._values = {}    # name -> {labels: value or [sum, count, max]}
+
+    def describe(self, name, kind, text):
+        """
+        Declare a metric.
+
+        Args:
+            name (str): Metric name, e.g. 'watchdog_restarts_total'
+            kind (str): 'counter', 'gauge' or 'summary'
+            text (str): Help text
+        """
+        with self._lock:
+            self._kinds[name] = (kind, text)
+            self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a summary (sum, count and max)"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            entry = series.setdefault(key, [0.0, 0, value])
+            entry[0] += value
+            entry[1] += 1
+            entry[2] = max(entry[2], value)
+
+    def snapshot(self):
+        """
+        Get all values.
+
+        Returns:
+            dict: name -> list of {'labels': dict, 'value': ...}
+        """
+        with self._lock:
+            return {name: [{'labels': dict(key), 'value': list(value) if isinstance(value, list) else value}
+                           for key, value in series.items()]
+                    for name, series in self._values.items()}
+
+    def render(self):
+        """Render all metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                kind, text = self._kinds.get(name, ('untyped', ''))
+                if text:
+                    lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind == 'summary':
+                        total, count, maximum = value
+                        lines.append(f"{name}_sum{_format_labels(key)} {total:g}")
+                        lines.append(f"{name}_count{_format_labels(key)} {count}")
+                        lines.append(f"{name}_max{_format_labels(key)} {maximum:g}")
+                    else:
+                        lines.append(f"{name}{_format_labels(key)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+# Registry of this process
+metrics = Metrics()
@@ -0,0 +1,213 @@
+"""
+Register-level fake of the MFRC522 chip
+
+Implements the transport interface of utils.mfrc522_fast.SpiTransport,
+so FastMFRC522 can be tested and benchmarked without hardware. The fake
+emulates the registers, FIFO and timer interrupt of the chip and a
+MIFARE Classic card with the ISO 14443-3 IDLE/READY/ACTIVE/HALT states.
+Every register access is counted like an SPI transfer.
+"""
+from utils.mfrc522_fast import (
+    COMMAND_REG, COM_IRQ_REG, ERROR_REG, STATUS2_REG, FIFO_DATA_REG, FIFO_LEVEL_REG,
+    CONTROL_REG, BIT_FRAMING_REG, CMD_IDLE, CMD_TRANSCEIVE, CMD_MF_AUTHENT, CMD_SOFT_RESET,
+    IRQ_TIMER, IRQ_IDLE, IRQ_RX, STATUS2_CRYPTO1_ON, PICC_REQA, PICC_WUPA, PICC_SEL_CL1,
+    PICC_AUTH_KEY_A, PICC_READ, PICC_WRITE, PICC_HALT, PICC_ACK, DEFAULT_KEY, crc_a
+)
+
+IDLE, READY, ACTIVE, HALT = 'idle', 'ready', 'active', 'halt'
+
+class FakeCard:
+    """
+    MIFARE Classic 1K card
+    """
+    def __init__(self, uid, key=None):
+        self.uid = list(uid[:4])
+        self.key = list(key or DEFAULT_KEY)
+        self.blocks = {block: [0] * 16 for block in range(64)}
+        self.state = IDLE
+        self.authenticated_sector = None
+        self._pending_write = None
+
+    @property
+    def uid_bytes(self):
+        """UID with check byte, as returned by anticollision"""
+        bcc = self.uid[0] ^ self.uid[1] ^ self.uid[2] ^ self.uid[3]
+        return self.uid + [bcc]
+
+    def set_text(self, text, blocks=(8, 9, 10)):
+        """Store text in data blocks, like SimpleMFRC522.write"""
+        data = list(text.encode('latin-1').ljust(16 * len(blocks), b' '))
+        for i, block in enumerate(blocks):
+            self.blocks[block] = data[i * 16:(i + 1) * 16]
+
+    def leave_field(self):
+        """Card is taken away from the reader"""
+        self.state = IDLE
+        self.authenticated_sector = None
+        self._pending_write = None
+
+    def authenticate(self, block, key, uid):
+        """Handle a MFAuthent command"""
+        if self.state != ACTIVE or list(uid) != self.uid or list(key) != self.key:
+            self.state = IDLE
+            return False
+        self.authenticated_sector = block // 4
+        return True
+
+    def _check_crc(self, frame):
+        return len(frame) >= 3 and crc_a(frame[:-2]) == frame[-2:]
+
+    def handle(self, frame, last_bits):
+        """
+        Handle a frame sent by the reader.
+
+        Returns:
+            tuple: (response bytes, valid bits in last byte), or None for no answer
+        """
+        # Second part of a write command: the 16 data bytes
+        if self._pending_write is not None:
+            block = self._pending_write
+            self._pending_write = None
+            if len(frame) == 18 and self._check_crc(frame):
+                self.blocks[block] = list(frame[:16])
+                return [PICC_ACK], 4
+            self.state = IDLE
+            return None
+
+        if last_bits == 7 and len(frame) == 1:
+            if frame[0] == PICC_REQA and self.state == IDLE:
+                self.state = READY
+                return [0x04, 0x00], 0
+            if frame[0] == PICC_WUPA and self.state in (IDLE, HALT):
+                self.state = READY
+                return [0x04, 0x00], 0
+            # Unexpected short frame, card falls back to its idle state
+            if self.state != HALT:
+                self.state = IDLE
+            return None
+
+        if self.state == READY and frame == [PICC_SEL_CL1, 0x20]:
+            return self.uid_bytes, 0
+
+        if self.state == READY and frame[:2] == [PICC_SEL_CL1, 0x70] and self._check_crc(frame):
+            if frame[2:7] == self.uid_bytes:
+                self.state = ACTIVE
+                return [0x08] + crc_a([0x08]), 0
+
+        if self.state == ACTIVE and self._check_crc(frame):
+            if frame[0] == PICC_HALT:
+                self.state = HALT
+                self.authenticated_sector = None
+                return None
+            if frame[0] == PICC_READ and self.authenticated_sector == frame[1] // 4:
+                data = list(self.blocks[frame[1]])
+                return data + crc_a(data), 0
+            if frame[0] == PICC_WRITE and self.authenticated_sector == frame[1] // 4:
+                self._pending_write = frame[1]
+                return [PICC_ACK], 4
+
+        # Anything else is a protocol error, the card goes back to idle
+        if self.state != HALT:
+            self.state = IDLE
+        self.authenticated_sector = None
+        return None
+
+class FakeMFRC522:
+    """
+    Fake chip with the register interface of SpiTransport
+    """
+    def __init__(self, card=None):
+        self.registers = [0] * 64
+        self.fifo = []
+        self.card = None
+        self.transfers = 0
+        if card:
+            self.insert(card)
+
+    def insert(self, card):
+        """Put a card on the reader"""
+        self.card = card
+        card.leave_field()
+
+    def remove(self):
+        """Take the card away"""
+        if self.card:
+            self.card.leave_field()
+        self.card = None
+
+    def read(self, register):
+        self.transfers += 1
+        if register == FIFO_DATA_REG:
+            return self.fifo.pop(0) if self.fifo else 0
+        if register == FIFO_LEVEL_REG:
+            return len(self.fifo)
+        return self.registers[register]
+
+    def write(self, register, value):
+        self.transfers += 1
+        self._write(register, value)
+
+    def read_many(self, register, count):
+        if count <= 0:
+            return []
+        self.transfers += 1
+        return [self.read(register) for _ in range(count)]
+
+    def write_many(self, register, values):
+        self.transfers += 1
+        for value in values:
+            self._write(register, value)
+
+    def close(self):
+        pass
+
+    def _write(self, register, value):
+        if register == FIFO_DATA_REG:
+            self.fifo.append(value & 0xFF)
+        elif register == FIFO_LEVEL_REG:
+            if value & 0x80:
+                self.fifo = []
+        elif register == COM_IRQ_REG:
+            # Bit 7 selects whether the marked bits are set or cleared
+            if value & 0x80:
+                self.registers[COM_IRQ_REG] |= value & 0x7F
+            else:
+                self.registers[COM_IRQ_REG] &= ~value & 0x7F
+        elif register == COMMAND_REG:
+            self.registers[COMMAND_REG] = value
+            if value == CMD_SOFT_RESET:
+                self.registers = [0] * 64
+                self.fifo = []
+            elif value == CMD_MF_AUTHENT:
+                self._authenticate()
+        elif register == BIT_FRAMING_REG:
+            self.registers[BIT_FRAMING_REG] = value & 0x7F
+            if value & 0x80 and self.registers[COMMAND_REG] == CMD_TRANSCEIVE:
+                self._transceive(value & 0x07)
+        else:
+            self.registers[register] = value
+
+    def _transceive(self, last_bits):
+        frame = self.fifo
+        self.fifo = []
+        self.registers[ERROR_REG] = 0
+        result = self.card.handle(frame, last_bits) if self.card else None
+        if result is None:
+            self.registers[COM_IRQ_REG] |= IRQ_TIMER
+            return
+        response, bits = result
+        self.fifo = list(response)
+        self.registers[CONTROL_REG] = bits
+        self.registers[COM_IRQ_REG] |= IRQ_RX | IRQ_IDLE
+
+    def _authenticate(self):
+        data = self.fifo
+        self.fifo = []
+        self.registers[COMMAND_REG] = CMD_IDLE
+        if self.card and len(data) == 12 and data[0] == PICC_AUTH_KEY_A:
+            if self.card.authenticate(data[1], data[2:8], data[8:12]):
+                self.registers[STATUS2_REG] |= STATUS2_CRYPTO1_ON
+                self.registers[COM_IRQ_REG] |= IRQ_IDLE
+                return
+        self.registers[STATUS2_REG] &= ~STATUS2_CRYPTO1_ON
+        self.registers[COM_IRQ_REG] |= IRQ_TIMER
@@ -0,0 +1,369 @@
+"""
+Fast MFRC522 reader backend
+
+SimpleMFRC522 authenticates and reads three data blocks on every poll,
+although only the UID is needed to look up a tag. This backend talks to
+the chip register by register and only runs the wake-up and
+anticollision commands when polling. Data blocks are read on demand.
+
+Register transfers are kept to a minimum: interrupt flags and the FIFO
+are reset with single writes, FIFO data is moved in bursts and CRCs are
+calculated in software instead of on the chip.
+"""
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# MFRC522 registers
+COMMAND_REG = 0x01
+COM_IEN_REG = 0x02
+COM_IRQ_REG = 0x04
+ERROR_REG = 0x06
+STATUS2_REG = 0x08
+FIFO_DATA_REG = 0x09
+FIFO_LEVEL_REG = 0x0A
+CONTROL_REG = 0x0C
+BIT_FRAMING_REG = 0x0D
+MODE_REG = 0x11
+TX_CONTROL_REG = 0x14
+TX_ASK_REG = 0x15
+T_MODE_REG = 0x2A
+T_PRESCALER_REG = 0x2B
+T_RELOAD_REG_H = 0x2C
+T_RELOAD_REG_L = 0x2D
+
+# MFRC522 commands
+CMD_IDLE = 0x00
+CMD_TRANSCEIVE = 0x0C
+CMD_MF_AUTHENT = 0x0E
+CMD_SOFT_RESET = 0x0F
+
+# Interrupt flags in COM_IRQ_REG
+IRQ_TIMER = 0x01
+IRQ_ERR = 0x02
+IRQ_IDLE = 0x10
+IRQ_RX = 0x20
+
+# Status flag in STATUS2_REG
+STATUS2_CRYPTO1_ON = 0x08
+
+# PICC (card) commands
+PICC_REQA = 0x26
+PICC_WUPA = 0x52
+PICC_SEL_CL1 = 0x93
+PICC_AUTH_KEY_A = 0x60
+PICC_READ = 0x30
+PICC_WRITE = 0xA0
+PICC_HALT = 0x50
+PICC_ACK = 0x0A
+
+# Same data blocks and key as SimpleMFRC522, so cards stay compatible
+TEXT_BLOCKS = (8, 9, 10)
+DEFAULT_KEY = [0xFF] * 6
+
+# Upper bound for polling the interrupt register during one command
+MAX_IRQ_POLLS = 2000
+
+class ReaderError(Exception):
+    """Raised when the card or chip reports an error"""
+
+def crc_a(data):
+    """
+    Calculate the ISO 14443-3 CRC_A of a frame.
+
+    Returns:
+        list: The two CRC bytes (low byte first)
+    """
+    crc = 0x6363
+    for byte in data:
+        byte ^= crc & 0xFF
+        byte = (byte ^ (byte << 4)) & 0xFF
+        crc = ((crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+    return [crc & 0xFF, crc >> 8]
+
+def uid_to_num(uid):
+    """Convert the 5 anticollision bytes to a number, like SimpleMFRC522 does"""
+    number = 0
+    for byte in uid[:5]:
+        number = number * 256 + byte
+    return number
+
+class SpiTransport:
+    """
+    Register access to an MFRC522 over SPI (spidev)
+    """
+    def __init__(self, bus=0, device=0, speed_hz=1000000, reset_pin=22):
+        import spidev
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = speed_hz
+        self.transfers = 0
+        self.reset_pin = reset_pin
+
+        if reset_pin is not None:
+            import RPi.GPIO as GPIO
+            GPIO.setwarnings(False)
+            if GPIO.getmode() is None:
+                GPIO.setmode(GPIO.BOARD)
+            GPIO.setup(reset_pin, GPIO.OUT)
+            GPIO.output(reset_pin, 1)
+
+    def read(self, register):
+        """Read one register"""
+        self.transfers += 1
+        return self.spi.xfer2([((register << 1) & 0x7E) | 0x80, 0])[1]
+
+    def write(self, register, value):
+        """Write one register"""
+        self.transfers += 1
+        self.spi.xfer2([(register << 1) & 0x7E, value])
+
+    def read_many(self, register, count):
+        """Read the same register count times in one transfer (FIFO burst)"""
+        if count <= 0:
+            return []
+        self.transfers += 1
+        address = ((register << 1) & 0x7E) | 0x80
+        return self.spi.xfer2([address] * count + [0])[1:]
+
+    def write_many(self, register, values):
+        """Write several values to the same register in one transfer (FIFO burst)"""
+        self.transfers += 1
+        self.spi.xfer2([(register << 1) & 0x7E] + list(values))
+
+    def reset(self):
+        """Hard reset: pull the reset pin of the chip low for a moment"""
+        if self.reset_pin is None:
+            return
+        import RPi.GPIO as GPIO
+        GPIO.output(self.reset_pin, 0)
+        time.sleep(0.01)
+        GPIO.output(self.reset_pin, 1)
+        # The oscillator needs a moment to start
+        time.sleep(0.05)
+
+    def close(self):
+        """Close the SPI device"""
+        self.spi.close()
+
+class FastMFRC522:
+    """
+    MFRC522 reader with a UID-only poll and on-demand data access
+
+    The read/write methods mirror SimpleMFRC522, so the handler can use
+    either backend.
+    """
+    def __init__(self, transport, key=None, text_blocks=TEXT_BLOCKS):
+        self.transport = transport
+        self.key = list(key or DEFAULT_KEY)
+        self.text_blocks = tuple(text_blocks)
+        self.init()
+
+    def reset(self):
+        """Recover a wedged chip: hard reset if the transport can, then init()"""
+        if hasattr(self.transport, 'reset'):
+            self.transport.reset()
+        self.init()
+
+    def init(self):
+        """Reset the chip and switch the antenna on"""
+        t = self.transport
+        t.write(COMMAND_REG, CMD_SOFT_RESET)
+        # Timer starts after each transmission and expires after ~0.3 ms
+        t.write(T_MODE_REG, 0x8D)
+        t.write(T_PRESCALER_REG, 0x3E)
+        t.write(T_RELOAD_REG_L, 30)
+        t.write(T_RELOAD_REG_H, 0)
+        t.write(TX_ASK_REG, 0x40)
+        t.write(MODE_REG, 0x3D)
+        t.write(TX_CONTROL_REG, t.read(TX_CONTROL_REG) | 0x03)
+
+    def _execute(self, command, data, last_bits=0, wait_irq=IRQ_RX | IRQ_IDLE):
+        """
+        Run a chip command with data from the FIFO.
+
+        Returns:
+            tuple: (response bytes, number of valid bits in the last byte),
+                or (None, 0) if the card did not answer
+        """
+        t = self.transport
+        t.write(COMMAND_REG, CMD_IDLE)
+        t.write(COM_IRQ_REG, 0x7F)        # Clear all interrupt flags
+        t.write(FIFO_LEVEL_REG, 0x80)     # Flush the FIFO
+        t.write_many(FIFO_DATA_REG, data)
+        t.write(COMMAND_REG, command)
+        if command == CMD_TRANSCEIVE:
+            t.write(BIT_FRAMING_REG, 0x80 | last_bits)  # StartSend
+
+        for _ in range(MAX_IRQ_POLLS):
+            irq = t.read(COM_IRQ_REG)
+            if irq & wait_irq:
+                break
+            if irq & IRQ_TIMER:
+                return None, 0
+        else:
+            return None, 0
+
+        if command == CMD_TRANSCEIVE:
+            t.write(BIT_FRAMING_REG, last_bits)
+
+        error = t.read(ERROR_REG)
+        if error & 0x1B:
+            raise ReaderError(f"MFRC522 error flags 0x{error:02x}")
+
+        if command != CMD_TRANSCEIVE:
+            return [], 0
+
+        level = t.read(FIFO_LEVEL_REG)
+        response = t.read_many(FIFO_DATA_REG, level)
+        bits = t.read(CONTROL_REG) & 0x07 if last_bits or level == 1 else 0
+        return response, bits
+
+    def _transceive(self, data, last_bits=0):
+        """Send a frame to the card and return its answer (None if it did not answer)"""
+        response, _ = self._execute(CMD_TRANSCEIVE, data, last_bits)
+        return response
+
+    def _wake_up(self):
+        """
+        Wake up a card in the field.
+
+        WUPA also wakes halted cards. A card that is still in the READY
+        state from the previous poll falls back to IDLE on the first WUPA
+        without answering, so one retry is needed in that case.
+        """
+        for _ in range(2):
+            response = self._transceive([PICC_WUPA], last_bits=7)
+            if response and len(response) == 2:
+                return True
+        return False
+
+    def _anticollision(self):
+        """Get the UID (4 bytes plus check byte) of the card in the field"""
+        self.transport.write(BIT_FRAMING_REG, 0x00)
+        response = self._transceive([PICC_SEL_CL1, 0x20])
+        if not response or len(response) != 5:
+            return None
+        if response[0] ^ response[1] ^ response[2] ^ response[3] != response[4]:
+            return None
+        return response
+
+    def read_uid(self):
+        """
+        Poll for a card without touching its data.
+
+        Returns:
+            list: The 5 UID bytes, or None if no card is present
+        """
+        if not self._wake_up():
+            return None
+        return self._anticollision()
+
+    def read_id_no_block(self):
+        """Get the ID of the card in the field, or None"""
+        uid = self.read_uid()
+        return uid_to_num(uid) if uid else None
+
+    def read_id(self):
+        """Wait for a card and return its ID"""
+        while True:
+            tag_id = self.read_id_no_block()
+            if tag_id:
+                return tag_id
+            time.sleep(0.05)
+
+    def _select(self, uid):
+        """Select a card by its UID"""
+        frame = [PICC_SEL_CL1, 0x70] + list(uid[:5])
+        response = self._transceive(frame + crc_a(frame))
+        if not response or len(response) != 3:
+            raise ReaderError("Card did not answer to SELECT")
+
+    def _authenticate(self, block, uid):
+        """Authenticate a block with key A"""
+        self._execute(CMD_MF_AUTHENT, [PICC_AUTH_KEY_A, block] + self.key + list(uid[:4]), wait_irq=IRQ_IDLE)
+        if not self.transport.read(STATUS2_REG) & STATUS2_CRYPTO1_ON:
+            raise ReaderError(f"Authentication of block {block} failed")
+
+    def _stop(self):
+        """Halt the card and switch off the encryption"""
+        frame = [PICC_HALT, 0x00]
+        try:
+            self._transceive(frame + crc_a(frame))
+        finally:
+            self.transport.write(STATUS2_REG, 0x00)
+
+    def read_blocks(self, uid, blocks=None):
+        """
+        Read data blocks of a selected card.
+
+        Args:
+            uid (list): UID bytes from read_uid
+            blocks (tuple): Block numbers, defaults to the text blocks
+
+        Returns:
+            bytes: The concatenated block data
+        """
+        blocks = blocks or self.text_blocks
+        data = []
+        try:
+            self._select(uid)
+            self._authenticate(blocks[0], uid)
+            for block in blocks:
+                frame = [PICC_READ, block]
+                response = self._transceive(frame + crc_a(frame))
+                if not response or len(response) != 18 or crc_a(response[:16]) != response[16:]:
+                    raise ReaderError(f"Reading block {block} failed")
+                data.extend(response[:16])
+        finally:
+            self._stop()
+        return bytes(data)
+
+    def write_blocks(self, uid, data, blocks=None):
+        """Write data (padded with spaces) to blocks of a card"""
+        blocks = blocks or self.text_blocks
+        data = bytes(data).ljust(16 * len(blocks), b' ')[:16 * len(blocks)]
+        try:
+            self._select(uid)
+            self._authenticate(blocks[0], uid)
+            for i, block in enumerate(blocks):
+                for frame in ([PICC_WRITE, block], list(data[i * 16:(i + 1) * 16])):
+                    response, bits = self._execute(CMD_TRANSCEIVE, frame + crc_a(frame))
+                    if not response or (response[0] & 0x0F) != PICC_ACK:
+                        raise ReaderError(f"Writing block {block} failed")
+        finally:
+            self._stop()
+
+    def read_no_block(self):
+        """Read ID and text of the card in the field, like SimpleMFRC522"""
+        uid = self.read_uid()
+        if not uid:
+            return None, None
+        data = self.read_blocks(uid)
+        return uid_to_num(uid), ''.join(chr(byte) for byte in data)
+
+    def read(self):
+        """Wait for a card and return its ID and text"""
+        while True:
+            tag_id, text = self.read_no_block()
+            if tag_id:
+                return tag_id, text
+            time.sleep(0.05)
+
+    def write_no_block(self, text):
+        """Write text to the card in the field; returns its ID and the text, or (None, None)"""
+        uid = self.read_uid()
+        if not uid:
+            return None, None
+        data = text.encode('latin-1', errors='replace')
+        self.write_blocks(uid, data)
+        return uid_to_num(uid), text[:16 * len(self.text_blocks)]
+
+    def write(self, text):
+        """Wait for a card and write text to it"""
+        while True:
+            tag_id, written = self.write_no_block(text)
+            if tag_id:
+                return tag_id, written
+            time.sleep(0.05)
@@ -0,0 +1,566 @@
+"""
+In-process audio mixer for the Kids Audio Player
+
+Tracks are decoded by mpg123 to raw PCM through a pipe. The mixer applies
+gain ramps with NumPy and writes the result to a single long-running
+output (aplay on the ALSA device, or a WAV file for tests). Because the
+output never restarts, card swaps can fade and crossfade without clicks or
+gaps, and two decoders only run at the same time during a crossfade.
+
+Every track gets an audio telemetry session. The mixer detects underruns
+from the samples it wrote against the wall clock; decode errors and the
+xruns aplay reports on stderr are read by background threads.
+"""
+import os
+import subprocess
+import threading
+import time
+import wave
+import json
+import logging
+from utils import sched_policy
+from utils.audio_telemetry import telemetry, classify, LagTracker
+from utils.file_handler import read_mp3_format
+
+logger = logging.getLogger(__name__)
+
+# NumPy is optional, the mixer engine is only available if it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+BYTES_PER_FRAME = 2 * CHANNELS
+
+# Frames processed per block (about 23 ms)
+BLOCK_FRAMES = 1024
+
+# Samples per MPEG-1 Layer III frame, assumed when resuming a restarted
+# decoder if the frame header of the file cannot be read
+MP3_FRAME_SAMPLES = 1152
+
+# Seconds after the output resumed from idle in which reported xruns are
+# ignored: aplay reports the time it ran dry while nothing played
+XRUN_GRACE = 1.0
+
+def _follow_stderr(process, handle):
+    """Pass every line a process writes to stderr to a function"""
+    def run():
+        try:
+            for line in process.stderr:
+                handle(line.decode(errors='replace'))
+        except (OSError, ValueError):
+            pass
+    threading.Thread(target=run, daemon=True).start()
+
+class Decoder:
+    """
+    mpg123 process decoding a file to 16 bit stereo PCM on stdout
+    """
+    def __init__(self, path, session=None):
+        """
+        Args:
+            path (str): File to decode
+            session (PlaybackSession): Gets the decode errors, None to
+                discard them
+        """
+        self.path = path
+        self.session = session
+        self.frames_read = 0
+        self.read_started = None    # Set while a read waits for mpg123
+        self._format = None         # (source sample rate, samples per frame)
+        self.process = self._start(0)
+
+    def _start(self, skip_frames):
+        # -q would also silence the decode errors
+        process = subprocess.Popen(
+            ['mpg123'] + ([] if self.session else ['-q']) +
+            ['-s', '-r', str(SAMPLE_RATE), '--stereo', '-e', 's16', '-k', str(skip_frames), self.path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE if self.session else subprocess.DEVNULL
+        )
+        sched_policy.apply_to_process(sched_policy.DECODER, process)
+        if self.session:
+            _follow_stderr(process, lambda line: process is self.process and self.session.stderr_line(line))
+        return process
+
+    def read(self, frames):
+        """
+        Read up to the given number of frames.
+
+        Returns:
+            ndarray: float32 array of shape (n, 2), empty at the end of the track
+        """
+        wanted = frames * BYTES_PER_FRAME
+        data = b''
+        self.read_started = time.monotonic()
+        while True:
+            process = self.process
+            data += process.stdout.read(wanted - len(data))
+            # A short read from a replaced process is not the end of the track
+            if len(data) >= wanted or process is self.process:
+                break
+        data = data[:len(data) - len(data) % BYTES_PER_FRAME]
+        self.frames_read += len(data) // BYTES_PER_FRAME
+        self.read_started = None
+        samples = np.frombuffer(data, dtype='<i2').astype(np.float32)
+        return samples.reshape(-1, CHANNELS)
+
+    def restart(self):
+        """
+        Replace a hanging mpg123, continuing near the position reached.
+
+        The position is rounded to whole MP3 frames of the source, whose
+        sample rate and frame size can differ from the output (e.g. 48 kHz
+        or MPEG-2 with 576 samples per frame).
+        """
+        old = self.process
+        self.process = self._start(self._source_frames())
+        if self.read_started is not None:
+            self.read_started = time.monotonic()
+        if self.session:
+            self.session.resumed()
+        try:
+            old.kill()
+            old.wait(timeout=1)
+        except Exception as e:
+            logger.error(f"Fehler beim Beenden des Decoders: {e}")
+        logger.warning(f"Decoder neu gestartet bei {self.frames_read / SAMPLE_RATE:.1f} s: {self.path}")
+
+    def _source_frames(self):
+        """MP3 frames of the source that were decoded into the frames read"""
+        if self._format is None:
+            self._format = read_mp3_format(self.path) or (SAMPLE_RATE, MP3_FRAME_SAMPLES)
+        source_rate, frame_samples = self._format
+        return int(self.frames_read * source_rate / SAMPLE_RATE) // frame_samples
+
+    def close(self):
+        """Stop the decoder process"""
+        try:
+            self.process.stdout.close()
+            self.process.terminate()
+            self.process.wait(timeout=1)
+        except Exception as e:
+            logger.error(f"Fehler beim Beenden des Decoders: {e}")
+            self.process.kill()
+
+class WavDecoder:
+    """
+    Reads a 16 bit PCM WAV file with the interface of Decoder
+    """
+    def __init__(self, path):
+        self.path = path
+        self._wave = wave.open(path, 'rb')
+        if self._wave.getsampwidth() != 2 or self._wave.getframerate() != SAMPLE_RATE:
+            self._wave.close()
+            raise ValueError(f"{path}: only 16 bit WAV files at {SAMPLE_RATE} Hz are supported")
+        self.channels = self._wave.getnchannels()
+
+    def read(self, frames):
+        samples = np.frombuffer(self._wave.readframes(frames), dtype='<i2').astype(np.float32)
+        samples = samples.reshape(-1, self.channels)
+        if self.channels == 1:
+            return np.repeat(samples, CHANNELS, axis=1)
+        return samples[:, :CHANNELS]
+
+    def close(self):
+        self._wave.close()
+
+def open_decoder(path, session=None):
+    """Get a decoder for a file, WAV files are read without mpg123"""
+    if path.lower().endswith('.wav'):
+        return WavDecoder(path)
+    return Decoder(path, session)
+
+class AlsaSink:
+    """
+    Output to an ALSA device through a single aplay process
+    """
+    def __init__(self, device='hw:0,0', latency=0.0, command=('aplay',)):
+        """
+        Args:
+            device (str): ALSA device
+            latency (float): Seconds of audio buffered between a write and
+                the speaker (reported by delay())
+            command (tuple): aplay executable, replaced in self-checks
+        """
+        self.device = device
+        self.latency = latency
+        self.command = list(command)
+        self.process = None
+        # Called with the length in ms (or None) when aplay reports an xrun
+        self.on_xrun = None
+
+    def delay(self):
+        """Seconds until the audio written last is heard"""
+        return self.latency
+
+    def write(self, data):
+        """Write 16 bit stereo PCM bytes"""
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(
+                self.command + ['-q', '-D', self.device, '-t', 'raw', '-f', 'S16_LE',
+                                '-r', str(SAMPLE_RATE), '-c', str(CHANNELS)],
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            sched_policy.apply_to_process(sched_policy.DECODER, self.process)
+            _follow_stderr(self.process, self._stderr_line)
+        self.process.stdin.write(data)
+
+    def _stderr_line(self, line):
+        kind = classify(line)
+        if kind and kind[0] == 'xrun':
+            if self.on_xrun:
+                self.on_xrun(kind[1])
+        elif line.strip():
+            logger.warning(f"aplay: {line.strip()}")
+
+    def close(self):
+        """Close the output process"""
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=1)
+            except Exception as e:
+                logger.error(f"Fehler beim Schließen der Audioausgabe: {e}")
+                self.process.kill()
+            self.process = None
+
+    def abort(self):
+        """Kill a hanging output process, the next write starts a new one"""
+        process = self.process
+        if process and process.poll() is None:
+            process.kill()
+            logger.warning("Audioausgabe hing und wurde neu gestartet")
+
+class FileSink:
+    """
+    Output to a WAV file (for tests and debugging)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.frames_written = 0
+        self._wave = wave.open(path, 'wb')
+        self._wave.setnchannels(CHANNELS)
+        self._wave.setsampwidth(2)
+        self._wave.setframerate(SAMPLE_RATE)
+
+    def write(self, data):
+        """Write 16 bit stereo PCM bytes"""
+        self._wave.writeframes(data)
+        self.frames_written += len(data) // BYTES_PER_FRAME
+
+    def close(self):
+        """Finish the WAV file"""
+        if self._wave:
+            self._wave.close()
+            self._wave = None
+
+class PacedFileSink(FileSink):
+    """
+    WAV file output that plays in real time like a sound card
+
+    Writes block while more than `buffer` seconds are queued, and the
+    device can run slightly fast or slow (rate_error_ppm) like a real
+    crystal. Pauses are filled with silence, so sample n of the file is
+    heard at started + n / rate; both are saved to <path>.json for
+    comparing several outputs.
+    """
+    def __init__(self, path, rate_error_ppm=0.0, buffer=0.1, clock=time.monotonic):
+        super().__init__(path)
+        self.rate = SAMPLE_RATE * (1 + rate_error_ppm / 1e6)
+        self.buffer = buffer
+        self.clock = clock
+        self.started = None
+        self._free_at = None   # Time the last written frame is heard
+
+    def write(self, data):
+        now = self.clock()
+        if self.started is None:
+            self.started = self._free_at = now
+        elif self._free_at < now:
+            # The device ran dry, it played silence meanwhile
+            gap = int(round((now - self._free_at) * self.rate))
+            super().write(bytes(gap * BYTES_PER_FRAME))
+            self._free_at += gap / self.rate
+        super().write(data)
+        self._free_at += len(data) // BYTES_PER_FRAME / self.rate
+
+        wait = self._free_at - self.buffer - self.clock()
+        if wait > 0:
+            time.sleep(wait)
+
+    def delay(self):
+        """Seconds until the audio written last is heard"""
+        if self._free_at is None:
+            return 0.0
+        return max(0.0, self._free_at - self.clock())
+
+    def close(self):
+        super().close()
+        with open(f"{self.path}.json", 'w') as f:
+            json.dump({'started': self.started, 'rate': self.rate}, f)
+
+class Voice:
+    """
+    A decoding track with its current gain and gain ramp
+    """
+    def __init__(self, decoder, level=1.0, session=None):
+        self.decoder = decoder
+        self.session = session
+        self.frames = 0
+        self.level = level     # Linear gain from the loudness normalization
+        self.gain = 0.0        # Current fade gain (0..1)
+        self.target = 0.0
+        self.step = 0.0        # Gain change per frame
+        self.finished = False
+
+    def ramp_to(self, target, frames):
+        """Ramp the fade gain to a target over a number of frames"""
+        self.target = target
+        if frames <= 0:
+            self.gain = target
+            self.step = 0.0
+        else:
+            self.step = (target - self.gain) / frames
+
+    @property
+    def silent(self):
+        """True once the voice faded out completely"""
+        return self.target == 0.0 and self.gain <= 0.0
+
+    def render(self, frames):
+        """
+        Decode and apply the gain ramp to the next block.
+
+        Returns:
+            ndarray: float32 array of shape (n, 2), n <= frames
+        """
+        block = self.decoder.read(frames)
+        if len(block) < frames:
+            self.finished = True
+        if not len(block):
+            return block
+        self.frames += len(block)
+        if self.session:
+            self.session.progress(self.frames / SAMPLE_RATE, len(block))
+
+        if self.step:
+            ramp = self.gain + self.step * np.arange(1, len(block) + 1, dtype=np.float32)
+            if self.step > 0:
+                np.minimum(ramp, self.target, out=ramp)
+            else:
+                np.maximum(ramp, self.target, out=ramp)
+            self.gain = float(ramp[-1])
+            if self.gain == self.target:
+                self.step = 0.0
+            block *= (ramp * self.level)[:, np.newaxis]
+        else:
+            block *= self.gain * self.level
+        return block
+
+    def close(self):
+        """Stop the decoder and end the telemetry session"""
+        self.decoder.close()
+        if self.session:
+            self.session.end()
+
+class Mixer:
+    """
+    Mixes the current track and fading tracks into one output
+    """
+    def __init__(self, sink, fade_in_ms=300, fade_out_ms=300, crossfade_ms=1000):
+        if np is None:
+            raise RuntimeError("NumPy is required for the mixer")
+        self.sink = sink
+        self.fade_in_frames = SAMPLE_RATE * fade_in_ms // 1000
+        self.fade_out_frames = SAMPLE_RATE * fade_out_ms // 1000
+        self.crossfade_frames = SAMPLE_RATE * crossfade_ms // 1000
+        self.current = None
+        self.fading = []
+        self.running = False
+        self.thread = None
+        self._lock = threading.Lock()
+        self._has_voices = threading.Event()
+        self.last_block = time.monotonic()
+        self.device = getattr(sink, 'device', None) or type(sink).__name__
+        self._lag = LagTracker()
+        self._active_since = 0.0
+        if hasattr(sink, 'on_xrun'):
+            sink.on_xrun = self._xrun
+
+    def play(self, path, gain_db=0.0, track=None):
+        """
+        Start a track. A playing track is crossfaded into the new one.
+
+        Args:
+            path (str): Path of the file to decode
+            gain_db (float): Loudness normalization gain
+            track (str): Track name for the telemetry, default the file name
+        """
+        session = telemetry.start(track or os.path.basename(path), self.device, 'mixer', track_lag=False)
+        try:
+            decoder = open_decoder(path, session)
+        except Exception:
+            session.end()
+            raise
+        voice = Voice(decoder, level=10 ** (gain_db / 20), session=session)
+        with self._lock:
+            if self.current:
+                fade_frames = self.crossfade_frames or self.fade_out_frames
+                self.current.ramp_to(0.0, fade_frames)
+                self.fading.append(self.current)
+                voice.ramp_to(1.0, self.crossfade_frames or self.fade_in_frames)
+            else:
+                voice.ramp_to(1.0, self.fade_in_frames)
+            if not self._has_voices.is_set():
+                # Idle until now, the stall check starts with this track
+                self.last_block = time.monotonic()
+            self.current = voice
+            self._has_voices.set()
+        logger.info(f"Mixer: Starte Wiedergabe {path}")
+
+    def stop(self):
+        """Fade out the current track"""
+        with self._lock:
+            if self.current:
+                self.current.ramp_to(0.0, self.fade_out_frames)
+                self.fading.append(self.current)
+                self.current = None
+                logger.info("Mixer: Wiedergabe wird ausgeblendet")
+
+    def is_playing(self):
+        """True while a track is playing (not counting fading tracks)"""
+        return self.current is not None
+
+    def stalled(self, timeout):
+        """
+        Check whether the mixing loop hangs (watchdog check).
+
+        Returns:
+            str: Reason, None while the loop writes blocks or is idle
+        """
+        if not self.running or not self._has_voices.is_set():
+            return None
+        idle = time.monotonic() - self.last_block
+        if idle > timeout:
+            return f"no progress: mixer idle for {idle:.1f} s"
+        return None
+
+    def _session(self):
+        """Telemetry session of the track that is heard"""
+        with self._lock:
+            voice = self.current or (self.fading[-1] if self.fading else None)
+        return voice.session if voice else None
+
+    def _xrun(self, milliseconds):
+        """Xrun reported by the output"""
+        if not self._has_voices.is_set() or time.monotonic() - self._active_since < XRUN_GRACE:
+            return
+        session = self._session()
+        if session:
+            session.xrun(milliseconds)
+
+    def recover(self, timeout):
+        """
+        Unblock a hanging mixing loop: restart the decoders that delivered
+        nothing for the timeout, otherwise the output.
+        """
+        now = time.monotonic()
+        with self._lock:
+            voices = ([self.current] if self.current else []) + self.fading
+        stuck = [voice.decoder for voice in voices
+                 if getattr(voice.decoder, 'read_started', None) is not None
+                 and now - voice.decoder.read_started > timeout]
+        for decoder in stuck:
+            decoder.restart()
+        if not stuck and hasattr(self.sink, 'abort'):
+            self.sink.abort()
+
+    def mix_block(self, frames=BLOCK_FRAMES):
+        """
+        Mix and write one block.
+
+        Returns:
+            int: Number of frames written (0 if nothing is playing)
+        """
+        with self._lock:
+            voices = ([self.current] if self.current else []) + self.fading
+
+        output = None
+        for voice in voices:
+            block = voice.render(frames)
+            if not len(block):
+                continue
+            if output is None:
+                output = np.zeros((frames, CHANNELS), dtype=np.float32)
+            output[:len(block)] += block
+
+        with self._lock:
+            for voice in voices:
+                if voice.finished or voice.silent:
+                    if voice is self.current:
+                        self.current = None
+                    elif voice in self.fading:
+                        self.fading.remove(voice)
+                    voice.close()
+            if not self.current and not self.fading:
+                self._has_voices.clear()
+
+        if output is None:
+            return 0
+        np.clip(output, -32768, 32767, out=output)
+        self.sink.write(output.astype('<i2').tobytes())
+        return frames
+
+    def start(self):
+        """Start the mixing thread"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stop the mixing thread and release decoders and output"""
+        self.running = False
+        self._has_voices.set()
+        if self.thread:
+            self.thread.join(timeout=1)
+        with self._lock:
+            for voice in ([self.current] if self.current else []) + self.fading:
+                voice.close()
+            self.current = None
+            self.fading = []
+        self.sink.close()
+
+    def _run(self):
+        """Mixing loop, paced by the blocking writes to the output"""
+        sched_policy.apply_to_thread(sched_policy.DECODER)
+        written = None
+        while self.running:
+            if not self._has_voices.is_set():
+                written = None
+            self._has_voices.wait()
+            if not self.running:
+                break
+            if written is None:
+                # Resumed from idle, the output position starts over
+                self._lag.reset()
+                self._active_since = time.monotonic()
+                written = 0
+            try:
+                frames = self.mix_block()
+                self.last_block = time.monotonic()
+                if frames:
+                    written += frames
+                    lost = self._lag.update(written / SAMPLE_RATE)
+                    session = self._session() if lost else None
+                    if session:
+                        session.underrun(lost)
+            except Exception as e:
+                logger.error(f"Mixer Fehler: {e}")
+                time.sleep(0.1)
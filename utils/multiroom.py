@@ -0,0 +1,612 @@
+"""
+Synchronized playback on several boxes
+
+One box is the leader, the others follow it. When a card is tapped on
+the leader, it picks a start time a little in the future on its own
+clock and sends the track and the start time to all followers, so every
+box starts the same sample at the same moment.
+
+- Clock sync: followers probe the leader over UDP twice a second and
+  estimate the offset of its clock NTP-style, ((t1 - t0) + (t2 - t3)) / 2,
+  using the probe with the shortest round trip of the last few.
+- Scheduled start: a command carries the start time on the leader's
+  clock; a box pads silence (or skips ahead if it joined late) so the
+  first sample is heard at that time.
+- Drift correction: sound cards run slightly fast or slow. Before each
+  block the player compares the position being heard with the position
+  the shared clock asks for and reads a few frames more or less,
+  stretching them to the block length (a playback rate change of at most
+  0.5 %). Large errors are fixed at once by skipping or padding.
+
+Probe replies carry the current command, so a follower that lost a
+datagram or started late catches up within a probe interval.
+
+    python -m utils.multiroom self-check   # leader and followers writing WAV files
+"""
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import logging
+from collections import deque
+from config import (MUSIC_DIR, AUDIO_DEVICE, MULTIROOM_ROLE, MULTIROOM_LEADER, MULTIROOM_PORT,
+                    MULTIROOM_LEAD_MS, MULTIROOM_OUTPUT_LATENCY_MS)
+from utils.clock import system_clock
+from utils.mixer import np, open_decoder, AlsaSink, PacedFileSink, SAMPLE_RATE, CHANNELS, BLOCK_FRAMES
+from utils.player import track_gain
+from utils import sched_policy
+from utils.transcode import resolve_playback_path
+from utils.file_handler import get_file_path
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL = 0.5
+
+# Probes used for the offset estimate
+PROBE_WINDOW = 8
+
+# Followers that did not probe for this long are no longer sent commands
+FOLLOWER_TIMEOUT = 5.0
+
+# Errors above this are fixed at once, smaller ones by the rate change
+HARD_CORRECTION_FRAMES = SAMPLE_RATE // 20
+
+# Largest rate change per block (5 of 1024 frames, about 0.5 %)
+MAX_ADJUST_FRAMES = BLOCK_FRAMES // 200
+
+MAX_DATAGRAM = 8192
+
+# Seconds after which a follower looks up the leader's host name again
+LEADER_RESOLVE_INTERVAL = 60.0
+
+class ClockSync:
+    """
+    Offset of the leader's clock from probe round trips
+    """
+    def __init__(self, window=PROBE_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.offset = None
+        self.rtt = None
+
+    @property
+    def ready(self):
+        return self.offset is not None
+
+    def add_sample(self, t0, t1, t2, t3):
+        """
+        Add a probe round trip.
+
+        Args:
+            t0 (float): Local time the probe was sent
+            t1 (float): Leader time the probe arrived
+            t2 (float): Leader time the reply was sent
+            t3 (float): Local time the reply arrived
+        """
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.samples.append((rtt, offset))
+        # The shortest round trip had the least queueing, trust it most
+        self.rtt, self.offset = min(self.samples)
+
+def _stretch(block, frames):
+    """Resample a block to a number of frames (linear interpolation)"""
+    positions = np.linspace(0, len(block) - 1, frames)
+    source = np.arange(len(block))
+    return np.stack([np.interp(positions, source, block[:, c]) for c in range(CHANNELS)], axis=1).astype(np.float32)
+
+class SyncedPlayer:
+    """
+    Plays one track at a time, started at a time of the shared clock and
+    kept on it
+    """
+    def __init__(self, sink, now, block_frames=BLOCK_FRAMES):
+        """
+        Args:
+            sink: Output with write(bytes) and delay() (see utils.mixer)
+            now (callable): Current time of the shared clock in seconds
+            block_frames (int): Frames written per block
+        """
+        if np is None:
+            raise RuntimeError("NumPy is required for synchronized playback")
+        self.sink = sink
+        self.now = now
+        self.block_frames = block_frames
+        self._command = None     # (path, start_at, level) to start next
+        self._stopping = False
+        self._decoder = None
+        self._start_at = 0.0
+        self._level = 1.0
+        self._position = 0       # Track frames written to the sink
+        self._playing = False    # First frames of the track written
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.stats = {'tracks': 0, 'adjusted_frames': 0, 'hard_corrections': 0,
+                      'error_ms': 0.0, 'max_error_ms': 0.0}
+
+    def play(self, path, start_at, gain_db=0.0):
+        """
+        Play a track from a time of the shared clock on.
+
+        Args:
+            path (str): File to decode
+            start_at (float): Shared clock time of the first sample; if
+                it has passed, playback starts at the matching position
+            gain_db (float): Loudness normalization gain
+        """
+        with self._cond:
+            self._command = (path, start_at, 10 ** (gain_db / 20))
+            self._stopping = False
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._command = None
+            self._stopping = True
+            self._cond.notify()
+
+    def is_playing(self):
+        return self._decoder is not None or self._command is not None
+
+    def position(self):
+        """Seconds of the track being heard now, None if nothing plays"""
+        if self._decoder is None:
+            return None
+        return max(0.0, (self._position - self.sink.delay() * SAMPLE_RATE) / SAMPLE_RATE)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='synced-player', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self._close_decoder()
+        self.sink.close()
+
+    def _close_decoder(self):
+        if self._decoder:
+            self._decoder.close()
+            self._decoder = None
+
+    def _run(self):
+        sched_policy.apply_to_thread(sched_policy.DECODER)
+        while True:
+            with self._cond:
+                while self._running and not self._command and not self._stopping and not self._decoder:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                command, self._command = self._command, None
+                stopping, self._stopping = self._stopping, False
+
+            try:
+                if stopping:
+                    self._close_decoder()
+                if command:
+                    self._begin(*command)
+                if self._decoder:
+                    self._step()
+            except Exception as e:
+                logger.error(f"Synchrone Wiedergabe fehlgeschlagen: {e}")
+                self._close_decoder()
+                time.sleep(0.1)
+
+    def _begin(self, path, start_at, level):
+        self._close_decoder()
+        self._decoder = open_decoder(path)
+        self._start_at = start_at
+        self._level = level
+        self._position = 0
+        self._playing = False
+        self.stats['tracks'] += 1
+        logger.info(f"Synchrone Wiedergabe von {os.path.basename(path)} um {start_at:.3f}")
+
+    def _error_frames(self):
+        """Frames the heard position is ahead (positive) or behind of the shared clock"""
+        heard = self._position - self.sink.delay() * SAMPLE_RATE
+        wanted = (self.now() - self._start_at) * SAMPLE_RATE
+        return heard - wanted
+
+    def _step(self):
+        """Write one block, corrected towards the shared clock"""
+        error = self._error_frames()
+        error_ms = error * 1000 / SAMPLE_RATE
+        self.stats['error_ms'] = round(error_ms, 2)
+        if self._playing:
+            self.stats['max_error_ms'] = max(self.stats['max_error_ms'], round(abs(error_ms), 2))
+
+        # Until the first sample is out, align exactly; later only large
+        # errors are worth an audible jump
+        threshold = HARD_CORRECTION_FRAMES if self._playing else MAX_ADJUST_FRAMES
+        if error > threshold:
+            # Too early (or before the start): play silence until it is time
+            frames = min(int(error), self.block_frames)
+            self.sink.write(bytes(frames * CHANNELS * 2))
+            if self._playing:
+                self.stats['hard_corrections'] += 1
+            return
+        if error < -threshold:
+            # Too late (joined a running track): skip ahead
+            skipped = len(self._decoder.read(int(-error)))
+            self._position += skipped
+            self.stats['hard_corrections'] += 1
+            if not skipped:
+                self._close_decoder()
+            return
+
+        adjust = int(max(-MAX_ADJUST_FRAMES, min(MAX_ADJUST_FRAMES, round(-error / 8))))
+        block = self._decoder.read(self.block_frames + adjust)
+        if not len(block):
+            self._close_decoder()
+            return
+        self._position += len(block)
+        self._playing = True
+        if adjust and len(block) == self.block_frames + adjust:
+            block = _stretch(block, self.block_frames)
+            self.stats['adjusted_frames'] += abs(adjust)
+
+        block *= self._level
+        np.clip(block, -32768, 32767, out=block)
+        self.sink.write(block.astype('<i2').tobytes())
+
+class MultiroomNode:
+    """
+    Leader or follower of a group of boxes playing in sync
+    """
+    def __init__(self, role, sink, leader=None, port=MULTIROOM_PORT, lead_time=MULTIROOM_LEAD_MS / 1000,
+                 clock=system_clock, music_dir=MUSIC_DIR, name=None):
+        """
+        Args:
+            role (str): 'leader' or 'follower'
+            sink: Audio output of this box
+            leader (str): Host (and optional :port) of the leader, followers only
+            port (int): UDP port of the leader
+            lead_time (float): Seconds between a tap and the synchronized start
+            clock: Clock providing monotonic() (see utils.clock)
+            music_dir (str): Directory of the tracks
+            name (str): Name reported to the leader
+        """
+        if role not in ('leader', 'follower'):
+            raise ValueError(f"Unknown multiroom role: {role}")
+        if role == 'follower' and not leader:
+            raise ValueError("A follower needs the address of the leader")
+        self.role = role
+        self.clock = clock
+        self.music_dir = music_dir
+        self.lead_time = lead_time
+        self.name = name or socket.gethostname()
+        self.port = port
+        if leader:
+            host, _, leader_port = leader.partition(':')
+            self.leader = (host, int(leader_port or port))
+        else:
+            self.leader = None
+        self._leader_addresses = set()   # Resolved (ip, port) of the leader
+        self._leader_resolved = None
+        self.sync = ClockSync()
+        self.player = SyncedPlayer(sink, self.now)
+        self.followers = {}      # address -> (name, last probe)
+        self._command = None     # Last play/stop command, sent with every probe reply
+        self._sequence = 0
+        self._applied = 0
+        self._sock = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def now(self):
+        """Current time of the leader's clock"""
+        if self.role == 'leader':
+            return self.clock.monotonic()
+        return self.clock.monotonic() + (self.sync.offset or 0.0)
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('0.0.0.0', self.port if self.role == 'leader' else 0))
+        self._sock.settimeout(1.0)
+        self._running = True
+        self.player.start()
+        threading.Thread(target=self._receive_loop, name='multiroom', daemon=True).start()
+        if self.role == 'follower':
+            threading.Thread(target=self._probe_loop, name='multiroom-probe', daemon=True).start()
+        logger.info(f"Multiroom {self.role} gestartet (Port {self._sock.getsockname()[1]})")
+
+    def close(self):
+        self._running = False
+        self.player.close()
+        if self._sock:
+            self._sock.close()
+
+    def play(self, filename):
+        """
+        Play a track (same interface as MP3Player.play).
+
+        On the leader all followers start it at the same time; a
+        follower plays its own cards only locally.
+        """
+        try:
+            path = get_file_path(self.music_dir, filename)
+        except (ValueError, FileNotFoundError):
+            logger.error(f"MP3-Datei nicht gefunden: {filename}")
+            return False
+        if self.role == 'leader':
+            with self._lock:
+                self._sequence += 1
+                self._command = {'type': 'play', 'seq': self._sequence, 'filename': filename,
+                                 'start_at': self.now() + self.lead_time, 'gain_db': track_gain(filename)}
+            self._broadcast(self._command)
+            self._apply(self._command)
+        else:
+            self.player.play(resolve_playback_path(path), self.now() + 0.05, track_gain(filename))
+        return True
+
+    def stop(self):
+        """Stop playback (on the leader: on all boxes)"""
+        if self.role == 'leader':
+            with self._lock:
+                self._sequence += 1
+                self._command = {'type': 'stop', 'seq': self._sequence}
+            self._broadcast(self._command)
+        self.player.stop()
+
+    def is_playing(self):
+        return self.player.is_playing()
+
+    def status(self):
+        position = self.player.position()
+        now = self.clock.monotonic()
+        return {
+            'role': self.role,
+            'offset_ms': round(self.sync.offset * 1000, 3) if self.sync.ready else None,
+            'rtt_ms': round(self.sync.rtt * 1000, 3) if self.sync.ready else None,
+            'followers': [{'name': name, 'address': f"{address[0]}:{address[1]}",
+                           'last_seen_s': round(now - seen, 1)}
+                          for address, (name, seen) in self.followers.items()],
+            'playing': self.player.is_playing(),
+            'position_s': round(position, 3) if position is not None else None,
+            **self.player.stats
+        }
+
+    def _send(self, message, address):
+        try:
+            self._sock.sendto(json.dumps(message).encode('utf-8'), address)
+        except OSError as e:
+            logger.debug(f"Multiroom-Nachricht an {address} fehlgeschlagen: {e}")
+
+    def _broadcast(self, message):
+        now = self.clock.monotonic()
+        for address, (_, seen) in list(self.followers.items()):
+            if now - seen > FOLLOWER_TIMEOUT:
+                self.followers.pop(address, None)
+            else:
+                self._send(message, address)
+
+    def _apply(self, command):
+        """Carry out a play or stop command of the leader once"""
+        if not command or command['seq'] <= self._applied:
+            return
+        self._applied = command['seq']
+        if command['type'] == 'play':
+            try:
+                path = get_file_path(self.music_dir, str(command['filename']))
+            except (ValueError, FileNotFoundError):
+                logger.error(f"Multiroom: {command['filename']} fehlt auf diesem Gerät")
+                return
+            self.player.play(resolve_playback_path(path), command['start_at'], command.get('gain_db', 0.0))
+        else:
+            self.player.stop()
+
+    def _resolve_leader(self):
+        """Look up the addresses of the leader, commands are only taken from them"""
+        host, port = self.leader
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)
+        except OSError as e:
+            logger.warning(f"Multiroom: Leader {host} nicht gefunden: {e}")
+            return
+        self._leader_addresses = {info[4] for info in infos}
+        self._leader_resolved = self.clock.monotonic()
+
+    def _probe_loop(self):
+        while self._running:
+            if (self._leader_resolved is None or
+                    self.clock.monotonic() - self._leader_resolved > LEADER_RESOLVE_INTERVAL):
+                self._resolve_leader()
+            self._send({'type': 'probe', 't0': self.clock.monotonic(), 'name': self.name}, self.leader)
+            time.sleep(PROBE_INTERVAL)
+
+    def _receive_loop(self):
+        while self._running:
+            try:
+                data, address = self._sock.recvfrom(MAX_DATAGRAM)
+                received = self.clock.monotonic()
+                message = json.loads(data)
+            except socket.timeout:
+                continue
+            except (OSError, ValueError):
+                if not self._running:
+                    break
+                continue
+
+            kind = message.get('type')
+            if kind == 'probe' and self.role == 'leader':
+                self.followers[address] = (message.get('name'), received)
+                self._send({'type': 'reply', 't0': message['t0'], 't1': received,
+                            't2': self.clock.monotonic(), 'command': self._command}, address)
+            elif self.role != 'follower':
+                continue
+            elif address not in self._leader_addresses:
+                logger.debug(f"Multiroom: Nachricht von {address} ignoriert, nicht der Leader")
+            elif kind == 'reply':
+                self.sync.add_sample(message['t0'], message['t1'], message['t2'], received)
+                self._apply(message.get('command'))
+            elif kind in ('play', 'stop') and self.sync.ready:
+                self._apply(message)
+
+def create_multiroom():
+    """
+    Create the node configured with MULTIROOM_ROLE.
+
+    Returns:
+        MultiroomNode: The started node, None if multiroom is off or NumPy
+            is missing
+    """
+    if MULTIROOM_ROLE not in ('leader', 'follower'):
+        return None
+    if np is None:
+        logger.warning("NumPy nicht installiert, Multiroom deaktiviert")
+        return None
+    try:
+        node = MultiroomNode(MULTIROOM_ROLE, AlsaSink(AUDIO_DEVICE, MULTIROOM_OUTPUT_LATENCY_MS / 1000),
+                             leader=MULTIROOM_LEADER)
+        node.start()
+        return node
+    except (OSError, ValueError) as e:
+        logger.error(f"Multiroom konnte nicht gestartet werden: {e}")
+        return None
+
+class _SkewedClock:
+    """System clock shifted by a constant, so the clock sync has work to do"""
+    def __init__(self, skew):
+        self.skew = skew
+
+    def monotonic(self):
+        return time.monotonic() + self.skew
+
+def _run_node(args):
+    """One box of the self-check, writing to a paced WAV file"""
+    sink = PacedFileSink(args.sink, rate_error_ppm=args.ppm)
+    node = MultiroomNode(args.role, sink, leader=args.leader, port=args.port, lead_time=0.5,
+                         clock=_SkewedClock(args.skew), music_dir=args.music_dir, name=os.path.basename(args.sink))
+    node.start()
+    started = time.monotonic()
+    played = False
+    while time.monotonic() - started < args.duration:
+        if args.role == 'leader' and not played and len(node.followers) >= args.wait_followers:
+            node.play(args.play)
+            played = True
+        time.sleep(0.05)
+    status = node.status()
+    status['true_offset_ms'] = round(-args.skew * 1000, 3) if args.role == 'follower' else 0.0
+    node.close()
+    with open(f"{args.sink}.status.json", 'w') as f:
+        json.dump(status, f)
+
+def _click_times(path):
+    """Times (on the shared monotonic clock) of the clicks in an output file"""
+    import wave
+    with open(f"{path}.json") as f:
+        timing = json.load(f)
+    with wave.open(path, 'rb') as w:
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2').reshape(-1, CHANNELS)[:, 0]
+    loud = np.flatnonzero(np.abs(samples.astype(np.int32)) > 8000)
+    clicks = []
+    for index in loud:
+        if not clicks or index - clicks[-1][-1] > SAMPLE_RATE // 10:
+            clicks.append([index])
+        else:
+            clicks[-1].append(index)
+    return [timing['started'] + group[int(np.argmax(np.abs(samples[group])))] / timing['rate'] for group in clicks]
+
+def _self_check(port=5750, duration=14.0):
+    """
+    A leader and three followers on this machine write WAV files that
+    play in real time. The sound cards run at different rates and the
+    followers' clocks are off by seconds; one follower starts late. The
+    clicks in the test track (every 0.5 s) are compared across the files.
+    """
+    import wave
+    import tempfile
+    import subprocess
+
+    root = tempfile.mkdtemp(prefix='kap-multiroom-')
+    track = os.path.join(root, 'clicks.wav')
+    frames = int(SAMPLE_RATE * (duration - 4))
+    signal = np.zeros(frames, dtype='<i2')
+    signal[::SAMPLE_RATE // 2] = 30000
+    with wave.open(track, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(signal.tobytes())
+
+    nodes = [
+        # name, role, sound card rate error (ppm), clock skew (s), start delay (s)
+        ('leader', 'leader', 0, 0.0, 0.0),
+        ('kitchen', 'follower', 300, 2.5, 0.0),
+        ('bedroom', 'follower', -250, -1.3, 0.0),
+        ('late', 'follower', 150, 7.0, 4.0),
+    ]
+    processes = []
+    started = time.monotonic()
+    for name, role, ppm, skew, delay in nodes:
+        time.sleep(max(0.0, delay - (time.monotonic() - started)))
+        command = [sys.executable, '-m', 'utils.multiroom', 'node', '--role', role,
+                   '--sink', os.path.join(root, f"{name}.wav"), '--ppm', str(ppm), '--skew', str(skew),
+                   '--port', str(port), '--music-dir', root, '--duration', str(duration - delay)]
+        if role == 'leader':
+            command += ['--play', 'clicks.wav', '--wait-followers', '2']
+        else:
+            command += ['--leader', f"127.0.0.1:{port}"]
+        processes.append(subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    for process in processes:
+        process.wait(timeout=duration + 30)
+
+    reference = _click_times(os.path.join(root, 'leader.wav'))
+    print(f"{len(reference)} clicks from the leader")
+    print(f"{'box':>8} {'ppm':>5} {'clock err':>10} {'clicks':>7} {'mean off':>9} {'max off':>8} "
+          f"{'last off':>9} {'uncorrected':>12}")
+    ok = len(reference) > 10
+    for name, role, ppm, skew, delay in nodes[1:]:
+        path = os.path.join(root, f"{name}.wav")
+        with open(f"{path}.status.json") as f:
+            status = json.load(f)
+        times = _click_times(path)
+        # Match each click to the leader's click closest in time
+        offsets = [min((t - r for r in reference), key=abs) * 1000 for t in times]
+        offsets = [o for o in offsets if abs(o) < 250]
+        clock_error = (status['offset_ms'] or 0) - status['true_offset_ms']
+        drift = ppm * 1e-6 * (duration - 4) * 1000
+        mean = sum(abs(o) for o in offsets) / len(offsets) if offsets else float('nan')
+        worst = max((abs(o) for o in offsets), default=float('nan'))
+        last = offsets[-1] if offsets else float('nan')
+        print(f"{name:>8} {ppm:>5} {clock_error:>8.2f}ms {len(offsets):>7} {mean:>7.2f}ms {worst:>6.2f}ms "
+              f"{last:>7.2f}ms {drift:>10.2f}ms")
+        ok = ok and len(offsets) >= len(reference) - (2 * delay + 2) and worst < 10
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Synchronized playback on several boxes")
+    commands = parser.add_subparsers(dest='command', required=True)
+    node_parser = commands.add_parser('node', help="run one box writing to a WAV file")
+    node_parser.add_argument('--role', choices=('leader', 'follower'), required=True)
+    node_parser.add_argument('--sink', required=True, help="WAV file to write")
+    node_parser.add_argument('--leader', help="host:port of the leader")
+    node_parser.add_argument('--port', type=int, default=MULTIROOM_PORT)
+    node_parser.add_argument('--ppm', type=float, default=0.0, help="rate error of the simulated sound card")
+    node_parser.add_argument('--skew', type=float, default=0.0, help="offset of this box's clock in seconds")
+    node_parser.add_argument('--music-dir', default=MUSIC_DIR)
+    node_parser.add_argument('--play', help="track the leader plays")
+    node_parser.add_argument('--wait-followers', type=int, default=0)
+    node_parser.add_argument('--duration', type=float, default=10.0)
+    check_parser = commands.add_parser('self-check', help="leader and followers on this machine")
+    check_parser.add_argument('--port', type=int, default=5750)
+    args = parser.parse_args()
+
+    if args.command == 'node':
+        _run_node(args)
+    else:
+        sys.exit(_self_check(args.port))
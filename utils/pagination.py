@@ -0,0 +1,108 @@
+"""
+Cursor pagination, search and sorting for list endpoints
+"""
+import base64
+import json
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+def _sort_value(value):
+    """Normalize a value so that it can be compared case-insensitively"""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value.casefold()
+    return value
+
+def encode_cursor(sort, item, key, id_key):
+    """Encode the position after an item as an opaque cursor string"""
+    raw = json.dumps([sort, _sort_value(item.get(key)), item.get(id_key)])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor created by encode_cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort, value, item_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return sort, value, item_id
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def paginate(items, args, sort_keys, search_fields, id_key, default_sort):
+    """
+    Filter, sort and slice a list of dictionaries.
+
+    Supported query arguments:
+        q: case-insensitive substring that one of the search fields must contain
+        prefix: case-insensitive prefix that one of the search fields must start with
+        sort: one of sort_keys, prefixed with '-' for descending order
+        limit: maximum number of items to return (all items if omitted)
+        cursor: value of the next cursor of the previous page
+
+    Args:
+        items (list): List of dictionaries
+        args (MultiDict): Request query arguments
+        sort_keys (tuple): Keys the client may sort by
+        search_fields (tuple): Keys that are searched by q and prefix
+        id_key (str): Unique key used to break ties between equal sort values
+        default_sort (str): Sort used when the client does not specify one
+
+    Returns:
+        tuple: (page items, next cursor or None, total number of matching items)
+
+    Raises:
+        ValueError: If one of the arguments is invalid
+    """
+    query = args.get('q', '').strip().casefold()
+    prefix = args.get('prefix', '').strip().casefold()
+    sort = args.get('sort', default_sort)
+    key = sort.lstrip('-')
+    descending = sort.startswith('-')
+
+    if key not in sort_keys:
+        raise ValueError(f"Invalid sort key: {key}")
+
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError(f"Invalid limit: {limit}")
+        limit = max(1, min(limit, MAX_LIMIT))
+
+    # Filter by substring and prefix
+    if query or prefix:
+        def matches(item):
+            values = [_sort_value(item.get(field)) for field in search_fields]
+            values = [value for value in values if isinstance(value, str)]
+            if query and not any(query in value for value in values):
+                return False
+            if prefix and not any(value.startswith(prefix) for value in values):
+                return False
+            return True
+        items = [item for item in items if matches(item)]
+
+    def position(item):
+        return (_sort_value(item.get(key)), _sort_value(item.get(id_key)))
+
+    items = sorted(items, key=position, reverse=descending)
+    total = len(items)
+
+    # Skip everything up to and including the cursor position
+    cursor = args.get('cursor')
+    if cursor:
+        cursor_sort, value, item_id = decode_cursor(cursor)
+        if cursor_sort != sort:
+            raise ValueError("Cursor does not match the requested sort order")
+        after = (value, _sort_value(item_id))
+        if descending:
+            items = [item for item in items if position(item) < after]
+        else:
+            items = [item for item in items if position(item) > after]
+
+    if limit is None or len(items) <= limit:
+        return items, None, total
+
+    page = items[:limit]
+    return page, encode_cursor(sort, page[-1], key, id_key), total
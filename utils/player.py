@@ -2,21 +2,297 @@
 MP3 Player for the Kids Audio Player
 """
 import os
+import time
+import weakref
 import subprocess
+import threading
 import logging
-from config import MUSIC_DIR
+from config import MUSIC_DIR, PLAYBACK_ENGINE, AUDIO_DEVICE, FADE_IN_MS, FADE_OUT_MS, CROSSFADE_MS
+from utils.transcode import resolve_playback_path
+from utils import sched_policy
+from utils.audio_telemetry import telemetry
 
 logger = logging.getLogger(__name__)
 
 # Global variable to store the current playback process
 current_process = None
 
+# Function returning the playback gain of a track in dB (see set_gain_provider)
+_gain_provider = None
+
+# Default output scale factor of mpg123
+MPG123_SCALE = 32768
+
+# Mixers when PLAYBACK_ENGINE is 'mixer', one per output device (see get_mixer)
+_mixers = {}
+_mixer_lock = threading.Lock()
+
+# Seconds a new decoder may take before missing progress counts as a stall
+DECODER_STARTUP_GRACE = 2.0
+
+# Playing mpg123 processes, checked by the watchdog (see decoder_health)
+_decoders = weakref.WeakSet()
+
+class Mpg123Process:
+    """
+    mpg123 in remote control mode (-R) playing one file
+
+    mpg123 reports every decoded frame as an '@F' line on stdout. A
+    reader thread keeps the last frame and when it arrived, so a decoder
+    that hangs can be told from one that plays, and restarted at the
+    frame it reached. The frames and what mpg123 writes to stderr also
+    go to the telemetry session of the playback.
+    """
+    def __init__(self, path, args=(), command=('mpg123',), track=None):
+        """
+        Args:
+            path (str): File to play
+            args (list): Further mpg123 options (output device, scale)
+            command (tuple): mpg123 executable, replaced in the tests
+            track (str): Track name for the telemetry, default the file name
+        """
+        self.path = path
+        self.args = list(args)
+        self.command = list(command)
+        self.frame = 0
+        self.seconds = 0.0
+        self.finished = False
+        self.stopped = False
+        self.error = None
+        self.restarts = 0
+        self.process = None
+        self.last_progress = 0.0
+        self._lock = threading.Lock()
+        device = self.args[self.args.index('-a') + 1] if '-a' in self.args[:-1] else 'default'
+        self.telemetry = telemetry.start(track or os.path.basename(path), device, 'mpg123')
+        self._start(0)
+        _decoders.add(self)
+
+    def _start(self, frame):
+        process = subprocess.Popen(
+            self.command + ['-R'] + self.args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        sched_policy.apply_to_process(sched_policy.DECODER, process)
+        self.process = process
+        self.last_progress = time.monotonic() + DECODER_STARTUP_GRACE
+        threading.Thread(target=self._read_status, args=(process,), daemon=True).start()
+        threading.Thread(target=self._read_errors, args=(process,), daemon=True).start()
+        self._send(process, f"LOAD {self.path}")
+        if frame:
+            self._send(process, f"JUMP {frame}")
+
+    @staticmethod
+    def _send(process, command):
+        try:
+            process.stdin.write(command + '\n')
+            process.stdin.flush()
+        except (OSError, ValueError):
+            pass  # Already gone, the watchdog or the caller notices
+
+    @staticmethod
+    def _close_input(process):
+        # mpg123 -R quits at the end of its input
+        try:
+            process.stdin.close()
+        except (OSError, ValueError):
+            pass
+
+    def _read_status(self, process):
+        """Follow the status lines of one mpg123 process"""
+        playing = False
+        try:
+            for line in process.stdout:
+                current = process is self.process
+                if line.startswith('@F '):
+                    parts = line.split()
+                    playing = True
+                    if current and len(parts) >= 4:
+                        frame = int(parts[1])
+                        self.seconds = float(parts[3])
+                        self.telemetry.progress(self.seconds, max(0, frame - self.frame))
+                        self.frame = frame
+                        self.last_progress = time.monotonic()
+                elif line.startswith('@P 0'):
+                    # End of the track
+                    if current:
+                        self.telemetry.end()
+                        self.finished = True
+                    self._close_input(process)
+                elif line.startswith('@E '):
+                    if current:
+                        self.error = line[3:].strip()
+                        self.telemetry.decode_error(self.error)
+                        logger.warning(f"mpg123: {self.error} ({self.path})")
+                    if not playing:
+                        # The file could not be opened, there is nothing to wait for
+                        if current:
+                            self.telemetry.end()
+                            self.finished = True
+                        self._close_input(process)
+        except (OSError, ValueError):
+            pass
+
+    def _read_errors(self, process):
+        """Follow what one mpg123 process writes to stderr (decode errors, xruns)"""
+        try:
+            for line in process.stderr:
+                if process is self.process:
+                    self.telemetry.stderr_line(line)
+        except (OSError, ValueError):
+            pass
+
+    def poll(self):
+        """Exit code of the mpg123 process, None while it runs"""
+        return self.process.poll()
+
+    def is_playing(self):
+        return not self.finished and not self.stopped and self.process.poll() is None
+
+    def stalled(self, timeout):
+        """
+        Check whether the decoder hangs.
+
+        Returns:
+            str: Reason ('no progress: ...' or 'exited: ...'), None if fine
+        """
+        if self.finished or self.stopped:
+            return None
+        code = self.process.poll()
+        if code is not None:
+            return f"exited: code {code}"
+        idle = time.monotonic() - self.last_progress
+        if idle > timeout:
+            return f"no progress: {idle:.1f} s at frame {self.frame}"
+        return None
+
+    def restart(self):
+        """Replace the mpg123 process, continuing at the last frame"""
+        with self._lock:
+            if self.stopped:
+                return
+            old = self.process
+            self._start(self.frame)
+            self.restarts += 1
+            self.telemetry.resumed()
+        _kill(old)
+        logger.warning(f"mpg123 neu gestartet bei Frame {self.frame}: {self.path}")
+
+    def stop(self):
+        """Stop playback, killing mpg123 if it does not terminate"""
+        with self._lock:
+            self.stopped = True
+            _decoders.discard(self)
+        _kill(self.process)
+        self.telemetry.end()
+
+def _kill(process, timeout=1):
+    """Terminate a process, kill it if it does not exit in time"""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Prozess {process.pid} reagiert nicht, wird beendet")
+        process.kill()
+        process.wait(timeout=timeout)
+
+def decoder_health(timeout):
+    """
+    Check the playing decoders (watchdog check).
+
+    Returns:
+        str: Reason of the first stalled decoder, None if all are fine
+    """
+    for decoder in list(_decoders):
+        reason = decoder.stalled(timeout)
+        if reason:
+            return f"{reason} ({os.path.basename(decoder.path)})"
+    for mixer in list(_mixers.values()):
+        reason = mixer.stalled(timeout)
+        if reason:
+            return reason
+    return None
+
+def restart_stalled_decoders(timeout):
+    """Restart the decoders that stalled (watchdog restart)"""
+    for decoder in list(_decoders):
+        if decoder.stalled(timeout):
+            decoder.restart()
+    for mixer in list(_mixers.values()):
+        if mixer.stalled(timeout):
+            mixer.recover(timeout)
+
+def set_gain_provider(provider):
+    """
+    Set the function used to look up the playback gain of a track.
+    
+    Args:
+        provider (callable): Takes the MP3 filename and returns the gain in dB
+    """
+    global _gain_provider
+    _gain_provider = provider
+
+def track_gain(mp3_filename):
+    """Get the playback gain of a track in dB"""
+    if not _gain_provider:
+        return 0.0
+    
+    try:
+        return _gain_provider(mp3_filename) or 0.0
+    except Exception as e:
+        logger.error(f"Fehler beim Ermitteln der Lautstärke: {e}")
+        return 0.0
+
+def gain_args(mp3_filename):
+    """Get the mpg123 arguments that apply the gain of a track"""
+    gain = track_gain(mp3_filename)
+    if not gain:
+        return []
+    return ['-f', str(int(MPG123_SCALE * 10 ** (gain / 20)))]
+
+def get_mixer(device=None):
+    """
+    Get the mixer of an output device.
+    
+    Every device has its own mixer, so players on different devices
+    (e.g. the readers of a pool) do not crossfade or stop each other.
+    
+    Args:
+        device (str): ALSA output device, None for AUDIO_DEVICE
+    
+    Returns:
+        Mixer: The mixer, or None if the mpg123 engine is configured or
+            the mixer is not available
+    """
+    if PLAYBACK_ENGINE != 'mixer':
+        return None
+    
+    device = device or AUDIO_DEVICE
+    with _mixer_lock:
+        if device not in _mixers:
+            from utils.mixer import Mixer, AlsaSink, np
+            if np is None:
+                logger.warning("NumPy nicht installiert, verwende mpg123 statt Mixer")
+                return None
+            mixer = Mixer(AlsaSink(device), FADE_IN_MS, FADE_OUT_MS, CROSSFADE_MS)
+            mixer.start()
+            _mixers[device] = mixer
+        return _mixers[device]
+
 def start_playback(mp3_filename):
     """Start playing an MP3 file"""
     global current_process
     
-    # Stop any existing playback
-    stop_playback()
+    # Stop any existing playback (the mixer crossfades into the new track instead)
+    mixer = get_mixer()
+    if not mixer or not mp3_filename:
+        stop_playback()
     
     if not mp3_filename:
         logger.warning("Keine MP3-Datei angegeben")
@@ -31,12 +307,16 @@ def start_playback(mp3_filename):
     
     try:
         # Start playback with mpg123
-        # Use the 3.5mm jack for audio output
-        current_process = subprocess.Popen(
-            ['mpg123', '-a', 'hw:0,0', mp3_path],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
+        # Output on the configured ALSA device (3.5mm jack by default)
+        # Play a transcoded copy if the source is heavy or not an MP3
+        play_path = resolve_playback_path(mp3_path)
+        
+        if mixer:
+            mixer.play(play_path, track_gain(mp3_filename), track=mp3_filename)
+            logger.info(f"Starte Wiedergabe: {mp3_filename}")
+            return True
+        
+        current_process = Mpg123Process(play_path, ['-a', AUDIO_DEVICE] + gain_args(mp3_filename), track=mp3_filename)
         logger.info(f"Starte Wiedergabe: {mp3_filename}")
         return True
     except Exception as e:
@@ -47,10 +327,13 @@ def stop_playback():
     """Stop the current playback"""
     global current_process
     
+    mixer = get_mixer()
+    if mixer:
+        mixer.stop()
+    
     if current_process:
         try:
-            current_process.terminate()
-            current_process.wait(timeout=1)
+            current_process.stop()
             logger.info("Wiedergabe gestoppt")
         except Exception as e:
             logger.error(f"Fehler beim Stoppen der Wiedergabe: {e}")
@@ -58,15 +341,22 @@ def stop_playback():
             current_process = None
 
 class MP3Player:
-    def __init__(self):
+    def __init__(self, device=None):
+        """
+        Args:
+            device (str): ALSA output device, None for the default device
+        """
         self.process = None
-        logger.info("MP3 Player initialized")
+        self.device = device
+        logger.info(f"MP3 Player initialized (device: {device or 'default'})")
 
     def play(self, filename):
         """Play an MP3 file"""
         try:
-            # Stop any currently playing song
-            self.stop()
+            # Stop any currently playing song (the mixer crossfades instead)
+            mixer = get_mixer(self.device)
+            if not mixer:
+                self.stop()
             
             # Get the full path to the MP3 file
             filepath = os.path.join(MUSIC_DIR, filename)
@@ -75,11 +365,16 @@ class MP3Player:
                 logger.error(f"MP3 file not found: {filepath}")
                 return False
             
+            if mixer:
+                mixer.play(resolve_playback_path(filepath), track_gain(filename), track=filename)
+                logger.info(f"Playing MP3: {filename}")
+                return True
+            
             # Play the MP3 file using mpg123
-            self.process = subprocess.Popen(
-                ['mpg123', '-q', filepath],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+            self.process = Mpg123Process(
+                resolve_playback_path(filepath),
+                (['-a', self.device] if self.device else []) + gain_args(filename),
+                track=filename
             )
             logger.info(f"Playing MP3: {filename}")
             return True
@@ -90,12 +385,22 @@ class MP3Player:
 
     def stop(self):
         """Stop the currently playing song"""
+        mixer = get_mixer(self.device)
+        if mixer:
+            mixer.stop()
+        
         if self.process:
             try:
-                self.process.terminate()
-                self.process.wait(timeout=1)
+                self.process.stop()
                 logger.info("MP3 playback stopped")
             except Exception as e:
                 logger.error(f"Error stopping MP3 playback: {e}")
             finally:
-                self.process = None 
\ No newline at end of file
+                self.process = None
+
+    def is_playing(self):
+        """Check whether a song is playing"""
+        mixer = get_mixer(self.device)
+        if mixer and mixer.is_playing():
+            return True
+        return self.process is not None and self.process.is_playing()
@@ -0,0 +1,353 @@
+"""
+Pool of several RFID readers on one Raspberry Pi
+
+All readers share the SPI bus, so a single scheduler thread polls them
+one after another. Every reader is polled once per interval; the
+scheduler always picks the reader whose poll is due first and the polls
+are spread evenly over the interval, so adding readers does not change
+how quickly a card on any of them is seen (as long as all polls fit into
+one interval).
+
+Each reader keeps its own debounce state and reports events with its ID,
+so the application can bind readers to their own output or playlist slot.
+The callbacks run one after another in a worker thread, so looking up a
+tag and starting its track does not delay the polls of the other readers.
+"""
+import threading
+import logging
+from collections import namedtuple
+from utils.clock import system_clock
+from utils.watchdog import Heartbeat
+from utils.callback_worker import CallbackWorker
+from utils import sched_policy
+
+logger = logging.getLogger(__name__)
+
+# Failed polls in a row after which the watchdog resets the readers
+READER_ERROR_LIMIT = 5
+
+ReaderSpec = namedtuple('ReaderSpec', ['reader_id', 'bus', 'device', 'output'])
+
+def parse_reader_specs(spec):
+    """
+    Parse the RFID_READERS setting.
+
+    Readers are separated by ';' and written as name=bus:device, optionally
+    followed by @ and an audio device, e.g. "corner=0:0@hw:0,0;desk=0:1@hw:1,0".
+
+    Returns:
+        list: ReaderSpec tuples
+
+    Raises:
+        ValueError: If the setting is malformed
+    """
+    specs = []
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        try:
+            reader_id, address = entry.split('=', 1)
+            address, _, output = address.partition('@')
+            bus, device = address.split(':')
+            specs.append(ReaderSpec(reader_id.strip(), int(bus), int(device), output.strip() or None))
+        except ValueError:
+            raise ValueError(f"Invalid reader specification: {entry!r}")
+    if len({s.reader_id for s in specs}) != len(specs):
+        raise ValueError("Reader names must be unique")
+    return specs
+
+class PooledReader:
+    """
+    A reader in the pool with its debounce state and latency statistics
+    """
+    def __init__(self, reader_id, reader, output=None):
+        self.reader_id = reader_id
+        self.reader = reader
+        self.output = output
+        self.current_tag = None
+        self.current_text = None
+        self.misses = 0
+        self.next_due = 0.0
+        self.consecutive_errors = 0
+        # Statistics
+        self.polls = 0
+        self.errors = 0
+        self.poll_time_total = 0.0
+        self.poll_time_max = 0.0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def stats(self):
+        """
+        Get the latency statistics of this reader.
+
+        poll is the time the SPI transfers of one poll took, lag is how late
+        the poll started compared to its schedule. A card is seen at most
+        interval + lag + poll after it was placed on the reader.
+        """
+        polls = self.polls or 1
+        return {
+            'reader_id': self.reader_id,
+            'polls': self.polls,
+            'errors': self.errors,
+            'consecutive_errors': self.consecutive_errors,
+            'avg_poll_ms': round(self.poll_time_total / polls * 1000, 3),
+            'max_poll_ms': round(self.poll_time_max * 1000, 3),
+            'avg_lag_ms': round(self.lag_total / polls * 1000, 3),
+            'max_lag_ms': round(self.lag_max * 1000, 3),
+            'current_tag': self.current_tag
+        }
+
+class ReaderPool:
+    """
+    Time-slices SPI access across several readers
+    """
+    def __init__(self, readers, callback=None, interval=0.1, removal_misses=3,
+                 read_text=False, clock=None):
+        """
+        Args:
+            readers (list): PooledReader objects
+            callback (callable): Called with (tag_id, status, reader_id),
+                status is 'present' or 'absent'; in a worker thread while
+                the scheduler thread runs
+            interval (float): Time between two polls of the same reader
+            removal_misses (int): Empty polls in a row before a tag counts
+                as removed
+            read_text (bool): Read the text of a new tag once (self-describing cards)
+            clock: Clock for the schedule, defaults to the system clock
+        """
+        self.readers = {r.reader_id: r for r in readers}
+        self.callback = callback
+        self.interval = interval
+        self.removal_misses = removal_misses
+        self.read_text = read_text
+        self.clock = clock or system_clock
+        self.spi_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.heartbeat = Heartbeat()
+        self._loop_id = 0    # Bumped on restart, older loops then exit
+        self._callbacks = CallbackWorker('reader-pool-callbacks')
+        self._schedule()
+
+    def _schedule(self):
+        """Spread the first polls of all readers evenly over one interval"""
+        now = self.clock.monotonic()
+        count = len(self.readers) or 1
+        for i, reader in enumerate(self.readers.values()):
+            reader.next_due = now + i * self.interval / count
+
+    def _emit(self, tag_id, status, reader, inline=False):
+        """
+        Report a tag event.
+
+        Args:
+            inline (bool): Call the callback in this thread (poll_next()
+                called directly, e.g. by the load test)
+        """
+        if not self.callback:
+            return
+        if not inline:
+            self._callbacks.submit(self._call, tag_id, status, reader)
+            return
+        self._call(tag_id, status, reader)
+
+    def _call(self, tag_id, status, reader):
+        try:
+            self.callback(tag_id, status, reader.reader_id)
+        except Exception as e:
+            logger.error(f"Fehler im Callback von Leser {reader.reader_id}: {e}")
+
+    def _poll(self, reader, loop_id=None):
+        """
+        Poll one reader and update its debounce state.
+
+        Returns:
+            bool: False if the loop was replaced by restart() (nothing read)
+        """
+        with self.spi_lock:
+            # A replaced loop must not touch the bus again
+            if loop_id is not None and loop_id != self._loop_id:
+                return False
+            tag_id = reader.reader.read_id_no_block()
+            text = None
+            if tag_id and str(tag_id) != reader.current_tag and self.read_text:
+                read_id, text = reader.reader.read_no_block()
+                if read_id != tag_id:
+                    text = None
+            if loop_id is not None and loop_id != self._loop_id:
+                # The read hung until restart() reset the reader
+                return False
+
+        inline = loop_id is None
+        if tag_id:
+            reader.misses = 0
+            tag_id = str(tag_id)
+            if tag_id != reader.current_tag:
+                logger.debug(f"Leser {reader.reader_id}: Neuer Tag erkannt: {tag_id}")
+                if reader.current_tag:
+                    self._emit(reader.current_tag, 'absent', reader, inline)
+                reader.current_tag = tag_id
+                reader.current_text = text
+                self._emit(tag_id, 'present', reader, inline)
+        elif reader.current_tag:
+            reader.misses += 1
+            if reader.misses >= self.removal_misses:
+                logger.debug(f"Leser {reader.reader_id}: Tag entfernt: {reader.current_tag}")
+                tag_id, reader.current_tag, reader.current_text = reader.current_tag, None, None
+                reader.misses = 0
+                self._emit(tag_id, 'absent', reader, inline)
+        return True
+
+    def poll_next(self, loop_id=None):
+        """
+        Wait for the next due reader and poll it.
+
+        Args:
+            loop_id (int): ID of the calling scheduler loop, it stops
+                polling once restart() replaced it. Without it the callback
+                is called in this thread.
+
+        Returns:
+            PooledReader: The polled reader, or None if the pool is empty
+                or the loop was replaced
+        """
+        if not self.readers:
+            return None
+        reader = min(self.readers.values(), key=lambda r: r.next_due)
+
+        delay = reader.next_due - self.clock.monotonic()
+        if delay > 0:
+            self.clock.sleep(delay)
+
+        started = self.clock.monotonic()
+        try:
+            if not self._poll(reader, loop_id):
+                return None
+            reader.consecutive_errors = 0
+        except Exception as e:
+            reader.errors += 1
+            reader.consecutive_errors += 1
+            logger.error(f"Leser {reader.reader_id}: Fehler beim Lesen: {e}")
+        finished = self.clock.monotonic()
+
+        lag = max(0.0, started - reader.next_due)
+        reader.polls += 1
+        reader.poll_time_total += finished - started
+        reader.poll_time_max = max(reader.poll_time_max, finished - started)
+        reader.lag_total += lag
+        reader.lag_max = max(reader.lag_max, lag)
+
+        # Keep the schedule, but skip polls that were missed completely
+        reader.next_due += self.interval
+        if reader.next_due < finished:
+            reader.next_due = finished + self.interval
+        return reader
+
+    def write_once(self, reader_id, text):
+        """
+        Write text to the tag on one reader.
+
+        Returns:
+            str: ID of the written tag, or None
+        """
+        reader = self.readers[reader_id]
+        try:
+            with self.spi_lock:
+                tag_id, _ = reader.reader.write_no_block(text)
+            return str(tag_id) if tag_id else None
+        except Exception as e:
+            logger.error(f"Leser {reader_id}: Fehler beim Schreiben: {e}")
+            return None
+
+    def stats(self):
+        """Get the latency statistics of all readers"""
+        return [reader.stats() for reader in self.readers.values()]
+
+    def start(self):
+        """Start the scheduler thread"""
+        if self.running:
+            return
+        self.running = True
+        self._schedule()
+        self.heartbeat.beat()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logger.info(f"Leser-Pool gestartet mit {len(self.readers)} Lesern")
+
+    def check_health(self, timeout):
+        """
+        Check the scheduler thread and the readers (watchdog check).
+
+        Returns:
+            str: Reason, None while all readers answer
+        """
+        if not self.running or self.thread is None:
+            return None
+        age = self.heartbeat.age()
+        if age > timeout:
+            return f"no heartbeat: {age:.1f} s"
+        failing = [r.reader_id for r in self.readers.values() if r.consecutive_errors >= READER_ERROR_LIMIT]
+        if failing:
+            return f"errors: {', '.join(failing)}"
+        return None
+
+    def restart(self):
+        """
+        Reset the readers and start a new scheduler thread (watchdog restart).
+
+        The readers are reset while holding the SPI lock unless a thread
+        that hangs in a transfer holds it. That thread exits once the
+        transfer returns, without touching the bus again; the new thread
+        waits for the lock before its first poll.
+        """
+        self._loop_id += 1
+        locked = self.spi_lock.acquire(timeout=0.05)
+        try:
+            for reader in self.readers.values():
+                if hasattr(reader.reader, 'reset'):
+                    try:
+                        reader.reader.reset()
+                    except Exception as e:
+                        logger.error(f"Leser {reader.reader_id}: Reset fehlgeschlagen: {e}")
+                reader.consecutive_errors = 0
+        finally:
+            if locked:
+                self.spi_lock.release()
+        self._schedule()
+        self.heartbeat.beat()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logger.warning(f"Leser-Pool neu gestartet (#{self._loop_id})")
+
+    def stop(self):
+        """Stop the scheduler thread"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def _run(self):
+        sched_policy.apply_to_thread(sched_policy.READER)
+        loop_id = self._loop_id
+        while self.running and loop_id == self._loop_id:
+            self.poll_next(loop_id)
+            if loop_id == self._loop_id:
+                self.heartbeat.beat()
+
+def create_reader_pool(spec, callback=None, **kwargs):
+    """
+    Create a pool of FastMFRC522 readers from the RFID_READERS setting.
+
+    Args:
+        spec (str): Reader specification (see parse_reader_specs)
+        callback (callable): Event callback (tag_id, status, reader_id)
+
+    Returns:
+        ReaderPool: The pool
+    """
+    from utils.mfrc522_fast import FastMFRC522, SpiTransport
+
+    readers = []
+    for s in parse_reader_specs(spec):
+        readers.append(PooledReader(s.reader_id, FastMFRC522(SpiTransport(s.bus, s.device)), s.output))
+        logger.info(f"RFID-Leser {s.reader_id} auf SPI {s.bus}.{s.device} initialisiert")
+    return ReaderPool(readers, callback, **kwargs)
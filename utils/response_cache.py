@@ -0,0 +1,125 @@
+"""
+Cache of serialized JSON responses
+
+List endpoints are polled often, but their data only changes when the
+library or the tags change. The cache keeps the encoded body of each
+response, together with its gzip/brotli variants, under the ETag of the
+response. The ETag contains the data generation, so a bump makes new
+requests miss the cache, and a generation listener drops the outdated
+entries right away. Cache hits only copy bytes into a new response.
+"""
+import json
+import threading
+import logging
+from collections import OrderedDict
+from flask import Response
+from utils.generation import add_listener
+from utils.http_cache import (make_etag, is_not_modified, not_modified_response, choose_encoding,
+                              compress, brotli, COMPRESS_MIN_SIZE)
+
+logger = logging.getLogger(__name__)
+
+class CachedResponse:
+    """
+    A serialized response with its compressed variants
+    """
+    def __init__(self, body, headers=None, status=200):
+        self.bodies = {None: body}
+        self.headers = {k: str(v) for k, v in (headers or {}).items() if v is not None}
+        self.status = status
+        if len(body) >= COMPRESS_MIN_SIZE:
+            self.bodies['gzip'] = compress(body, 'gzip')
+            if brotli is not None:
+                self.bodies['br'] = compress(body, 'br')
+
+    @property
+    def size(self):
+        return sum(len(body) for body in self.bodies.values())
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses, keyed by ETag
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # etag -> (dataset, generation, CachedResponse)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(etag)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, etag, dataset, generation, cached):
+        with self._lock:
+            self._entries[etag] = (dataset, generation, cached)
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, dataset, generation=None):
+        """Drop the entries of a data set older than a generation (all if None)"""
+        with self._lock:
+            stale = [etag for etag, (name, gen, _) in self._entries.items()
+                     if name == dataset and (generation is None or gen < generation)]
+            for etag in stale:
+                del self._entries[etag]
+        if stale:
+            logger.debug(f"Response cache: dropped {len(stale)} entries of {dataset}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(entry[2].size for entry in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+response_cache = ResponseCache()
+add_listener(lambda name, generation, keys, remote: response_cache.invalidate(name, generation))
+
+def cached_json_response(name, dataset, generation, args, build):
+    """
+    Answer a request from the response cache.
+
+    Args:
+        name (str): Name of the endpoint, used in the ETag
+        dataset (str): Data set the response depends on (e.g. TAGS)
+        generation (int): Current generation of the data set
+        args (MultiDict): Query arguments that influence the response
+        build (callable): Builds (payload, headers) on a cache miss
+
+    Returns:
+        Response: The Flask response (304 if the client is up to date)
+    """
+    etag = make_etag(name, generation, args)
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    cached = response_cache.get(etag)
+    if cached is None:
+        payload, headers = build()
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        cached = CachedResponse(body, headers)
+        response_cache.put(etag, dataset, generation, cached)
+
+    encoding = choose_encoding()
+    if encoding not in cached.bodies:
+        encoding = None
+
+    response = Response(cached.bodies[encoding], status=cached.status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers.extend(cached.headers)
+    return response
@@ -12,11 +12,13 @@ from datetime import datetime
 from contextlib import contextmanager
 import signal
 import sys
-from mfrc522 import SimpleMFRC522
-import RPi.GPIO as GPIO
-from flask import current_app
-from models import RFIDTag, db
 from utils.player import start_playback, stop_playback
+from utils.clock import system_clock
+from utils.log_pipeline import throttled
+from utils.watchdog import Heartbeat
+from utils.callback_worker import CallbackWorker
+from utils import sched_policy
+from config import RFID_READER_BACKEND, RFID_SPI_BUS, RFID_SPI_DEVICE, RFID_REMOVAL_MISSES, RFID_CARD_PAYLOAD
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -31,33 +33,50 @@ try:
     from mfrc522 import SimpleMFRC522
     RASPBERRY_PI = True
     logger.info("Running on Raspberry Pi, RFID module enabled")
-    print("[INIT] Running on Raspberry Pi, RFID module enabled")
 except (ImportError, RuntimeError) as e:
     RASPBERRY_PI = False
     logger.warning(f"Not running on Raspberry Pi or missing required libraries. RFID functionality will be simulated. Error: {e}")
-    print(f"[INIT] Not running on Raspberry Pi or missing required libraries. RFID functionality will be simulated. Error: {e}")
     
 # Allow force enabling simulation mode for testing (even on Raspberry Pi)
 # Set the environment variable RFID_SIMULATION=1 to enable
 if os.environ.get('RFID_SIMULATION') == '1':
     RASPBERRY_PI = False
     logger.info("RFID simulation mode forced by environment variable")
-    print("[INIT] RFID simulation mode forced by environment variable")
 
 class RFIDHandler:
     """
     Handler for RFID reader operations
     """
-    def __init__(self):
-        """Initialize the RFID handler"""
-        self.reader = None
+    def __init__(self, reader=None, clock=None):
+        """
+        Initialize the RFID handler
+        
+        Args:
+            reader: Reader to use instead of the hardware reader (e.g. a
+                scripted reader for simulations)
+            clock: Clock for the polling loops, defaults to the system clock
+        """
+        self.reader = reader
+        self.clock = clock or system_clock
+        self.removal_misses = RFID_REMOVAL_MISSES
         self.current_tag = None
+        self.current_text = None
+        self._simulated_texts = {}
         self.running = False
         self.thread = None
         self.tag_removal_thread = None
         self.removal_event = threading.Event()
         self.callback = None
         self.scanning = False
+        self.heartbeat = Heartbeat()
+        self._loop_id = 0    # Bumped on restart, older loops then exit
+        # Serializes access to the chip (detection loop, callbacks, bus requests)
+        self.reader_lock = threading.RLock()
+        self._read_started = None
+        # Tag callbacks run here, not in the detection loop
+        self._callbacks = CallbackWorker('rfid-callbacks')
+        if reader is not None:
+            return
         self._init_handler()
         
         # Register signal handlers for clean shutdown
@@ -65,13 +84,11 @@ class RFIDHandler:
         signal.signal(signal.SIGTERM, self._signal_handler)
         
         # Initialize the RFID reader if we're on a Raspberry Pi
-        if RASPBERRY_PI:
+        if RASPBERRY_PI and not self.reader:
             try:
-                self.reader = SimpleMFRC522()
-                print("[INIT] RFID reader initialized successfully")
+                self.reader = self._create_reader()
                 logger.info("RFID reader initialized")
             except Exception as e:
-                print(f"[ERROR] Failed to initialize RFID reader: {e}")
                 logger.error(f"Failed to initialize RFID reader: {e}")
                 self.reader = None
 
@@ -83,7 +100,7 @@ class RFIDHandler:
             
         try:
             # Initialize the reader
-            self.reader = SimpleMFRC522()
+            self.reader = self._create_reader()
             logger.info("RFID-Leser initialisiert")
             
             # Set up signal handlers for clean shutdown
@@ -94,29 +111,64 @@ class RFIDHandler:
             logger.error(f"Fehler beim Initialisieren des RFID-Lesers: {e}")
             self.reader = None
             
-    def _cleanup(self, signum, frame):
-        """Clean up GPIO on shutdown"""
-        logger.info("RFID-Handler wird beendet...")
+    def _create_reader(self):
+        """Create the reader for the configured backend"""
+        if RFID_READER_BACKEND == 'fast':
+            try:
+                from utils.mfrc522_fast import FastMFRC522, SpiTransport
+                return FastMFRC522(SpiTransport(RFID_SPI_BUS, RFID_SPI_DEVICE))
+            except ImportError as e:
+                logger.warning(f"spidev nicht verfügbar, verwende SimpleMFRC522: {e}")
+        return SimpleMFRC522()
+            
+    def cleanup(self):
+        """Release the GPIO pins"""
         if self.reader:
             try:
                 GPIO.cleanup()
                 logger.info("GPIO aufgeräumt")
             except Exception as e:
                 logger.error(f"Fehler beim Aufräumen von GPIO: {e}")
+
+    def _cleanup(self, signum, frame):
+        """Clean up GPIO on shutdown"""
+        logger.info("RFID-Handler wird beendet...")
+        self.cleanup()
         sys.exit(0)
 
-    def read_once(self):
-        """Read a tag once and return its ID and text"""
+    @contextmanager
+    def _reading(self):
+        """Hold the reader and record since when a read is running"""
+        with self.reader_lock:
+            outer, self._read_started = self._read_started, time.monotonic()
+            try:
+                yield
+            finally:
+                self._read_started = outer
+
+    def read_once(self, with_text=False):
+        """
+        Read a tag once and return its ID and text
+        
+        Args:
+            with_text (bool): Also read the text stored on the tag. This
+                needs a full authenticate-and-read, polling for the ID
+                alone is much faster.
+        """
         if not self.reader:
             logger.warning("RFID-Leser nicht initialisiert")
             return None, None
             
         try:
             # Try to read the tag
-            tag_id, text = self.reader.read_no_block()
+            with self._reading():
+                if with_text:
+                    tag_id, text = self.reader.read_no_block()
+                else:
+                    tag_id, text = self.reader.read_id_no_block(), None
             
             if tag_id:
-                logger.debug(f"Tag erkannt! ID: {tag_id}, Text: {text}")
+                throttled(logger, 'rfid-read', f"Tag erkannt! ID: {tag_id}, Text: {text}")
                 return str(tag_id), text
             else:
                 return None, None
@@ -125,6 +177,48 @@ class RFIDHandler:
             logger.error(f"RFID Lesefehler: {e}")
             return None, None
 
+    def read_text(self, tag_id):
+        """
+        Read the text stored on the tag in the field.
+
+        Only done once per new tag, the polling loops only read the ID.
+
+        Args:
+            tag_id (str): Expected ID, the text of a different tag is ignored
+        """
+        if not self.reader:
+            return self._simulated_texts.get(tag_id)
+
+        read_id, text = self.read_once(with_text=True)
+        if read_id != tag_id:
+            return None
+        return text
+
+    def write_once(self, text):
+        """
+        Write text to the tag in the field without waiting for one.
+
+        Returns:
+            str: ID of the written tag, or None if no tag was written
+        """
+        if not self.reader:
+            if RASPBERRY_PI or not self.current_tag:
+                logger.error("RFID reader not initialized")
+                return None
+            # Simulated cards keep their text in memory
+            self._simulated_texts[self.current_tag] = text
+            return self.current_tag
+
+        try:
+            with self._reading():
+                tag_id, _ = self.reader.write_no_block(text)
+            if tag_id:
+                logger.info(f"Successfully wrote to tag {tag_id}: {text}")
+                return str(tag_id)
+        except Exception as e:
+            logger.error(f"Error writing to tag: {e}")
+        return None
+
     def write(self, text):
         """Write text to a tag"""
         if not self.reader:
@@ -132,7 +226,8 @@ class RFIDHandler:
             return False
 
         try:
-            self.reader.write(text)
+            with self._reading():
+                self.reader.write(text)
             logger.info(f"Successfully wrote to tag: {text}")
             return True
         except Exception as e:
@@ -140,9 +235,28 @@ class RFIDHandler:
             return False
 
     def register_callback(self, callback):
-        """Register a callback function for tag events"""
+        """
+        Register a callback function for tag events.
+
+        The callback runs in a worker thread, in the order of the events,
+        while the detection loop keeps polling.
+        """
         self.callback = callback
         logger.info("Callback registered")
+
+    def _emit(self, tag_id, status, inline=False):
+        """
+        Report a tag event to the callback.
+
+        Args:
+            inline (bool): Call it in this thread (run_for() on a virtual clock)
+        """
+        if not self.callback:
+            return
+        if inline:
+            self.callback(tag_id, status)
+        else:
+            self._callbacks.submit(self.callback, tag_id, status)
         
     def start(self):
         """Start the RFID handler"""
@@ -151,11 +265,58 @@ class RFIDHandler:
             return
             
         self.running = True
+        self.heartbeat.beat()
         self.thread = threading.Thread(target=self._detection_loop)
         self.thread.daemon = True
         self.thread.start()
         logger.info("RFID handler started")
 
+    def check_health(self, timeout):
+        """
+        Check whether the detection loop still polls (watchdog check).
+
+        A read that takes longer than the timeout counts as hanging. Only
+        successful polls count as heartbeat, so a reader that fails on
+        every poll is restarted like one that hangs. Tag callbacks run in
+        their own thread and do not count.
+
+        Returns:
+            str: Reason, None while the loop is fine
+        """
+        if not self.running or self.thread is None:
+            return None
+        started = self._read_started
+        if started is not None and time.monotonic() - started > timeout:
+            return f"read hangs: {time.monotonic() - started:.1f} s"
+        age = self.heartbeat.age()
+        if age > timeout:
+            return f"no heartbeat: {age:.1f} s"
+        return None
+
+    def restart(self):
+        """
+        Reset the reader and start a new detection loop (watchdog restart).
+
+        A loop that hangs in a read cannot be interrupted; it exits as
+        soon as the read returns, which the reset is meant to cause. The
+        reader is reset while holding its lock unless that hanging read
+        holds it; the new loop waits for the lock before its first read.
+        """
+        self._loop_id += 1
+        locked = self.reader_lock.acquire(timeout=0.05)
+        try:
+            if self.reader and hasattr(self.reader, 'reset'):
+                self.reader.reset()
+            elif self.reader and RASPBERRY_PI:
+                self.reader = self._create_reader()
+        finally:
+            if locked:
+                self.reader_lock.release()
+        self.heartbeat.beat()
+        self.thread = threading.Thread(target=self._detection_loop, daemon=True)
+        self.thread.start()
+        logger.warning(f"RFID-Erkennung neu gestartet (#{self._loop_id})")
+
     def stop(self):
         """Stop the RFID handler"""
         if not self.running:
@@ -171,23 +332,23 @@ class RFIDHandler:
     
     def _check_tag_removal(self):
         """Separate thread to check for tag removal"""
-        print("[RFID] Tag removal detection thread started")
+        logger.debug("Tag removal detection thread started")
         last_tag_id = None
         consecutive_misses = 0
         
         while self.running:
-            time.sleep(0.1)  # Short interval for quick detection
+            self.clock.sleep(0.1)  # Short interval for quick detection
             
             # If we have a current tag, we need to check if it's still there
             current_tag = self.current_tag
             if current_tag:
                 # Try to read the tag
                 try:
-                    tag_id, _ = self.reader.read_no_block()
+                    tag_id = self.reader.read_id_no_block()
                     if not tag_id:
                         consecutive_misses += 1
                         if consecutive_misses >= 5:  # After 0.5 seconds of no tag
-                            print(f"[RFID REMOVAL] Tag {current_tag} has been removed (after {consecutive_misses} consecutive misses)")
+                            logger.debug(f"Tag {current_tag} has been removed (after {consecutive_misses} consecutive misses)")
                             # Notify callback that tag is gone
                             if self.callback:
                                 self.callback(current_tag, 'absent')
@@ -197,73 +358,98 @@ class RFIDHandler:
                         # Tag is still there
                         consecutive_misses = 0
                 except Exception as e:
-                    print(f"[ERROR] Error checking for tag removal: {e}")
-                    time.sleep(0.5)  # Wait a bit longer on errors
+                    logger.error(f"Error checking for tag removal: {e}")
+                    self.clock.sleep(0.5)  # Wait a bit longer on errors
             else:
                 # No current tag, just reset
                 consecutive_misses = 0
     
-    def _detection_loop(self):
+    def run_for(self, duration):
+        """
+        Run the detection loop in the calling thread for a given time.
+        
+        Meant for simulations on a virtual clock, where this returns as
+        soon as the loop has computed the simulated time.
+        """
+        self.running = True
+        try:
+            self._detection_loop(until=self.clock.monotonic() + duration)
+        finally:
+            self.running = False
+
+    def _detection_loop(self, until=None):
         """Main detection loop, runs in a separate thread"""
+        if until is None:
+            # Not for run_for(), which borrows the caller's thread
+            sched_policy.apply_to_thread(sched_policy.READER)
+
         if not self.reader and not RASPBERRY_PI:
             # In simulation mode
-            self._simulation_loop()
+            self._simulation_loop(until)
             return
             
         if not self.reader:
             logger.error("RFID reader not initialized, detection loop aborted")
             return
             
-        print("============================================")
-        print("RFID detection loop started on Raspberry Pi")
-        print("This will continuously scan for RFID tags")
-        print("============================================")
+        logger.info("RFID detection loop started")
             
-        last_tag_id = None
+        loop_id = self._loop_id
+        # A restarted loop continues with the tag that is on the reader
+        last_tag_id = self.current_tag
+        consecutive_misses = 0
         check_interval = 0.1  # Check every 100ms
         
-        while self.running:
+        inline = until is not None
+        while self.running and loop_id == self._loop_id and (until is None or self.clock.monotonic() < until):
             try:
-                # Use blocking read like in the test program
-                try:
-                    tag_id, text = self.reader.read()
-                    print(f"[DEBUG] RFID: Tag erkannt! ID: {tag_id}, Text: {text}")
+                # Poll only for the UID, the data blocks are not needed to resolve a tag
+                with self._reading():
+                    if loop_id != self._loop_id:
+                        break  # Replaced by the watchdog, the new loop uses the reader
+                    tag_id = self.reader.read_id_no_block()
+                if loop_id != self._loop_id:
+                    break  # Replaced by the watchdog while this read hung
+                self.heartbeat.beat()
+                
+                if tag_id:
+                    consecutive_misses = 0
                     
                     # Convert tag_id to string for consistency
                     tag_id = str(tag_id)
                     
-                    # New tag detected or same tag still present
                     if last_tag_id != tag_id:
                         # It's a new tag
-                        print(f"[DEBUG] RFID: Neuer Tag erkannt: {tag_id}")
-                        if self.callback:
-                            self.callback(tag_id, 'present')
+                        logger.debug(f"RFID: Neuer Tag erkannt: {tag_id}")
+                        previous_tag_id = last_tag_id
+                        # Read the track reference of a self-describing card once
+                        self.current_text = self.read_text(tag_id) if RFID_CARD_PAYLOAD else None
+                        # Set before the callbacks, a restarted loop must not report the tag again
                         last_tag_id = tag_id
                         self.current_tag = tag_id
+                        if previous_tag_id:
+                            self._emit(previous_tag_id, 'absent', inline)
+                        self._emit(tag_id, 'present', inline)
                         
-                except Exception as read_error:
-                    print(f"[ERROR] RFID Lesefehler: {read_error}")
-                    # If we had a previous tag, notify its removal
-                    if last_tag_id:
-                        print(f"[DEBUG] RFID: Tag entfernt: {last_tag_id}")
-                        if self.callback:
-                            self.callback(last_tag_id, 'absent')
+                elif last_tag_id:
+                    consecutive_misses += 1
+                    if consecutive_misses >= self.removal_misses:
+                        logger.debug(f"RFID: Tag entfernt: {last_tag_id}")
+                        removed_tag_id = last_tag_id
                         last_tag_id = None
                         self.current_tag = None
-                        # Stop MP3 playback when tag is removed
-                        if hasattr(self, 'player') and self.player:
-                            self.player.stop()
+                        consecutive_misses = 0
+                        self._emit(removed_tag_id, 'absent', inline)
                 
-                time.sleep(check_interval)
+                self.clock.sleep(check_interval)
                 
             except Exception as e:
-                print(f"[ERROR] RFID Hauptschleife Fehler: {e}")
-                time.sleep(0.5)
+                logger.error(f"RFID Hauptschleife Fehler: {e}")
+                self.clock.sleep(0.5)
     
     def _blocking_read(self):
         """Perform a blocking read in a separate thread to avoid hanging the main loop"""
         try:
-            print("[RFID] Starting blocking RFID read (timeout: 3s)")
             logger.debug("Starting blocking RFID read")
             
             # Add timeout mechanism for blocking read
@@ -276,22 +462,18 @@ class RFIDHandler:
             
             if read_thread.is_alive():
                 # Thread is still running after timeout
-                print("[RFID] Blocking read timed out")
                 logger.warning("Blocking RFID read timed out")
                 return None
                 
             # If we got here, the read completed
             if self.current_tag:
-                print(f"[RFID] Blocking read detected tag: {self.current_tag}")
                 logger.debug(f"Blocking read detected tag: {self.current_tag}")
                 return self.current_tag
             else:
-                print("[RFID] Blocking read returned no tag")
                 logger.debug("Blocking read returned no tag")
                 return None
                 
         except Exception as e:
-            print(f"[RFID ERROR] Error in blocking RFID read: {e}")
             logger.error(f"Error in blocking RFID read: {e}")
             self.current_tag = None
             return None
@@ -299,7 +481,7 @@ class RFIDHandler:
     def _perform_blocking_read(self):
         """Helper for _blocking_read - performs the actual blocking read"""
         if not self.reader:
-            print("[RFID ERROR] No reader available for blocking read")
+            logger.error("No reader available for blocking read")
             return
             
         try:
@@ -307,17 +489,21 @@ class RFIDHandler:
             tag_id, text = self.reader.read()
             if tag_id:
                 self.current_tag = str(tag_id)
-                print(f"[RFID] Raw blocking read result: {tag_id}, {text}")
+                logger.debug(f"Raw blocking read result: {tag_id}, {text}")
         except Exception as e:
-            print(f"[RFID ERROR] Error in _perform_blocking_read: {e}")
+            logger.error(f"Error in _perform_blocking_read: {e}")
             self.current_tag = None
     
-    def _simulation_loop(self):
+    def _simulation_loop(self, until=None):
         """
         Simulation loop for testing without actual hardware
         In real deployment, this would be replaced by actual RFID reading
+        
+        Runs on the handler's clock, see utils.rfid_simulation for
+        scripted card activity.
         """
         logger.info("Starting RFID simulation mode")
+        loop_id = self._loop_id
         
         # In simulation mode, use multiple simulated tags with faster cycling
         simulated_tags = ["12345678", "87654321", "11223344", "55667788", "99001122"]
@@ -337,8 +523,9 @@ class RFIDHandler:
         except:
             pass  # Ignore errors if we can't write to the file
             
-        while self.running:
-            current_time = time.time()
+        while self.running and loop_id == self._loop_id and (until is None or self.clock.monotonic() < until):
+            self.heartbeat.beat()
+            current_time = self.clock.time()
             
             # Check for manual tag simulation input (for testing without hardware)
             try:
@@ -361,9 +548,9 @@ class RFIDHandler:
                     # New tag detected
                     tag_id = manual_tag_request
                     self.current_tag = tag_id
+                    self.current_text = self._simulated_texts.get(tag_id)
                     
-                    if self.callback:
-                        self.callback(tag_id, 'present')
+                    self._emit(tag_id, 'present', until is not None)
                     logger.info(f"[MANUAL SIMULATION] RFID tag detected: {tag_id}")
                     tag_present = True
                     tag_detected_time = current_time
@@ -377,9 +564,9 @@ class RFIDHandler:
                     current_index = (current_index + 1) % len(simulated_tags)
                     tag_id = simulated_tags[current_index]
                     self.current_tag = tag_id
+                    self.current_text = self._simulated_texts.get(tag_id)
                     
-                    if self.callback:
-                        self.callback(tag_id, 'present')
+                    self._emit(tag_id, 'present', until is not None)
                     logger.info(f"[SIMULATION] RFID tag detected: {tag_id}")
                     tag_present = True
                     tag_detected_time = current_time
@@ -387,8 +574,7 @@ class RFIDHandler:
                 elif tag_present and current_time - tag_detected_time > 3:
                     # Simulate tag removal
                     tag_id = simulated_tags[current_index]
-                    if self.callback:
-                        self.callback(tag_id, 'absent')
+                    self._emit(tag_id, 'absent', until is not None)
                     logger.info(f"[SIMULATION] RFID tag removed: {tag_id}")
                     self.current_tag = None
                     tag_present = False
@@ -399,8 +585,7 @@ class RFIDHandler:
                 # After 5 seconds, automatically remove the manual tag
                 if manual_tag_request is not None:
                     tag_id = self.current_tag
-                    if self.callback:
-                        self.callback(tag_id, 'absent')
+                    self._emit(tag_id, 'absent', until is not None)
                     logger.info(f"[MANUAL SIMULATION] RFID tag removed: {tag_id}")
                     self.current_tag = None
                     tag_present = False
@@ -408,7 +593,7 @@ class RFIDHandler:
             
             # Sleep for a short interval to prevent 100% CPU usage
             # but still be very responsive to changes
-            time.sleep(check_interval)
+            self.clock.sleep(check_interval)
     
     def get_current_tag(self):
         """Get the currently detected tag ID"""
@@ -435,6 +620,8 @@ class RFIDHandler:
                         self.current_tag = tag_id
                         
                         # Check if tag is registered
+                        from flask import current_app
+                        from models import RFIDTag
                         with current_app.app_context():
                             tag = RFIDTag.query.filter_by(tag_id=tag_id).first()
                             if tag and tag.mp3_filename:
@@ -451,7 +638,7 @@ class RFIDHandler:
                         self.current_tag = None
                         
                 # Small delay to prevent CPU overload
-                time.sleep(0.1)
+                self.clock.sleep(0.1)
                 
         except Exception as e:
             logger.error(f"Fehler beim Scannen: {e}")
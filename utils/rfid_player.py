@@ -13,9 +13,9 @@ from datetime import datetime
 from models import RFIDTag, Song
 from db import db
 from app import app
+from config import MUSIC_DIR
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Setup logging
 logger = logging.getLogger(__name__)
 
 class RFIDPlayer:
@@ -28,7 +28,7 @@ class RFIDPlayer:
         self.is_playing = False
         self.process = None
         self.callbacks = []
-        self.music_dir = os.environ.get("MUSIC_DIR", os.path.join(os.getcwd(), "mp3s"))
+        self.music_dir = MUSIC_DIR
     
     def init_handler(self, handler):
         """Initialize the RFID handler"""
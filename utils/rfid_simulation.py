@@ -0,0 +1,190 @@
+"""
+Scripted RFID card activity on a virtual clock
+
+A tap schedule describes what happens on the reader over time: cards are
+placed and removed, lifted for a moment (flaps) or misread for a single
+poll. ScriptedReader plays the schedule back through the reader interface,
+so the real detection and debounce code of RFIDHandler runs against it.
+With a VirtualClock, days of activity run in seconds and the results are
+reproducible.
+"""
+import bisect
+import random
+from collections import namedtuple
+from utils.clock import VirtualClock
+
+PRESENT = 'present'
+REMOVE = 'remove'
+FLAP = 'flap'          # Card lifted for `duration` seconds, then back
+MISREAD = 'misread'    # The next poll returns nothing (or `tag_id`, if set)
+
+TapEvent = namedtuple('TapEvent', ['at', 'action', 'tag_id', 'duration'])
+TapEvent.__new__.__defaults__ = (None, 0.0)
+
+def generate_schedule(duration, tag_ids, seed=0, mean_gap=30.0, mean_hold=120.0,
+                      flap_rate=0.05, misread_rate=0.01, flap_duration=0.15):
+    """
+    Generate a random but reproducible tap schedule.
+
+    Args:
+        duration (float): Length of the schedule in seconds
+        tag_ids (list): Tags that are placed on the reader
+        seed (int): Random seed, the same seed gives the same schedule
+        mean_gap (float): Mean time without a card
+        mean_hold (float): Mean time a card stays on the reader
+        flap_rate (float): Flaps per second while a card is on the reader
+        misread_rate (float): Misreads per second while a card is on the reader
+        flap_duration (float): How long a card is lifted during a flap
+
+    Returns:
+        list: TapEvent tuples sorted by time
+    """
+    rng = random.Random(seed)
+    events = []
+    t = rng.expovariate(1 / mean_gap)
+    while t < duration:
+        tag_id = rng.choice(tag_ids)
+        events.append(TapEvent(t, PRESENT, tag_id))
+        removed = t + max(1.0, rng.expovariate(1 / mean_hold))
+
+        # Disturbances while the card is on the reader
+        rate = flap_rate + misread_rate
+        s = t + rng.expovariate(rate) if rate else removed
+        while s < removed - 1.0:
+            if rng.random() < flap_rate / rate:
+                events.append(TapEvent(s, FLAP, tag_id, flap_duration))
+            else:
+                events.append(TapEvent(s, MISREAD))
+            s += rng.expovariate(rate)
+
+        if removed >= duration:
+            break
+        events.append(TapEvent(removed, REMOVE))
+        t = removed + rng.expovariate(1 / mean_gap)
+    return events
+
+class ScriptedReader:
+    """
+    Reader that plays back a tap schedule on a clock
+    """
+    def __init__(self, schedule, clock):
+        self.schedule = sorted(schedule, key=lambda e: e.at)
+        self.clock = clock
+        self.position = 0
+        self.tag_id = None
+        self.lifted_until = None
+        self.misread = None
+        self.texts = {}
+        self.polls = 0
+
+    def _advance(self):
+        """Apply all events up to the current time"""
+        now = self.clock.monotonic()
+        while self.position < len(self.schedule) and self.schedule[self.position].at <= now:
+            event = self.schedule[self.position]
+            self.position += 1
+            if event.action == PRESENT:
+                self.tag_id = event.tag_id
+                self.lifted_until = None
+            elif event.action == REMOVE:
+                self.tag_id = None
+                self.lifted_until = None
+            elif event.action == FLAP:
+                self.lifted_until = event.at + event.duration
+            elif event.action == MISREAD:
+                self.misread = event
+        if self.lifted_until is not None and now >= self.lifted_until:
+            self.lifted_until = None
+
+    def read_id_no_block(self):
+        self.polls += 1
+        self._advance()
+        if self.misread:
+            misread, self.misread = self.misread, None
+            return misread.tag_id
+        if self.lifted_until is not None:
+            return None
+        return self.tag_id
+
+    def read_no_block(self):
+        tag_id = self.read_id_no_block()
+        return tag_id, self.texts.get(tag_id) if tag_id else None
+
+    def write_no_block(self, text):
+        tag_id = self.read_id_no_block()
+        if not tag_id:
+            return None, None
+        self.texts[tag_id] = text
+        return tag_id, text
+
+class SimulationResult:
+    """
+    Tag events reported during a scripted run
+    """
+    def __init__(self, schedule, events, polls):
+        self.schedule = schedule
+        self.events = events     # (time, tag_id, status)
+        self.polls = polls
+
+    def _windows(self, action):
+        """Time windows from each scripted present/remove to the next one"""
+        changes = [e for e in self.schedule if e.action in (PRESENT, REMOVE)]
+        for i, event in enumerate(changes):
+            if event.action == action:
+                end = changes[i + 1].at if i + 1 < len(changes) else float('inf')
+                yield event.at, end
+
+    def latencies(self, status=PRESENT):
+        """
+        Time from each scripted present/remove to the first matching event
+        reported before the next scripted change.
+
+        Returns:
+            list: Latencies in seconds, in schedule order (missed changes are skipped)
+        """
+        action = PRESENT if status == PRESENT else REMOVE
+        reported = [t for t, _, s in self.events if s == status]
+        result = []
+        for start, end in self._windows(action):
+            i = bisect.bisect_left(reported, start)
+            if i < len(reported) and reported[i] < end:
+                result.append(reported[i] - start)
+        return result
+
+    @property
+    def spurious_removals(self):
+        """Removals reported while the script had a card on the reader (flaps/misreads that got through)"""
+        windows = list(self._windows(REMOVE))
+        return sum(
+            1 for t, _, s in self.events
+            if s == 'absent' and not any(start <= t < end for start, end in windows)
+        )
+
+def run_scripted(schedule, duration, clock=None, removal_misses=None):
+    """
+    Run the RFIDHandler detection loop against a tap schedule.
+
+    Runs synchronously in the calling thread. With the default virtual
+    clock the run takes only as long as the loop needs to compute.
+
+    Args:
+        schedule (list): TapEvent tuples
+        duration (float): Simulated time to run for
+        clock: Clock to run on, defaults to a new VirtualClock
+        removal_misses (int): Override the removal debounce
+
+    Returns:
+        SimulationResult: The reported events
+    """
+    from utils.rfid_handler import RFIDHandler
+
+    clock = clock or VirtualClock()
+    reader = ScriptedReader(schedule, clock)
+    handler = RFIDHandler(reader=reader, clock=clock)
+    if removal_misses is not None:
+        handler.removal_misses = removal_misses
+
+    events = []
+    handler.register_callback(lambda tag_id, status: events.append((clock.monotonic(), tag_id, status)))
+    handler.run_for(duration)
+    return SimulationResult(schedule, events, reader.polls)
@@ -0,0 +1,348 @@
+"""
+Scheduling policy for the Kids Audio Player
+
+On a single-core Pi, web requests, log writes and analysis jobs compete
+with the decoder and the RFID loop for the CPU and the SD card, which is
+heard as stutter and felt as slow card detection. This module gives each
+role its CPU priority (real-time or nice), CPU affinity and IO priority:
+
+- decoder: mpg123 and aplay processes, the mixer thread
+- reader: the RFID detection loop and the reader pool thread
+- background: job workers, transcoding, the log writer
+
+Threads inherit the settings of the thread that starts them. Threads
+started from a loop with a role (e.g. the tag callback worker started by
+the RFID loop) call reset_thread() to run with the defaults again.
+
+Linux applies all three per thread, so a role can be given to a single
+thread of this process. Settings the process is not allowed to make
+(real-time without CAP_SYS_NICE or an RLIMIT_RTPRIO, raised IO priority
+without privileges) are skipped with one warning per role: real-time
+falls back to nice -10, then to the default priority.
+
+    python -m utils.sched_policy   # show what can be applied here and measure the reader loop
+"""
+import os
+import time
+import ctypes
+import platform
+import threading
+import logging
+from collections import deque
+from utils.metrics import metrics
+from config import (SCHED_POLICY_ENABLED, SCHED_DECODER_PRIORITY, SCHED_DECODER_IO, SCHED_DECODER_CPUS,
+                    SCHED_READER_PRIORITY, SCHED_READER_IO, SCHED_READER_CPUS,
+                    SCHED_BACKGROUND_PRIORITY, SCHED_BACKGROUND_IO, SCHED_BACKGROUND_CPUS)
+
+logger = logging.getLogger(__name__)
+
+DECODER = 'decoder'
+READER = 'reader'
+BACKGROUND = 'background'
+
+ROLES = {
+    DECODER: (SCHED_DECODER_PRIORITY, SCHED_DECODER_IO, SCHED_DECODER_CPUS),
+    READER: (SCHED_READER_PRIORITY, SCHED_READER_IO, SCHED_READER_CPUS),
+    BACKGROUND: (SCHED_BACKGROUND_PRIORITY, SCHED_BACKGROUND_IO, SCHED_BACKGROUND_CPUS),
+}
+
+# Used instead of a real-time priority the process may not set
+FALLBACK_NICE = -10
+
+# ioprio_set(2) has no wrapper in the C library
+IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                   'armv6l': 314, 'armv7l': 314, 'armv8l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IO_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+metrics.describe('sched_policy_degraded_total', 'counter', 'Scheduling settings that could not be applied')
+
+# Last applications, for status()
+_applied = deque(maxlen=50)
+_warned = set()
+_libc = None
+
+def parse_priority(spec):
+    """
+    Parse a priority setting.
+
+    Returns:
+        tuple: ('rr' or 'fifo', 1-99), ('nice', -20..19) or None for 'off'
+    """
+    spec = (spec or '').strip().lower()
+    if spec in ('', 'off'):
+        return None
+    kind, _, value = spec.partition(':')
+    if kind in ('rr', 'fifo'):
+        return kind, min(99, max(1, int(value or 1)))
+    if kind == 'nice':
+        return kind, min(19, max(-20, int(value or 0)))
+    raise ValueError(f"Unknown priority: {spec}")
+
+def parse_io(spec):
+    """
+    Parse an IO priority setting.
+
+    Returns:
+        tuple: (class name, level 0-7) or None for 'off'
+    """
+    spec = (spec or '').strip().lower()
+    if spec in ('', 'off'):
+        return None
+    kind, _, value = spec.partition(':')
+    if kind not in IO_CLASSES:
+        raise ValueError(f"Unknown IO priority: {spec}")
+    return kind, min(7, max(0, int(value or 0)))
+
+def parse_cpus(spec):
+    """Parse a CPU list like '0-2,3' into a set (empty for all CPUs)"""
+    cpus = set()
+    for part in (spec or '').replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _ioprio_set(target, io_class, level):
+    """Set the IO priority of a thread or process with the raw syscall"""
+    global _libc
+    number = IOPRIO_SYSCALLS.get(platform.machine())
+    if number is None:
+        raise OSError(f"ioprio_set unknown on {platform.machine()}")
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    value = (IO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | level
+    if _libc.syscall(number, IOPRIO_WHO_PROCESS, target, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def _set_priority(target, priority):
+    """
+    Apply a parsed priority, falling back from real-time to nice.
+
+    Returns:
+        tuple: (applied setting as str or None, error or None)
+    """
+    kind, value = priority
+    error = None
+    if kind in ('rr', 'fifo'):
+        policy = os.SCHED_RR if kind == 'rr' else os.SCHED_FIFO
+        try:
+            # Children (e.g. ffmpeg started from the reader loop) do not inherit it
+            os.sched_setscheduler(target, policy | os.SCHED_RESET_ON_FORK, os.sched_param(value))
+            return f"{kind}:{value}", None
+        except (OSError, AttributeError) as e:
+            error = f"{kind}:{value}: {e}"
+            kind, value = 'nice', FALLBACK_NICE
+    try:
+        os.setpriority(os.PRIO_PROCESS, target, value)
+        return f"nice:{value}", error
+    except OSError as e:
+        return None, f"{error + ', ' if error else ''}nice:{value}: {e}"
+
+def _apply(role, target):
+    """
+    Apply the settings of a role to a thread or process.
+
+    Returns:
+        dict: Applied settings and errors
+    """
+    priority_spec, io_spec, cpus_spec = ROLES[role]
+    result = {'priority': None, 'io': None, 'cpus': None, 'errors': []}
+
+    priority = parse_priority(priority_spec)
+    if priority:
+        result['priority'], error = _set_priority(target, priority)
+        if error:
+            result['errors'].append(('priority', error))
+
+    io = parse_io(io_spec)
+    if io:
+        try:
+            _ioprio_set(target, *io)
+            result['io'] = f"{io[0]}:{io[1]}"
+        except OSError as e:
+            result['errors'].append(('io', f"{io_spec}: {e}"))
+
+    cpus = parse_cpus(cpus_spec)
+    if cpus:
+        usable = cpus & os.sched_getaffinity(0)
+        try:
+            if not usable:
+                raise OSError(f"none of the CPUs {sorted(cpus)} is available")
+            os.sched_setaffinity(target, usable)
+            result['cpus'] = sorted(usable)
+        except OSError as e:
+            result['errors'].append(('cpus', f"{cpus_spec}: {e}"))
+    return result
+
+def apply(role, target=0, name=None):
+    """
+    Give a thread or process the scheduling settings of a role.
+
+    Args:
+        role (str): DECODER, READER or BACKGROUND
+        target (int): Thread ID (threading.get_native_id()) or process ID,
+            0 for the calling thread
+        name (str): Shown in the status
+
+    Returns:
+        dict: Applied settings and errors, None if disabled
+    """
+    if not SCHED_POLICY_ENABLED:
+        return None
+    try:
+        result = _apply(role, target)
+    except ValueError as e:
+        logger.error(f"Ungültige Scheduling-Einstellung für {role}: {e}")
+        return None
+
+    for part, error in result['errors']:
+        metrics.inc('sched_policy_degraded_total', role=role, part=part)
+        if (role, part) not in _warned:
+            _warned.add((role, part))
+            logger.warning(f"Scheduling für {role} nicht möglich ({error}), läuft mit Standardwerten weiter")
+        else:
+            logger.debug(f"Scheduling für {role}: {error}")
+
+    _applied.append(dict(result, role=role, target=target or threading.get_native_id(),
+                         name=name or threading.current_thread().name, at=time.time()))
+    return result
+
+def reset_thread():
+    """
+    Give the calling thread the default settings of the process back.
+
+    The scheduling policy becomes SCHED_OTHER with the niceness and CPU
+    affinity of the main thread, and the IO priority follows the niceness
+    again.
+
+    Returns:
+        dict: Errors by part (empty if all were reset), None if disabled
+    """
+    if not SCHED_POLICY_ENABLED:
+        return None
+    tid, pid = threading.get_native_id(), os.getpid()
+    errors = {}
+    steps = (
+        ('priority', lambda: os.sched_setscheduler(tid, os.SCHED_OTHER, os.sched_param(0))),
+        ('nice', lambda: os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, pid))),
+        ('io', lambda: _ioprio_set(tid, 'none', 0)),
+        ('cpus', lambda: os.sched_setaffinity(tid, os.sched_getaffinity(pid))),
+    )
+    for part, step in steps:
+        try:
+            step()
+        except (OSError, AttributeError) as e:
+            errors[part] = str(e)
+    if errors:
+        logger.debug(f"Scheduling von {threading.current_thread().name} nicht zurückgesetzt: {errors}")
+    _applied.append({'role': 'default', 'priority': None, 'io': None, 'cpus': None,
+                     'errors': list(errors.items()), 'target': tid,
+                     'name': threading.current_thread().name, 'at': time.time()})
+    return errors
+
+def apply_to_thread(role):
+    """Give the calling thread the settings of a role"""
+    return apply(role, threading.get_native_id(), threading.current_thread().name)
+
+def apply_to_process(role, process):
+    """Give a started subprocess.Popen the settings of a role"""
+    return apply(role, process.pid, os.path.basename(str(process.args[0] if isinstance(process.args, (list, tuple)) else process.args)))
+
+def preexec(role, nice=None):
+    """
+    Get a preexec_fn that applies a role in a child process before exec.
+
+    Nothing is logged there (the child of a threaded process must not
+    take locks); use apply_to_process to see errors.
+
+    Args:
+        nice (int): Niceness to add first (e.g. TRANSCODE_NICE)
+    """
+    def setup():
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError:
+                pass
+        if SCHED_POLICY_ENABLED:
+            try:
+                _apply(role, 0)
+            except Exception:
+                pass
+    return setup
+
+def status():
+    """Configured roles and the last applications"""
+    return {
+        'enabled': SCHED_POLICY_ENABLED,
+        'roles': {role: {'priority': p, 'io': io, 'cpus': cpus} for role, (p, io, cpus) in ROLES.items()},
+        'applied': list(_applied)
+    }
+
+def _measure_loop(duration, interval=0.01):
+    """Lateness of a 10 ms loop in ms (p50, p99, max)"""
+    late = []
+    end = time.monotonic() + duration
+    next_wake = time.monotonic() + interval
+    while time.monotonic() < end:
+        time.sleep(max(0.0, next_wake - time.monotonic()))
+        late.append((time.monotonic() - next_wake) * 1000)
+        next_wake += interval
+    late.sort()
+    return late[len(late) // 2], late[int(len(late) * 0.99)], late[-1]
+
+def _burn(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(10000))
+
+def _self_check(duration=4.0, busy=3):
+    """
+    Apply every role to a thread and measure how late a 10 ms loop (like
+    the RFID poll) wakes up while busy processes load the CPU, with the
+    default and with the reader settings.
+    """
+    import multiprocessing
+
+    print(f"{os.cpu_count()} CPU cores, uid {os.getuid()}, {platform.machine()}")
+    for role in ROLES:
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(apply_to_thread(role) or {}))
+        thread.start()
+        thread.join()
+        errors = '; '.join(error for _, error in result.get('errors', [])) or '-'
+        print(f"{role:<11} priority {str(result.get('priority')):<8} io {str(result.get('io')):<14} "
+              f"cpus {str(result.get('cpus')):<8} errors: {errors}")
+
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    workers = [context.Process(target=_burn, args=(stop,), daemon=True) for _ in range(busy)]
+    for worker in workers:
+        worker.start()
+    time.sleep(0.3)
+
+    print(f"\nLateness of a 10 ms loop over {duration:.0f} s with {busy} busy processes")
+    print(f"{'loop thread':<28} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for label, role in (('default', None), ('reader role', READER)):
+        figures = []
+        def run():
+            if role:
+                apply_to_thread(role)
+            figures.extend(_measure_loop(duration))
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        print(f"{label:<28} {'%7.2f %7.2f %7.2f' % tuple(figures)}")
+
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=2)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(_self_check())
@@ -0,0 +1,270 @@
+"""
+In-memory fuzzy search over songs and RFID tags
+
+Every word of a document is split into trigrams. A query word is matched
+against the vocabulary through the trigrams it shares with it, so small
+typos still find the right word, and documents are ranked by how well all
+query words match.
+"""
+import threading
+import unicodedata
+import re
+import logging
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Minimum trigram similarity for a word to count as a (fuzzy) match
+MIN_SIMILARITY = 0.35
+
+# Bonus added when a document word starts with the query word
+PREFIX_BONUS = 0.5
+
+_WORD_RE = re.compile(r'[0-9a-z]+')
+
+def normalize(text):
+    """Lower-case text and strip accents (e.g. 'Bär' -> 'bar')"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+    """Split text into normalized words"""
+    if not text:
+        return []
+    return _WORD_RE.findall(normalize(text))
+
+def trigrams(word):
+    """
+    Get the trigrams of a word.
+
+    The word is padded with two spaces in front, so the first trigrams
+    also encode the beginning of the word and short query words can be
+    matched as prefixes.
+    """
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _prefix_trigrams(word):
+    """Trigrams of the beginning of a word, used for query words shorter than 3 characters"""
+    padded = f"  {word}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchIndex:
+    """
+    Incremental trigram index over small documents
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._documents = {}                 # doc id -> (payload, words, signature)
+        self._word_documents = defaultdict(set)  # word -> doc ids
+        self._trigram_words = defaultdict(set)   # trigram -> words
+        self._word_trigrams = {}             # word -> trigrams
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._documents
+
+    def add(self, doc_id, texts, payload, signature=None):
+        """
+        Add or replace a document.
+
+        Args:
+            doc_id (str): Unique document id
+            texts (list): Texts that should be searchable
+            payload (dict): Data returned for matching documents
+            signature: Optional value to detect whether a document changed
+        """
+        words = set()
+        for text in texts:
+            words.update(tokenize(text))
+
+        with self._lock:
+            if doc_id in self._documents:
+                self.remove(doc_id)
+
+            self._documents[doc_id] = (payload, words, signature)
+            for word in words:
+                if word not in self._word_trigrams:
+                    grams = trigrams(word)
+                    self._word_trigrams[word] = grams
+                    for gram in grams:
+                        self._trigram_words[gram].add(word)
+                self._word_documents[word].add(doc_id)
+
+    def remove(self, doc_id):
+        """Remove a document from the index"""
+        with self._lock:
+            entry = self._documents.pop(doc_id, None)
+            if not entry:
+                return
+
+            for word in entry[1]:
+                documents = self._word_documents.get(word)
+                if documents is None:
+                    continue
+                documents.discard(doc_id)
+                if documents:
+                    continue
+
+                # Last document with this word, drop it from the vocabulary
+                del self._word_documents[word]
+                for gram in self._word_trigrams.pop(word, ()):
+                    grams_words = self._trigram_words.get(gram)
+                    if grams_words is not None:
+                        grams_words.discard(word)
+                        if not grams_words:
+                            del self._trigram_words[gram]
+
+    def signature(self, doc_id):
+        """Get the signature a document was added with"""
+        entry = self._documents.get(doc_id)
+        return entry[2] if entry else None
+
+    def doc_ids(self, prefix=''):
+        """Get the ids of all documents, optionally only those starting with prefix"""
+        with self._lock:
+            return [doc_id for doc_id in self._documents if doc_id.startswith(prefix)]
+
+    def _match_word(self, query_word):
+        """
+        Find vocabulary words similar to a query word.
+
+        Returns:
+            dict: word -> score
+        """
+        if len(query_word) < 3:
+            query_grams = _prefix_trigrams(query_word)
+        else:
+            query_grams = trigrams(query_word)
+
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._trigram_words.get(gram, ()))
+
+        matches = {}
+        for word, count in shared.items():
+            if word.startswith(query_word):
+                # Prefix matches are always accepted
+                similarity = 2.0 * count / (len(query_grams) + len(self._word_trigrams[word]))
+                matches[word] = similarity + PREFIX_BONUS
+            elif len(query_word) >= 3:
+                similarity = 2.0 * count / (len(query_grams) + len(self._word_trigrams[word]))
+                if similarity >= MIN_SIMILARITY:
+                    matches[word] = similarity
+        return matches
+
+    def search(self, query, limit=20, prefix=''):
+        """
+        Search the index.
+
+        Every query word has to match (exactly, as a prefix or fuzzily)
+        at least one word of a document.
+
+        Args:
+            query (str): Search text
+            limit (int): Maximum number of results
+            prefix (str): Only return documents whose id starts with prefix
+
+        Returns:
+            list: (score, payload) tuples, best match first
+        """
+        query_words = tokenize(query)
+        if not query_words:
+            return []
+
+        with self._lock:
+            scores = None
+            for query_word in query_words:
+                word_scores = defaultdict(float)
+                for word, score in self._match_word(query_word).items():
+                    for doc_id in self._word_documents[word]:
+                        if doc_id.startswith(prefix) and score > word_scores[doc_id]:
+                            word_scores[doc_id] = score
+
+                if scores is None:
+                    scores = dict(word_scores)
+                else:
+                    scores = {doc_id: total + word_scores[doc_id]
+                              for doc_id, total in scores.items() if doc_id in word_scores}
+                if not scores:
+                    return []
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            return [(round(score, 3), self._documents[doc_id][0]) for doc_id, score in ranked]
+
+class LibrarySearch:
+    """
+    Search index kept in sync with the music library and the RFID tags
+    """
+    SONG = 'song:'
+    TAG = 'tag:'
+
+    def __init__(self, library):
+        self.library = library
+        self.index = SearchIndex()
+        self._library_generation = None
+        self._tags_generation = None
+        self._lock = threading.Lock()
+
+    def sync_songs(self, songs):
+        """Update the index with the current list of songs"""
+        current = set()
+        for song in songs:
+            doc_id = self.SONG + song['filename']
+            current.add(doc_id)
+            signature = (song.get('title'), song.get('artist'), song.get('album'), song.get('cover_image'))
+            if self.index.signature(doc_id) == signature:
+                continue
+            texts = [song.get('title'), song.get('artist'), song.get('album'), song['filename']]
+            self.index.add(doc_id, texts, dict(song, kind='song'), signature)
+
+        for doc_id in self.index.doc_ids(self.SONG):
+            if doc_id not in current:
+                self.index.remove(doc_id)
+
+    def sync_tags(self, tags):
+        """
+        Update the index with the current list of tags.
+
+        Args:
+            tags (list): Dictionaries with tag_id, name and mp3_filename
+        """
+        current = set()
+        for tag in tags:
+            doc_id = self.TAG + tag['tag_id']
+            current.add(doc_id)
+            signature = (tag['name'], tag['mp3_filename'])
+            if self.index.signature(doc_id) == signature:
+                continue
+            self.index.add(doc_id, [tag['name'], tag['tag_id'], tag['mp3_filename']], dict(tag, kind='tag'), signature)
+
+        for doc_id in self.index.doc_ids(self.TAG):
+            if doc_id not in current:
+                self.index.remove(doc_id)
+
+    def refresh(self, tags_generation, load_tags):
+        """
+        Bring the index up to date if the library or the tags changed.
+
+        Args:
+            tags_generation (int): Current generation of the RFID tags
+            load_tags (callable): Returns the list of tags, only called if they changed
+        """
+        with self._lock:
+            library_generation = self.library.refresh()
+            if library_generation != self._library_generation:
+                self.sync_songs(self.library.get_songs())
+                self._library_generation = library_generation
+                logger.debug(f"Search index synced with library generation {library_generation}")
+
+            if tags_generation != self._tags_generation:
+                self.sync_tags(load_tags())
+                self._tags_generation = tags_generation
+                logger.debug(f"Search index synced with tag generation {tags_generation}")
+
+    def search(self, query, limit=20, kind=None):
+        """Search songs and/or tags ('song', 'tag' or None for both)"""
+        prefix = {'song': self.SONG, 'tag': self.TAG}.get(kind, '')
+        return self.index.search(query, limit=limit, prefix=prefix)
@@ -0,0 +1,106 @@
+"""
+In-memory cache of the RFID tag mappings
+
+Loads all tags once and keeps them until a change notification arrives,
+then reloads only the tags named in the notification. If notifications
+were lost (a gap in the generations of a sender), everything is reloaded.
+Notifications that arrive while all tags are loaded are applied after the
+load, since the load may have read the tags before the change.
+"""
+import threading
+import logging
+from utils.generation import TAGS
+
+logger = logging.getLogger(__name__)
+
+class TagMappingCache:
+    """
+    Tag ID to (name, mp3_filename) mapping, refreshed by change notifications
+    """
+    def __init__(self, app):
+        """
+        Args:
+            app: Flask app providing the database
+        """
+        self.app = app
+        self._tags = {}
+        self._loaded = False
+        self._sources = {}
+        self._changed = None       # Tags notified while a full load runs
+        self._stale = False        # Load again after the running one
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def reload(self):
+        """Load all tags from the database"""
+        from models import RFIDTag
+        with self._load_lock:
+            with self._lock:
+                self._changed, self._stale = set(), False
+            with self.app.app_context():
+                tags = {t.tag_id: (t.name, t.mp3_filename) for t in RFIDTag.query.all()}
+            with self._lock:
+                self._tags = tags
+                self._loaded = True
+                changed, stale, self._changed = self._changed, self._stale, None
+        logger.info(f"Tag mappings loaded: {len(tags)} tags")
+
+        if stale:
+            self.reload()
+        elif changed:
+            self.refresh(sorted(changed))
+
+    def refresh(self, tag_ids):
+        """Reload some tags from the database"""
+        from models import RFIDTag
+        with self.app.app_context():
+            rows = RFIDTag.query.filter(RFIDTag.tag_id.in_(tag_ids)).all()
+            found = {t.tag_id: (t.name, t.mp3_filename) for t in rows}
+        with self._lock:
+            for tag_id in tag_ids:
+                if tag_id in found:
+                    self._tags[tag_id] = found[tag_id]
+                else:
+                    self._tags.pop(tag_id, None)
+        logger.debug(f"Tag mappings refreshed: {tag_ids}")
+
+    def get(self, tag_id):
+        """
+        Get the mapping of a tag.
+
+        Returns:
+            tuple: (name, mp3_filename), or None if the tag is not registered
+        """
+        if not self._loaded:
+            self.reload()
+        with self._lock:
+            return self._tags.get(tag_id)
+
+    def handle_notification(self, message):
+        """Apply a change notification (see utils.change_notify)"""
+        if message.get('topic') != TAGS:
+            return
+
+        source, generation = message.get('source'), message.get('generation')
+        with self._lock:
+            last = self._sources.get(source)
+            self._sources[source] = generation
+            gap = last is not None and generation != last + 1
+            if self._changed is not None:
+                # A full load is running, apply the change after it
+                if gap or message.get('keys') is None:
+                    self._stale = True
+                else:
+                    self._changed.update(message['keys'])
+                return
+            loaded = self._loaded
+
+        if not loaded:
+            # The first load reads the change
+            return
+        if gap or message.get('keys') is None:
+            if gap:
+                logger.warning(f"Change notifications from {source} lost, reloading all tags")
+            self.reload()
+        else:
+            self.refresh(message['keys'])
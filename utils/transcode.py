@@ -0,0 +1,284 @@
+"""
+Transcoding cache for the Kids Audio Player
+
+Sources that are expensive to decode on a Pi (high-bitrate MP3s) or that
+mpg123 cannot play at all (WAV, FLAC, OGG, ...) are converted once with
+ffmpeg into a small MP3. Results are stored under the hash of the source
+content and the output profile, and the least recently used files are
+evicted when the cache grows beyond its size limit.
+
+Playback looks sources up by path, size and modification time in an index
+kept next to the cached files. Hashing and transcoding only happen in a
+background worker, so a tap on a large source that is not cached yet
+never waits for them; the source is played directly that time.
+"""
+import os
+import json
+import queue
+import shutil
+import subprocess
+import threading
+import logging
+from utils.file_handler import content_hash
+from utils import sched_policy
+from config import (TRANSCODE_ENABLED, TRANSCODE_CACHE_DIR, TRANSCODE_CACHE_MAX_MB,
+                    TRANSCODE_BITRATE_KBPS, TRANSCODE_SAMPLE_RATE, TRANSCODE_NICE)
+
+logger = logging.getLogger(__name__)
+
+# Index of the cached copies by path, size and mtime of the source
+INDEX_FILE = 'index.json'
+
+# Bitrates (kbps) of MPEG-1 Layer III and MPEG-2/2.5 Layer III frames
+_MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+_MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+
+def mp3_bitrate(path):
+    """
+    Read the bitrate of the first MP3 frame.
+
+    Returns:
+        int: Bitrate in kbps, or None if no frame header was found
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(10)
+            offset = 0
+            if data[:3] == b'ID3' and len(data) == 10:
+                offset = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+            f.seek(offset)
+            data = f.read(16 * 1024)
+    except OSError:
+        return None
+
+    for i in range(len(data) - 3):
+        if data[i] != 0xFF or (data[i + 1] & 0xE0) != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 0x03
+        layer = (data[i + 1] >> 1) & 0x03
+        index = data[i + 2] >> 4
+        if layer != 0x01 or version == 0x01 or index in (0, 15):
+            continue  # Not a Layer III header
+        table = _MPEG1_BITRATES if version == 0x03 else _MPEG2_BITRATES
+        return table[index]
+    return None
+
+class TranscodeCache:
+    """
+    Content-addressed cache of transcoded audio files
+    """
+    def __init__(self, cache_dir, max_bytes, bitrate_kbps, sample_rate):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bitrate_kbps = bitrate_kbps
+        self.sample_rate = sample_rate
+        self.profile = f"mp3-{bitrate_kbps}k-{sample_rate}"
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._worker = None
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, INDEX_FILE)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            return index if isinstance(index, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        """Write the index, dropping entries whose copy was evicted"""
+        with self._lock:
+            self._index = {key: path for key, path in self._index.items() if os.path.exists(path)}
+            data = json.dumps(self._index)
+        tmp_path = f"{self._index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning(f"Could not write the transcode index: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _index_key(self, source_path):
+        """Key of a source in the index (changes when the file is replaced)"""
+        stat = os.stat(source_path)
+        return f"{os.path.abspath(source_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def cache_path(self, source_path):
+        """Get the path a source is cached under (reads the whole source)"""
+        digest = content_hash(source_path)
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{self.profile}.mp3")
+
+    def needs_transcode(self, source_path):
+        """Check whether a source should be played from a transcoded copy"""
+        if not source_path.lower().endswith('.mp3'):
+            return True
+        bitrate = mp3_bitrate(source_path)
+        return bitrate is not None and bitrate > self.bitrate_kbps
+
+    def lookup(self, source_path):
+        """
+        Get the cached copy of a source without reading the source.
+
+        Returns:
+            str: Path of the cached file, or None if it is not cached
+        """
+        key = self._index_key(source_path)
+        with self._lock:
+            path = self._index.get(key)
+        if not path or not os.path.exists(path):
+            return None
+        # Touch the file, eviction removes the least recently used files first
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def transcode(self, source_path):
+        """
+        Transcode a source into the cache (blocking).
+
+        Returns:
+            str: Path of the cached file
+        """
+        key = self._index_key(source_path)
+        path = self.cache_path(source_path)
+        if os.path.exists(path):
+            self._remember(key, path)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            subprocess.run(
+                ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+                 '-i', source_path, '-vn', '-ac', '2', '-ar', str(self.sample_rate),
+                 '-b:a', f"{self.bitrate_kbps}k", '-f', 'mp3', tmp_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+                preexec_fn=sched_policy.preexec(sched_policy.BACKGROUND, TRANSCODE_NICE)
+            )
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        logger.info(f"Transcoded {source_path} -> {path}")
+        self.evict()
+        self._remember(key, path)
+        return path
+
+    def _remember(self, key, path):
+        with self._lock:
+            self._index[key] = path
+        self._save_index()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits its size limit"""
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.mp3'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted {path} from the transcode cache")
+            except OSError as e:
+                logger.warning(f"Could not evict {path}: {e}")
+
+    def schedule(self, source_path):
+        """Transcode a source in the background"""
+        with self._lock:
+            if source_path in self._pending:
+                return
+            self._pending.add(source_path)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        self._queue.put(source_path)
+
+    def _run(self):
+        """Background worker transcoding one source at a time"""
+        while True:
+            source_path = self._queue.get()
+            try:
+                self.transcode(source_path)
+            except Exception as e:
+                logger.error(f"Transcoding of {source_path} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(source_path)
+
+    def resolve(self, source_path):
+        """
+        Get the file that should be played for a source.
+
+        Called when a card is tapped, so it never hashes or transcodes:
+        sources without a cached copy are played directly this time and
+        transcoded in the background for the next time. mpg123 cannot
+        play most non-MP3 sources directly; their first tap stays silent
+        (the mixer plays WAV files).
+
+        Returns:
+            str: Path of the file to play
+        """
+        try:
+            if not self.needs_transcode(source_path):
+                return source_path
+
+            cached = self.lookup(source_path)
+            if cached:
+                return cached
+
+            self.schedule(source_path)
+            if not source_path.lower().endswith('.mp3'):
+                logger.info(f"{source_path} wird im Hintergrund umgewandelt, bis dahin wird die Quelle direkt abgespielt")
+        except Exception as e:
+            logger.error(f"Transcode cache error for {source_path}: {e}")
+        return source_path
+
+# Shared cache instance (None if transcoding is disabled or ffmpeg is missing)
+_transcode_cache = None
+
+def get_transcode_cache():
+    """Get the shared transcode cache, or None if transcoding is disabled"""
+    global _transcode_cache
+    if _transcode_cache is None and TRANSCODE_ENABLED:
+        if not shutil.which('ffmpeg'):
+            logger.warning("Transcoding enabled but ffmpeg not found")
+            return None
+        _transcode_cache = TranscodeCache(
+            TRANSCODE_CACHE_DIR,
+            TRANSCODE_CACHE_MAX_MB * 1024 * 1024,
+            TRANSCODE_BITRATE_KBPS,
+            TRANSCODE_SAMPLE_RATE
+        )
+    return _transcode_cache
+
+def resolve_playback_path(source_path):
+    """Get the file to play for a source, using the transcode cache if enabled"""
+    cache = get_transcode_cache()
+    if cache is None:
+        return source_path
+    return cache.resolve(source_path)
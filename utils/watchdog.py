@@ -0,0 +1,193 @@
+"""
+Watchdog for the Kids Audio Player
+
+Watches the RFID loop and the audio decoders. The loops report heartbeats,
+the decoders their progress; a component that stopped is restarted in the
+background, so a wedged SPI reader or a hanging mpg123 recovers within
+about a second instead of waiting for someone to power-cycle the box.
+A component that keeps failing is restarted with exponential backoff.
+
+Restarts and recovery times are recorded in utils.metrics.
+"""
+import time
+import threading
+import logging
+from utils.metrics import metrics
+from utils import sched_policy
+from config import (WATCHDOG_ENABLED, WATCHDOG_INTERVAL_MS, WATCHDOG_READER_TIMEOUT_MS,
+                    WATCHDOG_DECODER_TIMEOUT_MS, WATCHDOG_BACKOFF_MAX_S)
+
+logger = logging.getLogger(__name__)
+
+# Wait before the second restart of a component, doubled for every further one
+BACKOFF_MIN = 0.5
+
+# A component that stayed healthy this long starts again at BACKOFF_MIN
+STABLE_AFTER = 60.0
+
+metrics.describe('watchdog_restarts_total', 'counter', 'Restarts of stalled components')
+metrics.describe('watchdog_restart_errors_total', 'counter', 'Restarts that raised an error')
+metrics.describe('watchdog_recovery_seconds', 'summary', 'Time from detecting a stall until the component was healthy again')
+metrics.describe('watchdog_healthy', 'gauge', '1 if the component is healthy')
+
+class Heartbeat:
+    """
+    Time of the last sign of life of a loop
+    """
+    def __init__(self):
+        self.last = time.monotonic()
+
+    def beat(self):
+        self.last = time.monotonic()
+
+    def age(self):
+        """Seconds since the last beat"""
+        return time.monotonic() - self.last
+
+class _Component:
+    def __init__(self, name, check, restart):
+        self.name = name
+        self.check = check
+        self.restart = restart
+        self.failed_since = None
+        self.healthy_since = time.monotonic()
+        self.next_restart = 0.0
+        self.backoff = BACKOFF_MIN
+        self.restarting = False
+        self.restarts = 0
+        self.last_reason = None
+        self.last_recovery = None
+
+class Watchdog:
+    """
+    Checks registered components and restarts the ones that stalled
+    """
+    def __init__(self, interval=WATCHDOG_INTERVAL_MS / 1000, backoff_max=WATCHDOG_BACKOFF_MAX_S):
+        self.interval = interval
+        self.backoff_max = backoff_max
+        self.components = {}
+        self.running = False
+        self.thread = None
+
+    def watch(self, name, check, restart):
+        """
+        Register a component.
+
+        Args:
+            name (str): Name used in logs and metrics
+            check (callable): Returns None while healthy, otherwise the
+                reason (str)
+            restart (callable): Called with the reason in a background
+                thread to restart the component
+        """
+        self.components[name] = _Component(name, check, restart)
+        metrics.set('watchdog_healthy', 1, component=name)
+
+    def start(self):
+        """Start the watchdog thread"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='watchdog', daemon=True)
+        self.thread.start()
+        logger.info(f"Watchdog gestartet ({', '.join(self.components)})")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def _run(self):
+        # Must get the CPU when the loops it watches are starved
+        sched_policy.apply_to_thread(sched_policy.READER)
+        while self.running:
+            for component in list(self.components.values()):
+                self.check(component)
+            time.sleep(self.interval)
+
+    def check(self, component):
+        """Check one component and restart it if needed"""
+        if component.restarting:
+            return
+        now = time.monotonic()
+        try:
+            reason = component.check()
+        except Exception as e:
+            reason = f"check failed: {e}"
+
+        if reason is None:
+            if component.failed_since is not None:
+                recovery = now - component.failed_since
+                component.failed_since = None
+                component.healthy_since = now
+                component.last_recovery = recovery
+                metrics.observe('watchdog_recovery_seconds', recovery, component=component.name)
+                metrics.set('watchdog_healthy', 1, component=component.name)
+                logger.info(f"Watchdog: {component.name} läuft wieder nach {recovery * 1000:.0f} ms")
+            elif component.backoff > BACKOFF_MIN and now - component.healthy_since > STABLE_AFTER:
+                component.backoff = BACKOFF_MIN
+            return
+
+        if component.failed_since is None:
+            component.failed_since = now
+            metrics.set('watchdog_healthy', 0, component=component.name)
+            logger.warning(f"Watchdog: {component.name} hängt ({reason})")
+        if now < component.next_restart:
+            return
+
+        component.restarts += 1
+        component.last_reason = reason
+        component.next_restart = now + component.backoff
+        component.backoff = min(component.backoff * 2, self.backoff_max)
+        component.restarting = True
+        metrics.inc('watchdog_restarts_total', component=component.name, reason=reason.split(':')[0])
+        threading.Thread(target=self._restart, args=(component, reason), daemon=True,
+                         name=f"watchdog-restart-{component.name}").start()
+
+    def _restart(self, component, reason):
+        try:
+            logger.warning(f"Watchdog: starte {component.name} neu (#{component.restarts}, {reason})")
+            component.restart(reason)
+        except Exception as e:
+            metrics.inc('watchdog_restart_errors_total', component=component.name)
+            logger.error(f"Watchdog: Neustart von {component.name} fehlgeschlagen: {e}")
+        finally:
+            component.restarting = False
+
+    def status(self):
+        """State of the watched components"""
+        now = time.monotonic()
+        return {
+            name: {
+                'healthy': component.failed_since is None,
+                'failing_s': round(now - component.failed_since, 3) if component.failed_since is not None else None,
+                'restarts': component.restarts,
+                'last_reason': component.last_reason,
+                'last_recovery_ms': round(component.last_recovery * 1000, 1) if component.last_recovery is not None else None,
+                'backoff_s': component.backoff
+            }
+            for name, component in self.components.items()
+        }
+
+def create_watchdog(reader=None):
+    """
+    Create the watchdog for a reader and the audio decoders.
+
+    Args:
+        reader: RFIDHandler or ReaderPool (with check_health and restart)
+
+    Returns:
+        Watchdog: The (not yet started) watchdog, or None if disabled
+    """
+    if not WATCHDOG_ENABLED:
+        return None
+    from utils.player import decoder_health, restart_stalled_decoders
+
+    watchdog = Watchdog()
+    if reader is not None:
+        watchdog.watch('reader', lambda: reader.check_health(WATCHDOG_READER_TIMEOUT_MS / 1000),
+                       lambda reason: reader.restart())
+    watchdog.watch('decoder', lambda: decoder_health(WATCHDOG_DECODER_TIMEOUT_MS / 1000),
+                   lambda reason: restart_stalled_decoders(WATCHDOG_DECODER_TIMEOUT_MS / 1000))
+    return watchdog